@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Runs many TLS handshakes, each followed by an HTTP request, concurrently from a single thread with AsyncTLSSocket
+coroutines.
+
+    #> python async_concurrent_handshakes.py <host> <port> [sessions]
+"""
+
+from __future__ import print_function
+import socket
+import sys
+import time
+
+try:
+    from scapy.layers.ssl_tls import *
+    import scapy.layers.ssl_tls_async as tlsa
+except ImportError:
+    from scapy_ssl_tls.ssl_tls import *
+    import scapy_ssl_tls.ssl_tls_async as tlsa
+
+
+def session(target):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect(target)
+    tls_socket = tlsa.AsyncTLSSocket(sock, client=True, timeout=5)
+    try:
+        yield tls_socket.do_handshake(TLSVersion.TLS_1_2, [TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
+                                                          TLSCipherSuite.RSA_WITH_AES_256_CBC_SHA])
+        resp = yield tls_socket.do_round_trip(TLSPlaintext(data="GET / HTTP/1.1\r\nHost: %s\r\n\r\n" % target[0]))
+        raise tlsa.Return(len(resp[TLSPlaintext].data) if resp.haslayer(TLSPlaintext) else 0)
+    finally:
+        tls_socket.close()
+
+
+def main(target, sessions):
+    loop = tlsa.EventLoop()
+    start = time.time()
+    tasks = [loop.spawn(session(target)) for _ in range(sessions)]
+    loop.run()
+    elapsed = time.time() - start
+    for index, task in enumerate(tasks):
+        try:
+            print("session %d: %d bytes of application data" % (index, task.result()))
+        except TLSProtocolError as tpe:
+            print("session %d: %s" % (index, tpe))
+    print("* %d sessions in %.2fs" % (sessions, elapsed))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) <= 2:
+        print("USAGE: <host> <port> [sessions]")
+        exit(1)
+    main((sys.argv[1], int(sys.argv[2])), int(sys.argv[3]) if len(sys.argv) > 3 else 10)
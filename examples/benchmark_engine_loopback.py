@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks sans-IO TLSEngine sessions in an in memory loopback: one loop, no sockets nor threads, interleaves the
+handshakes and an application data round trip of all client and server session pairs.
+
+    #> python benchmark_engine_loopback.py [sessions] [cert.der] [key.pem]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+try:
+    from scapy.layers.ssl_tls import *
+    import scapy.layers.ssl_tls_engine as ssl_tls_engine
+except ImportError:
+    from scapy_ssl_tls.ssl_tls import *
+    import scapy_ssl_tls.ssl_tls_engine as ssl_tls_engine
+
+KEYS = os.path.join(os.path.dirname(__file__), "..", "tests", "integration", "keys")
+
+
+class SessionPair(object):
+    """ A client and a server engine, and the bytes in flight on their in memory wire
+    """
+
+    def __init__(self, certificates, keyfile):
+        self.client = ssl_tls_engine.TLSEngine(client=True)
+        self.server = ssl_tls_engine.TLSEngine(client=False)
+        self.server.tls_ctx.server_ctx.load_rsa_keys_from_file(keyfile)
+        self.server.accept_handshake(certificates, TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+        self.to_server = self.client.start_handshake(TLSVersion.TLS_1_2, [TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+        self.to_client = ""
+        self.pinged = False
+        self.ponged = False
+
+    def step(self):
+        """ Delivers the bytes in flight, returns False once the round trip is done
+        """
+        data, self.to_server = self.to_server, ""
+        for record in self.server.feed_incoming(data):
+            if record.haslayer(TLSPlaintext):
+                self.to_client += self.server.send(TLSPlaintext(data=record[TLSPlaintext].data))
+        self.to_client += self.server.data_to_send()
+        data, self.to_client = self.to_client, ""
+        for record in self.client.feed_incoming(data):
+            self.ponged |= record.haslayer(TLSPlaintext)
+        self.to_server += self.client.data_to_send()
+        if self.client.handshake_complete and not self.pinged:
+            self.pinged = True
+            self.to_server += self.client.send(TLSPlaintext(data="ping"))
+        return not self.ponged
+
+
+def main(sessions, certfile, keyfile):
+    with open(certfile, "rb") as f:
+        certificates = [TLSCertificate(data=f.read())]
+    start = time.time()
+    pairs = [SessionPair(certificates, keyfile) for _ in range(sessions)]
+    while pairs:
+        pairs = [pair for pair in pairs if pair.step()]
+    elapsed = time.time() - start
+    print("* %d sessions (handshake and round trip) in %.2fs, %.1f sessions/s" % (sessions, elapsed,
+                                                                                  sessions / elapsed))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+         sys.argv[2] if len(sys.argv) > 2 else os.path.join(KEYS, "cert.der"),
+         sys.argv[3] if len(sys.argv) > 3 else os.path.join(KEYS, "key.pem"))
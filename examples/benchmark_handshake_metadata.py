@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks metadata only handshake extraction, in handshakes per second. The synthetic corpus replays the
+connections of a capture under as many distinct client addresses as requested, interleaved.
+
+    #> python benchmark_handshake_metadata.py [handshakes] [workers] [capture.pcap]
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+
+try:
+    from scapy.all import IP, TCP
+    import scapy.layers.ssl_tls_metadata as ssl_tls_metadata
+    import scapy.layers.ssl_tls_pipeline as ssl_tls_pipeline
+except ImportError:
+    from scapy.all import IP, TCP
+    import scapy_ssl_tls.ssl_tls_metadata as ssl_tls_metadata
+    import scapy_ssl_tls.ssl_tls_pipeline as ssl_tls_pipeline
+
+DEFAULT_CAPTURE = os.path.join(os.path.dirname(__file__), "..", "tests", "files", "RSA_WITH_AES_128_CBC_SHA.pcap")
+
+
+def synthetic_corpus(pcap, copies):
+    """ Returns (linktype, timestamp, raw_bytes) tuples replaying pcap copies times, client address changed per copy
+    """
+    template = list(ssl_tls_pipeline.decode_packets(ssl_tls_pipeline.iter_pcap(pcap)))
+    client = template[0][IP].src
+    corpus = []
+    for pkt in template:
+        for copy in range(copies):
+            address = "10.%d.%d.%d" % (copy >> 16 & 0xff, copy >> 8 & 0xff, copy & 0xff)
+            replayed = pkt.copy()
+            if replayed[IP].src == client:
+                replayed[IP].src = address
+            else:
+                replayed[IP].dst = address
+            del replayed[IP].chksum
+            del replayed[TCP].chksum
+            corpus.append((ssl_tls_pipeline.DLT_EN10MB, pkt.time, str(replayed)))
+    return corpus
+
+
+def main(handshakes=1000, workers=0, pcap=DEFAULT_CAPTURE):
+    print("* building corpus of %d handshakes" % handshakes)
+    corpus = synthetic_corpus(pcap, handshakes)
+    extractor = ssl_tls_metadata.HandshakeExtractor()
+    pipeline = ssl_tls_pipeline.ShardedPipeline(extractor.handle_record, workers=workers,
+                                                on_evict=extractor.handle_evict)
+    started = time.time()
+    extracted = sum(1 for _ in pipeline.run(corpus))
+    elapsed = time.time() - started
+    print("* %d handshakes (%d packets) in %.2fs with %d workers: %.0f handshakes/s" %
+          (extracted, len(corpus), elapsed, workers, extracted / elapsed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]] + sys.argv[3:])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Benchmarks the memory held by TLSSessionCtx, in bytes per session, under each history policy. Sessions are run in an
+in memory TLSEngine loopback: a TLS 1.2 handshake, then application data round trips. Sizes are the sum of
+sys.getsizeof() over all objects reachable from the client contexts, objects shared by all sessions are amortized.
+
+    #> python benchmark_session_memory.py [sessions] [round_trips] [cert.der] [key.pem]
+"""
+
+from __future__ import print_function
+import collections
+import os
+import sys
+import types
+
+try:
+    from scapy.layers.ssl_tls import *
+    import scapy.layers.ssl_tls_crypto as ssl_tls_crypto
+    import scapy.layers.ssl_tls_engine as ssl_tls_engine
+except ImportError:
+    from scapy_ssl_tls.ssl_tls import *
+    import scapy_ssl_tls.ssl_tls_crypto as ssl_tls_crypto
+    import scapy_ssl_tls.ssl_tls_engine as ssl_tls_engine
+
+KEYS = os.path.join(os.path.dirname(__file__), "..", "tests", "integration", "keys")
+POLICIES = (ssl_tls_crypto.TLSSessionCtx.HISTORY_ALL, ssl_tls_crypto.TLSSessionCtx.HISTORY_HANDSHAKE, 16,
+            ssl_tls_crypto.TLSSessionCtx.HISTORY_NONE)
+# Not accounted to sessions: code and classes
+SKIPPED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                 types.MethodType)
+
+
+def slot_values(obj):
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        for slot in (slots,) if isinstance(slots, str) else slots:
+            # Private slots are name mangled
+            if slot.startswith("__") and not slot.endswith("__"):
+                slot = "_%s%s" % (cls.__name__.lstrip("_"), slot)
+            if hasattr(obj, slot):
+                yield getattr(obj, slot)
+
+
+def deep_size(root):
+    """ Returns the bytes of all objects reachable from root, each counted once
+    """
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            pending.extend(obj)
+        if hasattr(obj, "__dict__"):
+            pending.append(obj.__dict__)
+        pending.extend(slot_values(obj))
+    return size
+
+
+def run_session(history_policy, certificates, keyfile, round_trips):
+    """ Returns the client engine, once its handshake and round trips are done
+    """
+    client = ssl_tls_engine.TLSEngine(client=True, tls_ctx=ssl_tls_crypto.TLSSessionCtx(True, history_policy))
+    server = ssl_tls_engine.TLSEngine(client=False, tls_ctx=ssl_tls_crypto.TLSSessionCtx(False, history_policy))
+    server.tls_ctx.server_ctx.load_rsa_keys_from_file(keyfile)
+    server.accept_handshake(certificates, TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+    to_server = client.start_handshake(TLSVersion.TLS_1_2, [TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+    while not client.handshake_complete:
+        server.feed_incoming(to_server)
+        client.feed_incoming(server.data_to_send())
+        to_server = client.data_to_send()
+    server.feed_incoming(to_server)
+    for _ in range(round_trips):
+        for record in server.feed_incoming(client.send(TLSPlaintext(data="ping"))):
+            client.feed_incoming(server.send(TLSPlaintext(data=record[TLSPlaintext].data)))
+    return client
+
+
+def main(sessions, round_trips, certfile, keyfile):
+    with open(certfile, "rb") as f:
+        certificates = [TLSCertificate(data=f.read())]
+    for history_policy in POLICIES:
+        clients = [run_session(history_policy, certificates, keyfile, round_trips) for _ in range(sessions)]
+        size = deep_size([client.tls_ctx for client in clients])
+        print("* history policy %-9s: %d bytes/session (%d sessions, %d round trips each)" %
+              (history_policy, size // sessions, sessions, round_trips))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+         sys.argv[3] if len(sys.argv) > 3 else os.path.join(KEYS, "cert.der"),
+         sys.argv[4] if len(sys.argv) > 4 else os.path.join(KEYS, "key.pem"))
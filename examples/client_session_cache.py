@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Reconnects to a server several times, resuming the cached session in an abbreviated handshake once the first full
+handshake completed.
+
+    #> python client_session_cache.py <host> <port> [connections]
+"""
+
+from __future__ import print_function
+import socket
+import sys
+import time
+
+try:
+    from scapy.layers.ssl_tls import *
+    import scapy.layers.ssl_tls_session as tlssess
+except ImportError:
+    from scapy_ssl_tls.ssl_tls import *
+    import scapy_ssl_tls.ssl_tls_session as tlssess
+
+
+def main(target, connections):
+    cache = tlssess.ClientSessionCache()
+    for index in range(connections):
+        with TLSSocket(socket.create_connection(target), client=True) as tls_socket:
+            start = time.time()
+            tlssess.tls_do_cached_handshake(tls_socket, cache, TLSVersion.TLS_1_2,
+                                            [TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
+                                             TLSCipherSuite.RSA_WITH_AES_256_CBC_SHA])
+            elapsed = time.time() - start
+            print("connection %d: %s handshake in %.3fs, %r" % (index, "abbreviated" if
+                                                                 tls_socket.tls_ctx.negotiated.resumption else "full",
+                                                                 elapsed, cache.get(*target)))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) <= 2:
+        print("USAGE: <host> <port> [connections]")
+        exit(1)
+    main((sys.argv[1], int(sys.argv[2])), int(sys.argv[3]) if len(sys.argv) > 3 else 3)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Exports one line of metadata per TLS handshake found in a capture, as NDJSON or CSV (by output file extension).
+No session context is built and no key is needed.
+
+    #> python handshake_metadata_export.py capture.pcap handshakes.ndjson [workers]
+"""
+
+from __future__ import print_function
+import os
+import sys
+
+try:
+    import scapy.layers.ssl_tls_metadata as ssl_tls_metadata
+    import scapy.layers.ssl_tls_pipeline as ssl_tls_pipeline
+except ImportError:
+    import scapy_ssl_tls.ssl_tls_metadata as ssl_tls_metadata
+    import scapy_ssl_tls.ssl_tls_pipeline as ssl_tls_pipeline
+
+
+def main(pcap, output, workers=None):
+    extractor = ssl_tls_metadata.HandshakeExtractor()
+    pipeline = ssl_tls_pipeline.ShardedPipeline(extractor.handle_record, workers=workers,
+                                                on_evict=extractor.handle_evict)
+    writer_cls = ssl_tls_metadata.CSVWriter if output.endswith(".csv") else ssl_tls_metadata.NDJSONWriter
+    meter = ssl_tls_pipeline.ProgressMeter(lambda m: print("* %s" % m, file=sys.stderr),
+                                           total=os.path.getsize(pcap), interval=5)
+    with open(output, "wb") as fileobj, writer_cls(fileobj) as writer:
+        writer.writeall(pipeline.run(meter(ssl_tls_pipeline.iter_pcap(pcap))))
+    print("* %d handshakes written to %s, %d packets, %d filtered" % (writer.written, output, pipeline.packets,
+                                                                     pipeline.filtered))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("USAGE: <pcap> <output.ndjson|output.csv> [workers]")
+        exit(1)
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
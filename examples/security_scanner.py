@@ -11,7 +11,6 @@ An example implementation of a passive TLS security scanner with custom starttls
 """
 from __future__ import print_function
 import sys
-import concurrent.futures
 
 try:
     from scapy.all import get_if_list, sniff, IP, TCP
@@ -22,12 +21,20 @@ try:
     # This import works from the project directory
     from scapy_ssl_tls.ssl_tls import *
     import scapy_ssl_tls.ssl_tls_keystore as tlsk
+    import scapy_ssl_tls.ssl_tls_scan as ssl_tls_scan
+    import scapy_ssl_tls.ssl_tls_session as tlssess
+    import scapy_ssl_tls.ssl_tls_stream as ssl_tls_stream
 except ImportError as ie:
     # If you installed this package via pip, you just need to execute this
     from scapy.layers.ssl_tls import *
     import scapy.layers.ssl_tls_keystore as tlsk
+    import scapy.layers.ssl_tls_scan as ssl_tls_scan
+    import scapy.layers.ssl_tls_session as tlssess
+    import scapy.layers.ssl_tls_stream as ssl_tls_stream
 
+import functools
 import socket
+import threading
 from collections import namedtuple
 import time
 
@@ -56,19 +63,9 @@ class TCPConnection(object):
             self._s.settimeout(timeout)
         self._s.sendall(str(pkt))
 
-    def recvall(self, size=8192 * 4, timeout=None):
-        resp = []
-        if timeout:
-            self._s.settimeout(timeout)
-        while True:
-            try:
-                data = self._s.recv(size)
-                if not data:
-                    break
-                resp.append(data)
-            except socket.timeout:
-                break
-        return SSL(''.join(resp))
+    def recvall(self, size=8192 * 4, timeout=None, until=None):
+        # Returns early once until(records) holds, see ssl_tls_stream.recv_records()
+        return SSL(ssl_tls_stream.recv_records(self._s, until, size, timeout or self._s.gettimeout()))
 
 
 class TLSInfo(object):
@@ -145,6 +142,10 @@ class TLSInfo(object):
         self.info.server.heartbeat = None
         self.info.server.certificates = set([])
         self.info.server.extensions = set([])
+        # {version: [cipher, ...]} when the server enforces its preference
+        self.info.server.preferred_ciphers = {}
+        # The group the server selected for its TLS 1.3 key share
+        self.info.server.key_share_group = None
 
     def __str__(self):
         return """<TLSInfo
@@ -163,6 +164,7 @@ class TLSInfo(object):
         server.sessions_established: %s
         server.fallback_scsv: %s
         server.heartbeat: %s
+        server.key_share_group: %s
 
         server.certificates: %s
 >
@@ -179,6 +181,7 @@ class TLSInfo(object):
                self.info.server.sessions_established,
                self.info.server.fallback_scsv,
                self.info.server.heartbeat,
+               TLS_SUPPORTED_GROUPS.get(self.info.server.key_share_group, self.info.server.key_share_group),
                repr(self.info.server.certificates))
 
     def get_events(self):
@@ -246,8 +249,8 @@ class TLSInfo(object):
             try:
                 for certlist in tlsinfo.certificates:
                     for cert in certlist.certificates:
-                        keystore = tlsk.RSAKeystore.from_der_certificate(str(cert.data))
-                        pubkey = keystore.public
+                        cert_info = tlsk.certificate_cache.get_info(cert.data)
+                        pubkey = cert_info.public
                         pubkey_size = pubkey.size_in_bits()
                         if pubkey_size < 2048:
                             events.append(
@@ -341,16 +344,113 @@ class TLSInfo(object):
             self.history.append(pkt)
 
 
-class TLSScanner(object):
+class ProbeFindings(object):
+    """ What a _scan_ probe learnt about its target: server responses, events and the key share group selected.
+    Probes run on worker threads, TLSScanner.apply_findings() merges findings into the TLSInfo of the target
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.events = []
+        self.key_share_group = None
+
 
-    def __init__(self, workers=10):
+class TLSScanner(object):
+    # Probes are patched copies of pre serialized ClientHellos
+    CLIENT_HELLO = ssl_tls_scan.ClientHelloTemplate()
+    HEARTBEAT_CLIENT_HELLO = ssl_tls_scan.ClientHelloTemplate(
+        TLSRecord() / TLSHandshakes(handshakes=[TLSHandshake() / TLSClientHello(
+            cipher_suites=list(range(0xfe))[::-1],
+            extensions=[TLSExtension() / TLSExtHeartbeat(mode=TLSHeartbeatMode.PEER_ALLOWED_TO_SEND)])]))
+
+    def __init__(self, workers=10, per_host=None, host_rate=None, max_connections=1024, probe_timeout=2.0,
+                 exhaustive=False, key_shares=None):
         self.workers = workers
+        self.per_host = per_host or workers
+        self.host_rate = host_rate
+        self.max_connections = max_connections
+        self.probe_timeout = probe_timeout
+        # Probe each cipher on its own rather than by elimination
+        self.exhaustive = exhaustive
+        # TLS 1.3 probes send a key share of the group each server selected last only
+        self.key_shares = key_shares if key_shares is not None else tlssess.KeyShareCache()
+        # Shared by the TLS 1.3 probes of all targets
+        self._key_shares_lock = threading.Lock()
         self.capabilities = TLSInfo()
+        self.results = {}
+        self.scheduler = None
+        self.reactor = None
+
+    def capabilities_of(self, target):
+        capabilities = self.results.get(target)
+        if capabilities is None:
+            capabilities = self.results[target] = TLSInfo()
+        return capabilities
+
+    def apply_findings(self, target, findings):
+        """ Callback of the _scan_ jobs, invoked in the thread iterating the ScanScheduler
+        """
+        if findings is None:
+            return
+        capabilities = self.capabilities_of(target)
+        for resp in findings.responses:
+            capabilities.insert(resp, client=False)
+        capabilities.events.extend(findings.events)
+        if findings.key_share_group is not None:
+            capabilities.info.server.key_share_group = findings.key_share_group
 
     def scan(self, target, starttls=None):
-        for scan_method in (f for f in dir(self) if f.startswith("_scan_")):
-            print ("=> %s" % (scan_method.replace("_scan_", "")))
-            getattr(self, scan_method)(target, starttls=starttls)
+        self.capabilities = self.scan_targets([target], starttls=starttls)[target]
+
+    def scan_targets(self, targets, starttls=None):
+        """ Scans all targets at once, within the global and per host limits. Returns {target: TLSInfo}
+
+        Multi step scans run as jobs on worker threads, their findings are applied from this thread. Single shot
+        probes, e.g. the cipher enumerations, are queued meanwhile and then all run at once from this thread, see
+        ProbeReactor.
+        """
+        self.scheduler = ssl_tls_scan.ScanScheduler(workers=self.workers, per_host=self.per_host,
+                                                    host_rate=self.host_rate)
+        self.reactor = ssl_tls_scan.ProbeReactor(max_connections=self.max_connections, per_host=self.per_host,
+                                                 timeout=self.probe_timeout)
+        for target in targets:
+            self.capabilities_of(target)
+            for scan_method in (f for f in dir(self) if f.startswith("_scan_")):
+                self.scheduler.submit(target, getattr(self, scan_method), (target, starttls),
+                                      callback=functools.partial(self.apply_findings, target))
+        for job in self.scheduler.run():
+            if job.error is not None:
+                print ("- %s:%d %s failed: %r" % (job.target + (job.probe.__name__, job.error)))
+            else:
+                print ("=> %s:%d %s" % (job.target + (job.probe.__name__.replace("_scan_", ""),)))
+        print ("=> running %d probes" % len(self.reactor))
+        for conn in self.reactor.run():
+            if conn.error is not None:
+                print ("- %s:%d probe failed: %r" % (conn.target + (conn.error,)))
+        return dict((target, self.results[target]) for target in targets)
+
+    def _submit_probe(self, target, pkt, starttls=None):
+        capabilities = self.capabilities_of(target)
+
+        def insert(conn):
+            if conn.records:
+                capabilities.insert(SSL(conn.response), client=False)
+        self.reactor.submit(target, pkt, preamble=ssl_tls_scan.starttls_preamble(starttls) if starttls else None,
+                            callback=insert)
+
+    def _enumerate_ciphersuites(self, target, version, cipherlist, starttls=None):
+        capabilities = self.capabilities_of(target)
+
+        def preferred(enumeration):
+            if enumeration.error is not None:
+                print ("- %s:%d cipher enumeration failed: %r" % (target + (enumeration.error,)))
+            if enumeration.server_preference:
+                capabilities.info.server.preferred_ciphers[version] = enumeration.accepted
+        ssl_tls_scan.CipherSuiteEnumeration(
+            target, version, [cipher for cipher in cipherlist if cipher not in ssl_tls_scan.SCSV_CIPHER_SUITES],
+            preamble_factory=(lambda: ssl_tls_scan.starttls_preamble(starttls)) if starttls else None,
+            on_response=lambda resp: capabilities.insert(resp, client=False),
+            on_done=preferred).start(self.reactor)
 
     def sniff(self, target=None, iface=None):
         def _process(pkt):
@@ -396,6 +496,7 @@ class TLSScanner(object):
             crypto_container.padding = "\xff%s" % padding[1:]
             return crypto_container
 
+        findings = ProbeFindings()
         try:
             t = TCPConnection(target, starttls=starttls)
             ts = TLSSocket(t._s, client=True)
@@ -407,100 +508,68 @@ class TLSScanner(object):
                         target[0]),)
             r = ts.recvall()
             if len(r.records) == 0:
-                self.capabilities.events.append(
+                findings.events.append(
                     ("Poodle2 - not vulnerable, but implementation does not send a BAD_RECORD_MAC alert", r))
             elif r.haslayer(TLSAlert) and r[TLSAlert].description == TLSAlertDescription.BAD_RECORD_MAC:
                 # not vulnerable
                 pass
             else:
-                self.capabilities.events.append(("Poodle2 - vulnerable", r))
+                findings.events.append(("Poodle2 - vulnerable", r))
 
         except (socket.error, NotImplementedError) as se:
             print (repr(se))
-            return None
+        return findings
 
     def _scan_compressions(self, target, starttls=None, compression_list=TLS_COMPRESSION_METHODS.keys()):
+        findings = ProbeFindings()
         for comp in compression_list:
-            # prepare pkt
-            pkt = TLSRecord() / \
-                  TLSHandshakes(handshakes=[TLSHandshake() /
-                                            TLSClientHello(version=TLSVersion.TLS_1_1,
-                                                           cipher_suites=list(range(0xfe))[::-1],
-                                                           compression_methods=comp)])
+            pkt = self.CLIENT_HELLO.build(version=TLSVersion.TLS_1_1, cipher_suites=list(range(0xfe))[::-1],
+                                          compression_methods=[comp])
             # connect
             try:
                 t = TCPConnection(target, starttls=starttls)
                 t.sendall(pkt)
-                resp = t.recvall(timeout=0.5)
-                self.capabilities.insert(resp, client=False)
+                resp = t.recvall(timeout=0.5, until=ssl_tls_scan.flight_complete)
+                findings.responses.append(resp)
             except socket.error as se:
                 print (repr(se))
-
-    def _check_cipher(self, target, cipher_id, starttls=None, version=TLSVersion.TLS_1_0):
-        pkt = TLSRecord(version=version) / \
-              TLSHandshakes(handshakes=[TLSHandshake() /
-                                        TLSClientHello(version=version,
-                                                       cipher_suites=[cipher_id])])
-        try:
-            t = TCPConnection(target, starttls=starttls)
-            t.sendall(pkt)
-            resp = t.recvall(timeout=0.5)
-        except socket.error as se:
-            print (repr(se))
-            return None
-        return resp
+        return findings
 
     def _scan_accepted_ciphersuites(
             self,
             target,
             starttls=None,
-            cipherlist=TLS_CIPHER_SUITES.keys(),
-            version=TLSVersion.TLS_1_0):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
-            tasks = [
-                executor.submit(
-                    self._check_cipher,
-                    target,
-                    cipher_id,
-                    starttls,
-                    version) for cipher_id in cipherlist]
-            for future in concurrent.futures.as_completed(tasks):
-                self.capabilities.insert(future.result(), client=False)
+            cipherlist=[c for c in TLS_CIPHER_SUITES.keys() if c >> 8 != 0x13],
+            versions=(TLSVersion.SSL_3_0, TLSVersion.TLS_1_0, TLSVersion.TLS_1_1, TLSVersion.TLS_1_2)):
+        if not self.exhaustive:
+            for version in versions:
+                self._enumerate_ciphersuites(target, version, cipherlist, starttls)
+            return
+        version = TLSVersion.TLS_1_0
+        for cipher_id in cipherlist:
+            pkt = self.CLIENT_HELLO.build(version=version, record_version=version, cipher_suites=[cipher_id])
+            self._submit_probe(target, pkt, starttls)
 
     def _scan_supported_protocol_versions(
         self,
         target,
         starttls=None,
-        versionlist=(
+        versionlist=tuple(
             (k,
              v) for k,
             v in TLS_VERSIONS.iteritems() if v.startswith("TLS_") or v.startswith("SSL_"))):
+        findings = ProbeFindings()
         for magic, name in versionlist:
-            pkt = TLSRecord(version=magic) / \
-                  TLSHandshakes(handshakes=[TLSHandshake() /
-                                            TLSClientHello(version=magic,
-                                                           cipher_suites=list(range(0xfe))[::-1],
-                                                           extensions=[TLSExtension() /
-                                                                       TLSExtHeartbeat(mode=TLSHeartbeatMode.PEER_ALLOWED_TO_SEND)])])
+            pkt = self.HEARTBEAT_CLIENT_HELLO.build(version=magic, record_version=magic)
             try:
                 # connect
                 t = TCPConnection(target, starttls=starttls)
                 t.sendall(pkt)
-                resp = t.recvall(timeout=0.5)
-                self.capabilities.insert(resp, client=False)
+                resp = t.recvall(timeout=0.5, until=ssl_tls_scan.flight_complete)
+                findings.responses.append(resp)
             except socket.error as se:
                 print (repr(se))
-
-    def _check_cipher_sslv2(self, target, cipher_id, starttls=None, version=TLSVersion.SSL_2_0):
-        pkt = SSLv2Record() / SSLv2ClientHello(cipher_suites=[cipher_id], challenge='A' * 16, session_id='')
-        try:
-            t = TCPConnection(target, starttls=starttls)
-            t.sendall(pkt)
-            resp = t.recvall(timeout=0.5)
-        except socket.error as se:
-            print (repr(se))
-            return None
-        return resp
+        return findings
 
     def _scan_accepted_ciphersuites_ssl2(
             self,
@@ -508,53 +577,77 @@ class TLSScanner(object):
             starttls=None,
             cipherlist=SSLv2_CIPHER_SUITES.keys(),
             version=TLSVersion.SSL_2_0):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
-            tasks = [
-                executor.submit(
-                    self._check_cipher_sslv2,
-                    target,
-                    cipher_id,
-                    starttls,
-                    version) for cipher_id in cipherlist]
-            for future in concurrent.futures.as_completed(tasks):
-                self.capabilities.insert(future.result(), client=False)
+        if not self.exhaustive:
+            # The SSLv2 ServerHello lists all offered ciphers the server supports
+            pkt = SSLv2Record() / SSLv2ClientHello(cipher_suites=cipherlist, challenge='A' * 16, session_id='')
+            self._submit_probe(target, pkt, starttls)
+            return
+        for cipher_id in cipherlist:
+            pkt = SSLv2Record() / SSLv2ClientHello(cipher_suites=[cipher_id], challenge='A' * 16, session_id='')
+            self._submit_probe(target, pkt, starttls)
 
     def _scan_scsv(self, target, starttls=None):
-        pkt = TLSRecord(version=TLSVersion.TLS_1_1) / \
-              TLSHandshakes(handshakes=[TLSHandshake() /
-                                        TLSClientHello(version=TLSVersion.TLS_1_0,
-                                                       cipher_suites=[TLSCipherSuite.FALLBACK_SCSV] + list(range(0xfe))[::-1])])
+        pkt = self.CLIENT_HELLO.build(version=TLSVersion.TLS_1_0, record_version=TLSVersion.TLS_1_1,
+                                      cipher_suites=[TLSCipherSuite.FALLBACK_SCSV] + list(range(0xfe))[::-1])
+        findings = ProbeFindings()
         # connect
         try:
             t = TCPConnection(target, starttls=starttls)
             t.sendall(pkt)
-            resp = t.recvall(timeout=2)
-            self.capabilities.insert(resp, client=False)
+            resp = t.recvall(timeout=2, until=ssl_tls_scan.flight_complete)
+            findings.responses.append(resp)
             if not (resp.haslayer(TLSAlert) and resp[TLSAlert].description ==
                     TLSAlertDescription.INAPPROPRIATE_FALLBACK):
-                self.capabilities.events.append(("DOWNGRADE / POODLE - FALLBACK_SCSV - not honored", resp))
+                findings.events.append(("DOWNGRADE / POODLE - FALLBACK_SCSV - not honored", resp))
         except socket.error as se:
             print (repr(se))
+        return findings
+
+    def _scan_tls13_key_share(self, target, starttls=None, version=tls_draft_version(18),
+                              cipherlist=[c for c in TLS_CIPHER_SUITES.keys() if c >> 8 == 0x13]):
+        host, port = target[:2]
+        findings = ProbeFindings()
+        with self._key_shares_lock:
+            groups = self.key_shares.predict(host, port, (TLSSupportedGroup.SECP256R1,))
+        # A HelloRetryRequest costs one more connection, with a key share of the group it selected
+        for _ in range(2):
+            try:
+                t = TCPConnection(target, starttls=starttls)
+                t.sendall(ssl_tls_scan.tls13_hello(version, cipherlist, groups))
+                resp = t.recvall(timeout=0.5, until=ssl_tls_scan.flight_complete)
+            except socket.error as se:
+                print (repr(se))
+                return findings
+            findings.responses.append(resp)
+            with self._key_shares_lock:
+                group = self.key_shares.update(host, port, resp)
+            if group is None or group in groups or not resp.haslayer(TLSHelloRetryRequest):
+                break
+            groups = (group,)
+        if group is not None and not resp.haslayer(TLSHelloRetryRequest):
+            findings.key_share_group = group
+        return findings
 
     def _scan_heartbleed(self, target, starttls=None, version=TLSVersion.TLS_1_0, payload_length=20):
+        findings = ProbeFindings()
         try:
             t = TCPConnection(target, starttls=starttls)
             pkt = TLSRecord(version=version) / TLSHandshakes(handshakes=[TLSHandshake() /
                                                                          TLSClientHello(version=version)])
             t.sendall(pkt)
-            resp = t.recvall(timeout=0.5)
+            resp = t.recvall(timeout=0.5, until=ssl_tls_scan.flight_complete)
             pkt = TLSRecord(version=version) / TLSHeartBeat(length=2**14 - 1, data='bleed...')
             t.sendall(str(pkt))
-            resp = t.recvall(timeout=0.5)
+            resp = t.recvall(timeout=0.5, until=ssl_tls_stream.received_records(1))
             if resp.haslayer(TLSHeartBeat) and resp[TLSHeartBeat].length > 8:
-                self.capabilities.events.append(("HEARTBLEED - vulnerable", resp))
+                findings.events.append(("HEARTBLEED - vulnerable", resp))
         except socket.error as se:
             print (repr(se))
-            return None
-        return resp
+        return findings
 
     def _scan_secure_renegotiation(self, target, starttls=None, version=TLSVersion.TLS_1_0, payload_length=20):
         # todo: also test EMPTY_RENEGOTIATION_INFO_SCSV
+        findings = ProbeFindings()
         try:
             t = TCPConnection(target, starttls=starttls)
             pkt = TLSRecord(version=version) / \
@@ -563,20 +656,52 @@ class TLSScanner(object):
                                                            extensions=TLSExtension() /
                                                                       TLSExtRenegotiationInfo())])
             t.sendall(pkt)
-            resp = t.recvall(timeout=0.5)
+            resp = t.recvall(timeout=0.5, until=ssl_tls_scan.flight_complete)
             if resp.haslayer(TLSExtRenegotiationInfo):
-                self.capabilities.events.append(("TLS EXTENSION SECURE RENEGOTIATION - not supported", resp))
+                findings.events.append(("TLS EXTENSION SECURE RENEGOTIATION - not supported", resp))
         except socket.error as se:
             print (repr(se))
-            return None
-        return resp
+        return findings
+
+
+def print_capabilities(capabilities):
+    print ("[*] Capabilities (Debug)")
+    print (capabilities)
+    print ("[*] supported ciphers: %s/%s" % (
+        len(capabilities.info.server.ciphers), len(TLS_CIPHER_SUITES) + len(SSLv2_CIPHER_SUITES)))
+    print (" * " + "\n * ".join(
+        ("%s (0x%0.4x)" % (TLS_CIPHER_SUITES.get(c, "SSLv2_%s" % SSLv2_CIPHER_SUITES.get(c, c)), c) for c in
+         capabilities.info.server.ciphers)))
+    print ("")
+    print ("[*] server cipher preference order:")
+    for version, ciphers in sorted(capabilities.info.server.preferred_ciphers.items()):
+        print (" * %s: %s" % (TLS_VERSIONS.get(version, version),
+                              ", ".join(TLS_CIPHER_SUITES.get(c, "0x%0.4x" % c) for c in ciphers)))
+    print ("")
+    print (
+        "[*] supported protocol versions: %s/%s" %
+        (len(
+            capabilities.info.server.versions),
+            len(TLS_VERSIONS)))
+    print (" * " + "\n * ".join(
+        ("%s (0x%0.4x)" % (TLS_VERSIONS.get(c, c), c) for c in capabilities.info.server.versions)))
+    print ("")
+    print ("[*] supported compressions methods: %s/%s" % (
+        len(capabilities.info.server.compressions), len(TLS_COMPRESSION_METHODS)))
+    print (" * " + "\n * ".join(("%s (0x%0.4x)" % (TLS_COMPRESSION_METHODS.get(c, c), c) for c in
+                                 capabilities.info.server.compressions)))
+    print ("")
+    events = capabilities.get_events()
+    print ("[*] Events: %s" % len(events))
+    print ("* EVENT - " + "\n* EVENT - ".join(e[0] for e in events))
 
 
 def main():
     print (__doc__)
     if len(sys.argv) <= 3:
-        print ("USAGE: <mode> <host> <port> [starttls] [num_worker] [interface]")
+        print ("USAGE: <mode> <host[,host,...]> <port> [starttls] [num_worker] [interface]")
         print ("       mode     ... client | sniff")
+        print ("       host     ... client mode scans all comma separated hosts at once")
         print ("       starttls ... starttls keyword e.g. 'starttls\\n' or 'ssl\\n'")
         print ("available interfaces")
         for i in get_if_list():
@@ -584,44 +709,25 @@ def main():
         exit(1)
     mode = sys.argv[1]
     starttls = sys.argv[4] if len(sys.argv) > 4 else None
-    host = sys.argv[2]
+    hosts = sys.argv[2].split(",")
     port = int(sys.argv[3])
     num_workers = 10 if not len(sys.argv) > 5 else int(sys.argv[5])
     iface = "eth0" if not len(sys.argv) > 6 else sys.argv[6]
 
-    scanner = TLSScanner(workers=num_workers)
     if mode == "sniff":
-        print ("[*] [passive] Scanning in 'sniff' mode for %s on %s..." % (repr((host, port)), iface))
-        scanner.sniff((host, port), iface=iface)
+        scanner = TLSScanner(workers=num_workers)
+        print ("[*] [passive] Scanning in 'sniff' mode for %s on %s..." % (repr((hosts[0], port)), iface))
+        scanner.sniff((hosts[0], port), iface=iface)
     else:
-        print ("[*] [active] Scanning with %s parallel threads..." % num_workers)
+        # Each host gets a fair share of the workers
+        scanner = TLSScanner(workers=num_workers * len(hosts), per_host=num_workers)
+        print ("[*] [active] Scanning %d host(s) with %s parallel threads per host..." % (len(hosts), num_workers))
         t_start = time.time()
-        scanner.scan((host, port), starttls=starttls)
-        print ("\n")
-        print ("[*] Capabilities (Debug)")
-        print (scanner.capabilities)
-        print ("[*] supported ciphers: %s/%s" % (
-            len(scanner.capabilities.info.server.ciphers), len(TLS_CIPHER_SUITES) + len(SSLv2_CIPHER_SUITES)))
-        print (" * " + "\n * ".join(
-            ("%s (0x%0.4x)" % (TLS_CIPHER_SUITES.get(c, "SSLv2_%s" % SSLv2_CIPHER_SUITES.get(c, c)), c) for c in
-             scanner.capabilities.info.server.ciphers)))
-        print ("")
-        print (
-            "[*] supported protocol versions: %s/%s" %
-            (len(
-                scanner.capabilities.info.server.versions),
-                len(TLS_VERSIONS)))
-        print (" * " + "\n * ".join(
-            ("%s (0x%0.4x)" % (TLS_VERSIONS.get(c, c), c) for c in scanner.capabilities.info.server.versions)))
-        print ("")
-        print ("[*] supported compressions methods: %s/%s" % (
-            len(scanner.capabilities.info.server.compressions), len(TLS_COMPRESSION_METHODS)))
-        print (" * " + "\n * ".join(("%s (0x%0.4x)" % (TLS_COMPRESSION_METHODS.get(c, c), c) for c in
-                                     scanner.capabilities.info.server.compressions)))
-        print ("")
-        events = scanner.capabilities.get_events()
-        print ("[*] Events: %s" % len(events))
-        print ("* EVENT - " + "\n* EVENT - ".join(e[0] for e in events))
+        results = scanner.scan_targets([(host, port) for host in hosts], starttls=starttls)
+        for target, capabilities in sorted(results.items()):
+            print ("\n")
+            print ("[*] Target: %s:%d" % target)
+            print_capabilities(capabilities)
         t_diff = time.time() - t_start
         print ("")
         print ("Scan took: %ss" % t_diff)
@@ -25,121 +25,18 @@ try:
     # If you installed this package via pip, you just need to execute this
     from scapy.layers.ssl_tls import *
     import scapy.layers.ssl_tls_crypto as ssl_tls_crypto
+    import scapy.layers.ssl_tls_stream as ssl_tls_stream
+    import scapy.layers.ssl_tls_pipeline as ssl_tls_pipeline
 except ImportError:
     # This import works from the project directory
     from scapy_ssl_tls.ssl_tls import *
     import scapy_ssl_tls.ssl_tls_crypto as ssl_tls_crypto
+    import scapy_ssl_tls.ssl_tls_stream as ssl_tls_stream
+    import scapy_ssl_tls.ssl_tls_pipeline as ssl_tls_pipeline
 
 import socket
 
 
-class L4TcpReassembler(object):
-
-    """ WARNING - this is not a valid TCP Stream Reassembler.
-                  It is not L5+ aware and only operates at L4
-                  Only works for the assumption that a consecutive stream will be split in segments of the max segment size (mss). It will concat segments == mss until a segment < mss is found. it will then spit out a reassembled (fake) TCP packet with the full payload.
-    """
-    class TCPFlags:
-        FIN = 0x01
-        SYN = 0x02
-        RST = 0x04
-        PSH = 0x08
-        ACK = 0x10
-        URG = 0x20
-        ECE = 0x40
-        CWR = 0x80
-
-    class TCPStream(object):
-
-        def __init__(self, pkt):
-            self.pktlist = []
-            self.stream_id = L4TcpReassembler.TCPStream.stream_id(pkt)
-
-            if not pkt[TCP].flags & L4TcpReassembler.TCPFlags.SYN:
-                raise Exception("NOT THE BEGINNING OF A STREAM: %s" % repr(self.stream_id))
-
-            self.syn = pkt[TCP]
-            self.syn.payload = NoPayload()   # strip payload
-            self.initial_seq = pkt[TCP].seq
-
-            self.last_seq = self.initial_seq
-            self.relative_seq = 0
-
-            self.mss = (option[1] for option in pkt[TCP].options if option[0] == "MSS").next()
-
-        @staticmethod
-        def stream_id(pkt):
-            return pkt[IP].src, pkt[TCP].sport, pkt[IP].dst, pkt[TCP].dport
-
-        def process(self, pkt):
-            self.last_seq = pkt[TCP].seq
-            payload_size = len(pkt[TCP].payload)   
-            if payload_size < self.mss:
-                # flush pktlist as [pkt stack, current_pkt]
-                if len(self.pktlist) > 1:
-                    # create fake packet
-                    p_reassembled = pkt
-                    del p_reassembled[IP].len
-                    del p_reassembled[IP].chksum
-                    del p_reassembled[TCP].chksum
-                    #p_reassembled.name = "TCPReassembled"
-                    p_reassembled[TCP].payload = Raw(load=''.join(str(p[TCP].payload) 
-                                                                  for p in self.pktlist) + str(p_reassembled[TCP].payload))
-                    p_reassembled[TCP] = TCP(str(p_reassembled[TCP]))       # force re-dissect
-
-                    self.pktlist = []
-                    return p_reassembled
-                # otherwise just return current pkt
-                return pkt
-            # segment size > track it
-            self.pktlist.append(pkt)
-            return None
-
-        def __repr__(self, *args, **kwargs):
-            return "<<TCPSTream: %s | mss=%s seq_init=%s seq_last=%s seq_diff=%s pktlist=%s>>" % (repr(
-                self.stream_id),
-                self.mss,
-                self.initial_seq,
-                self.last_seq,
-                self.last_seq - self.initial_seq,
-                self.pktlist)
-
-    def __init__(self):
-        # track streams
-        self.streams = {}
-
-    def get_stream(self, pkt):
-        stream_id = L4TcpReassembler.TCPStream.stream_id(pkt)
-        stream_obj = self.streams.get(stream_id)                # get stream tracker
-        if not stream_obj:
-            try:
-                stream_obj = L4TcpReassembler.TCPStream(pkt)
-                self.streams[stream_id] = stream_obj
-            except:
-                pass  # not a valid stream, or in the middle of a stream
-        return stream_obj
-
-    def reassemble(self, pktlist):
-        """Defragment and Reassemble Streams
-        """
-        # defragment L3
-        for pkt in defragment(pktlist):
-            if not pkt.haslayer(TCP):
-                # Not TCP, return
-                yield pkt
-                continue
-            # get Stream object
-            stream = self.get_stream(pkt)
-            if not stream:
-                continue
-            p = stream.process(pkt)
-            if not p:
-                # assume stream not complete
-                continue
-            # assume stream complete
-            yield p
-
-
 class Sniffer(object):
 
     """ Sniffer()
@@ -149,65 +46,59 @@ class Sniffer(object):
     """
 
     def __init__(self):
-        self.ssl_session_map = {}
+        self.flows = ssl_tls_stream.FlowTable(ctx_factory=self._create_context)
+        self.target = None
+        self.keyfile = None
         self.exit_after_num_valid_packets = None
         self.valid_pkts = 0
 
-    def _create_context(self, target, keyfile=None):
+    def _setup(self, target, keyfile=None):
         self.target = target
         self.keyfile = keyfile
-
-        session = ssl_tls_crypto.TLSSessionCtx()
         if keyfile:
             print ("* load servers privatekey for ciphertext decryption (RSA key only): %s" % keyfile)
-            session.server_ctx.load_rsa_keys_from_file(keyfile)
-
-            session.printed = False
-            self.ssl_session_map[target] = session
         else:
             print ("!! missing private key")
 
-    def process_ssl(self, p):
-        if not p.haslayer(SSL):
-            return
-        session = self.ssl_session_map.get(
-            (p[IP].dst, p[TCP].dport)) or self.ssl_session_map.get(
-            (p[IP].src, p[TCP].sport))
+    def _create_context(self, flow):
+        # Only flows to the target can be decrypted with its private key
+        if not self.keyfile or self.target not in flow.key:
+            return None
+        session = ssl_tls_crypto.TLSSessionCtx(history_policy=ssl_tls_crypto.TLSSessionCtx.HISTORY_NONE)
+        session.server_ctx.load_rsa_keys_from_file(self.keyfile)
+        flow.info["printed"] = False
+        return session
+
+    def process_ssl(self, flow, source, p_ssl):
+        destination = flow.server if flow.is_client(source) else flow.client
+        session = flow.ctx
         if not session:
-            print (
-                "|   %-16s:%-5d => %-16s:%-5d | %s" % (p[IP].src, p[TCP].sport, p[IP].dst, p[TCP].dport, repr(p[SSL])))
+            print ("|   %-16s:%-5d => %-16s:%-5d | %s" % (source + destination + (repr(p_ssl),)))
             return
-        p_ssl = p[SSL]
-        source = (p[IP].src, p[TCP].sport)
 
         if p_ssl.haslayer(SSLv2Record):
-            print ("SSLv2 not supported - skipping..", repr(p))
+            print ("SSLv2 not supported - skipping..", repr(p_ssl))
             return
 
-
         if p_ssl.haslayer(TLSServerHello):
-            session.printed = False
-            session.master_secret = None
-            session.match_server = source
             # reset the session and print it next time
+            flow.info["printed"] = False
+            session.master_secret = None
         if p_ssl.haslayer(TLSClientHello):
-            session.match_client = source
+            flow.set_client(source)
 
         session.insert(p_ssl)
 
-        if session.master_secret and session.printed == False:
+        if session.master_secret and not flow.info["printed"]:
             print (session)
-            session.printed = True
+            flow.info["printed"] = True
 
-        print (
-            "|   %-16s:%-5d => %-16s:%-5d | %s" % (p[IP].src, p[TCP].sport, p[IP].dst, p[TCP].dport, repr(p_ssl)))
-        if p.haslayer(TLSCiphertext) or (p.haslayer(TLSAlert) and p.haslayer(Raw)):
-            if source == session.match_client:
+        print ("|   %-16s:%-5d => %-16s:%-5d | %s" % (source + destination + (repr(p_ssl),)))
+        if p_ssl.haslayer(TLSCiphertext) or (p_ssl.haslayer(TLSAlert) and p_ssl.haslayer(Raw)):
+            if flow.is_client(source):
                 session.set_mode(server=True)
-            elif source == session.match_server:
-                session.set_mode(client=True)
             else:
-                Exception("src packet mismatch: %s" % repr(source))
+                session.set_mode(client=True)
             try:
                 p = SSL(str(p_ssl), ctx=session)
                 print ("|-> %-48s | %s" % ("decrypted record", repr(p)))
@@ -216,24 +107,30 @@ class Sniffer(object):
 
         self.valid_pkts += 1
         if self.exit_after_num_valid_packets and self.valid_pkts > self.exit_after_num_valid_packets:
-            sys.exit(0)        
+            sys.exit(0)
 
-    def sniff(self, target, keyfile=None, iface=None):
-        self._tcp_reassembler = L4TcpReassembler()
+    def _process_records(self, records):
+        for flow, source, record in records:
+            self.process_ssl(flow, source, SSL(record))
 
+    def sniff(self, target, keyfile=None, iface=None):
         def reassemble(p):
-            for rp in (pkt for pkt in self._tcp_reassembler.reassemble([p]) if pkt.haslayer(SSL)):
-                self.process_ssl(rp)
+            self._process_records(self.flows.reassemble([p]))
         if iface:
             conf.iface = iface
-        self._create_context(target=target, keyfile=keyfile)
+        self._setup(target=target, keyfile=keyfile)
         while True:
             sniff(filter="host %s and tcp port %d" % (target[0], target[1]), prn=reassemble, store=0, timeout=3)
 
     def rdpcap(self, target, keyfile, pcap):
-        self._create_context(target=target, keyfile=keyfile)
-        for p in (pkt for pkt in L4TcpReassembler().reassemble(rdpcap(pcap)) if pkt.haslayer(SSL)):
-            self.process_ssl(p)
+        self._setup(target=target, keyfile=keyfile)
+        # Packets are read, processed and dropped one at a time
+        meter = ssl_tls_pipeline.ProgressMeter(lambda m: print ("* %s" % m, file=sys.stderr),
+                                               total=os.path.getsize(pcap), interval=5)
+        # Only packets that may carry TLS, on any port, get dissected
+        prefilter = ssl_tls_pipeline.TLSPreFilter()
+        packets = ssl_tls_pipeline.decode_packets(prefilter(meter(ssl_tls_pipeline.iter_pcap(pcap))))
+        self._process_records(self.flows.reassemble(packets))
 
 
 def main(target, pcap=None, iface=None, keyfile=None, num_pkts=None):
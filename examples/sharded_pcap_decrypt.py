@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+Decrypts all TLS flows of a capture to a given server, spreading flows over all cores.
+
+    #> python sharded_pcap_decrypt.py 192.168.220.131 443 capture.pcap server.pem [workers]
+"""
+
+from __future__ import print_function
+import sys
+
+try:
+    from scapy.layers.ssl_tls import *
+    import scapy.layers.ssl_tls_crypto as ssl_tls_crypto
+    import scapy.layers.ssl_tls_pipeline as ssl_tls_pipeline
+except ImportError:
+    from scapy_ssl_tls.ssl_tls import *
+    import scapy_ssl_tls.ssl_tls_crypto as ssl_tls_crypto
+    import scapy_ssl_tls.ssl_tls_pipeline as ssl_tls_pipeline
+
+
+class FlowDecryptor(object):
+    """ Runs in the worker processes: one TLSSessionCtx per flow to the target
+    """
+
+    def __init__(self, target, keyfile):
+        self.target = target
+        self.keyfile = keyfile
+
+    def create_context(self, flow):
+        if self.target not in flow.key:
+            return None
+        session = ssl_tls_crypto.TLSSessionCtx(history_policy=ssl_tls_crypto.TLSSessionCtx.HISTORY_NONE)
+        session.server_ctx.load_rsa_keys_from_file(self.keyfile)
+        return session
+
+    def handle_record(self, flow, source, record):
+        destination = flow.server if flow.is_client(source) else flow.client
+        prefix = "%-16s:%-5d => %-16s:%-5d" % (source + destination)
+        session = flow.ctx
+        p_ssl = SSL(record)
+        if session is None or p_ssl.haslayer(SSLv2Record):
+            return ["%s | %s" % (prefix, repr(p_ssl))]
+        if p_ssl.haslayer(TLSClientHello):
+            flow.set_client(source)
+        session.insert(p_ssl)
+        if not (p_ssl.haslayer(TLSCiphertext) or (p_ssl.haslayer(TLSAlert) and p_ssl.haslayer(Raw))):
+            return ["%s | %s" % (prefix, repr(p_ssl))]
+        session.set_mode(server=flow.is_client(source))
+        try:
+            return ["%s | %s" % (prefix, repr(SSL(record, ctx=session)))]
+        except ValueError as ve:
+            return ["%s | Exception: %r" % (prefix, ve)]
+
+    def handle_evict(self, flow, reason):
+        return ["%s:%d <=> %s:%d | flow done (%s)" % (flow.client + flow.server + (reason,))]
+
+
+def main(target, pcap, keyfile, workers=None):
+    decryptor = FlowDecryptor(target, keyfile)
+    pipeline = ssl_tls_pipeline.ShardedPipeline(decryptor.handle_record, workers=workers,
+                                                on_evict=decryptor.handle_evict,
+                                                ctx_factory=decryptor.create_context)
+    for line in pipeline.run_pcap(pcap):
+        print(line)
+    print("* %d packets, %d skipped, %d filtered" % (pipeline.packets, pipeline.skipped, pipeline.filtered))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5:
+        print("USAGE: <host> <port> <pcap> <keyfile> [workers]")
+        exit(1)
+    main((sys.argv[1], int(sys.argv[2])), sys.argv[3], sys.argv[4],
+         int(sys.argv[5]) if len(sys.argv) > 5 else None)
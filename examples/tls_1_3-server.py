@@ -53,7 +53,7 @@ def main():
             err += 1
         else:
             try:
-                r = client_socket.recvall()
+                r = client_socket.recvall(until=tlss.received_handshake(TLSHandshakeType.CLIENT_HELLO))
                 r.show()
     
                 server_hello = TLSRecord() / \
@@ -2,6 +2,7 @@
 # -*- coding: UTF-8 -*-
 # Author : <github.com/tintinweb/scapy-ssl_tls>
 
+from scapy.asn1packet import ASN1_Packet
 from scapy.packet import bind_layers, Packet, Raw
 from scapy.fields import *
 from scapy.layers.inet import TCP, UDP
@@ -9,6 +10,7 @@ from scapy.layers import x509
 
 
 import ssl_tls_registry as registry
+import ssl_tls_stream as tlss
 
 
 class BLenField(LenField):
@@ -238,6 +240,104 @@ class TypedPacketListField(PacketListField):
         return self.cls(m, type_=self.type_)
 
 
+class LazyX509Cert(x509.X509_Cert):
+    """
+    X509_Cert which keeps the raw DER slice it was dissected from and only runs the ASN.1 dissector
+    once one of its fields is accessed. Until then, building the packet returns the DER slice as is.
+    Most passive analysis only needs the DER (or its public key, see ssl_tls_keystore.der_subject_public_key_info),
+    so this avoids decoding every certificate of every chain.
+    """
+    __slots__ = ["der"]
+    ASN1_codec = x509.X509_Cert.ASN1_codec
+    ASN1_root = x509.X509_Cert.ASN1_root
+
+    def __init__(self, _pkt=b"", post_transform=None, _internal=0, _underlayer=None, **fields):
+        # Explicitly set fields need the full packet, fall back to an eager dissection
+        self.der = str(_pkt) if _pkt and not fields else None
+        x509.X509_Cert.__init__(self, _pkt, post_transform, _internal, _underlayer, **fields)
+
+    def init_fields(self):
+        # Default values of X509_Cert are expensive to build. Delay them until the certificate is materialized
+        if self.der is None:
+            x509.X509_Cert.init_fields(self)
+
+    def dissect(self, s):
+        if self.der is None:
+            x509.X509_Cert.dissect(self, s)
+        else:
+            self.raw_packet_cache = self.der
+            self.explicit = 1
+
+    def materialize(self):
+        if self.der is not None:
+            der, self.der = self.der, None
+            self.raw_packet_cache = None
+            self.explicit = 0
+            x509.X509_Cert.init_fields(self)
+            x509.X509_Cert.dissect(self, der)
+        return self
+
+    @property
+    def materialized(self):
+        return self.der is None
+
+    def getfieldval(self, attr):
+        return x509.X509_Cert.getfieldval(self.materialize(), attr)
+
+    def getfield_and_val(self, attr):
+        return x509.X509_Cert.getfield_and_val(self.materialize(), attr)
+
+    def setfieldval(self, attr, val):
+        return x509.X509_Cert.setfieldval(self.materialize(), attr, val)
+
+    def delfieldval(self, attr):
+        return x509.X509_Cert.delfieldval(self.materialize(), attr)
+
+    def __iter__(self):
+        # A dissected certificate has no field values to expand, building a non explicit parent packet iterates it
+        if self.der is not None:
+            return iter([self])
+        return x509.X509_Cert.__iter__(self)
+
+    def __repr__(self):
+        return x509.X509_Cert.__repr__(self.materialize())
+
+    def _needs_fields(self, cls):
+        # TLS layers never live inside a certificate. Only look into the ASN.1 tree for ASN.1 layers
+        return not (isinstance(cls, type) and not issubclass(cls, ASN1_Packet))
+
+    def haslayer(self, cls):
+        if cls is x509.X509_Cert:
+            return True
+        if self._needs_fields(cls):
+            self.materialize()
+        return x509.X509_Cert.haslayer(self, cls)
+
+    def getlayer(self, cls, nb=1, _track=None, _subclass=False, **flt):
+        if cls is x509.X509_Cert:
+            cls = self.__class__
+        if flt or (cls is not self.__class__ and self._needs_fields(cls)):
+            self.materialize()
+        return x509.X509_Cert.getlayer(self, cls, nb, _track, _subclass, **flt)
+
+    def copy(self):
+        # Packet.copy() builds the default fields of an empty instance first, keep the copy lazy instead
+        if self.der is None:
+            return x509.X509_Cert.copy(self)
+        clone = self.__class__(self.der)
+        clone.underlayer = self.underlayer
+        clone.time = self.time
+        return clone
+
+    def __eq__(self, other):
+        if isinstance(other, LazyX509Cert) and self.der is not None and other.der is not None:
+            return self.der == other.der
+        return x509.X509_Cert.__eq__(self.materialize(), other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
 class EnumStruct(object):
 
     def __init__(self, entries):
@@ -409,6 +509,10 @@ TLS_PSK_KEY_EXCHANGE_MODE.update({0: "psk_ke",
                                   255: "reserved"})
 TLSPSKKeyExchangeMode = EnumStruct(TLS_PSK_KEY_EXCHANGE_MODE)
 
+TLS_KEY_UPDATE_REQUESTS = {0: "update_not_requested",
+                           1: "update_requested"}
+TLSKeyUpdateRequest = EnumStruct(TLS_KEY_UPDATE_REQUESTS)
+
 TLS_CERTIFICATE_STATUS_TYPES = registry.TLS_CERTIFICATE_STATUS_TYPES
 TLSCertificateStatusType = EnumStruct(TLS_CERTIFICATE_STATUS_TYPES)
 
@@ -691,6 +795,11 @@ class TLSExtPSKKeyExchangeModes(PacketNoPayload):
                                       length_from=lambda x: x.length)]
 
 
+class TLSExtTicketEarlyDataInfo(PacketNoPayload):
+    name = "TLS Extension Ticket Early Data Info"
+    fields_desc = [IntField("max_early_data_size", 0)]
+
+
 class TLSHelloRequest(Packet):
     name = "TLS Hello Request"
     fields_desc = []
@@ -756,6 +865,16 @@ class TLSSessionTicket(PacketNoPayload):
                    StrLenField("ticket", '', length_from=lambda x:x.ticket_length)]
 
 
+class TLS13SessionTicket(PacketNoPayload):
+    name = "TLS 1.3 Session Ticket"
+    fields_desc = [IntField("lifetime", 7200),
+                   XIntField("age_add", 0),
+                   XFieldLenField("ticket_length", None, length_of="ticket", fmt="!H"),
+                   StrLenField("ticket", '', length_from=lambda x:x.ticket_length),
+                   XFieldLenField("extensions_length", None, length_of="extensions", fmt="H"),
+                   TypedPacketListField("extensions", None, TLSExtension, length_from=lambda x:x.extensions_length, type_="TLS13SessionTicket")]
+
+
 class TLSHeartBeat(PacketNoPayload):
     name = "TLS HeartBeat"
     fields_desc = [ByteEnumField("type", TLSHeartbeatMessageType.HEARTBEAT_REQUEST, TLS_HEARTBEAT_MESSAGE_TYPE),
@@ -870,7 +989,7 @@ class TLSServerHelloDone(PacketNoPayload):
 class TLSCertificate(PacketNoPayload):
     name = "TLS Certificate"
     fields_desc = [XBLenField("length", None, length_of="data", fmt="!I", numbytes=3),
-                   PacketLenField("data", None, x509.X509_Cert, length_from=lambda x:x.length)]
+                   PacketLenField("data", None, LazyX509Cert, length_from=lambda x:x.length)]
 
 
 class TLS10Certificate(PacketNoPayload):
@@ -882,7 +1001,7 @@ class TLS10Certificate(PacketNoPayload):
 class TLSCertificateEntry(PacketNoPayload):
     name = "TLS Certificate Entry"
     fields_desc = [XBLenField("length", None, length_of="cert_data", fmt="!I", numbytes=3),
-                   PacketLenField("cert_data", None, x509.X509_Cert, length_from=lambda x: x.length),
+                   PacketLenField("cert_data", None, LazyX509Cert, length_from=lambda x: x.length),
                    XFieldLenField("extensions_length", None, length_of="extensions", fmt="H"),
                    PacketListField("extensions", None, TLSExtension, length_from=lambda x: x.extensions_length)]
 
@@ -1062,6 +1181,16 @@ class TLSHandshake(PacketLengthFieldPayload):
         self.tls_ctx = fields.pop("ctx", None)
         PacketLengthFieldPayload.__init__(self, *args, **fields)
 
+    def guess_payload_class(self, payload):
+        if self.type == TLSHandshakeType.NEWSESSIONTICKET:
+            # TLS 1.3 tickets carry an age_add and extensions, a TLS 1.2 ticket fills the message on its own
+            tls12_ticket_fits = len(payload) >= 6 and struct.unpack("!H", payload[4:6])[0] + 6 == len(payload)
+            if (self.tls_ctx is not None and self.tls_ctx.negotiated.version >= TLSVersion.TLS_1_3) or \
+                    not tls12_ticket_fits:
+                return TLS13SessionTicket
+            return TLSSessionTicket
+        return PacketLengthFieldPayload.guess_payload_class(self, payload)
+
 
 class PacketListFieldContext(PacketListField):
     def m2i(self, pkt, m):
@@ -1081,6 +1210,11 @@ class TLSFinished(PacketNoPayload):
     fields_desc = [StrLenField("data", "", length_from=lambda x:x.underlayer.length)]
 
 
+class TLSKeyUpdate(PacketNoPayload):
+    name = "TLS Key Update"
+    fields_desc = [ByteEnumField("request_update", TLSKeyUpdateRequest.UPDATE_NOT_REQUESTED, TLS_KEY_UPDATE_REQUESTS)]
+
+
 class TLSPlaintext(TLSDecryptablePacket):
     name = "TLS Plaintext"
     fields_desc = [StrField("data", "", fmt="H")]
@@ -1220,6 +1354,50 @@ class SSLv2ClientMasterKey(Packet):
                    StrLenField("key_argument", '', length_from=lambda x:x.key_argument_length)]
 
 
+class TLSKeyUpdatePolicy(object):
+    """
+    When a TLSSocket updates its TLS 1.3 traffic keys on its own, with a KeyUpdate sent ahead of the next record: once
+    max_records records or max_bytes bytes were written under the current keys, e.g. to stay within the usage limits
+    of the AEAD over long lived sessions. request_update asks the peer to update its keys in turn.
+    """
+
+    def __init__(self, max_records=None, max_bytes=None, request_update=False):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.request_update = request_update
+
+    def due(self, ctx):
+        return (self.max_records is not None and ctx.sequence >= self.max_records) or \
+               (self.max_bytes is not None and ctx.protected_bytes >= self.max_bytes)
+
+
+class TLSFlight(object):
+    """
+    The records of one flight, e.g. ClientKeyExchange, ChangeCipherSpec and Finished. Each packet added is
+    serialized, encrypted if due, and inserted into the session context right away, so that a later packet, e.g. the
+    Finished, can be computed from the former. The flight is then written to the socket at once, see
+    TLSSocket.send_flight().
+    """
+
+    def __init__(self, tls_socket):
+        self.tls_socket = tls_socket
+        self.packets = []
+        self.chunks = []
+
+    def add(self, pkt):
+        self.chunks.append(self.tls_socket._to_raw(pkt))
+        self.packets.append(pkt)
+        self.tls_socket.tls_ctx.insert(pkt, self.tls_socket._get_pkt_origin('out'))
+        return self
+
+    @property
+    def data(self):
+        return "".join(self.chunks)
+
+    def __len__(self):
+        return len(self.packets)
+
+
 class TLSSocket(object):
 
     def __init__(self, sock=socket.socket(), client=None, tls_ctx=None):
@@ -1239,9 +1417,13 @@ class TLSSocket(object):
         else:
             self.tls_ctx = tls_ctx
         self.ctx = self.tls_ctx.client_ctx if self.client else self.tls_ctx.server_ctx
+        self.parser = TLSRecordParser(self.tls_ctx, self._get_pkt_origin('in'))
         self.compress_hook = None
         self.pre_encrypt_hook = None
         self.encrypt_hook = None
+        # See TLSKeyUpdatePolicy
+        self.key_update_policy = None
+        self._nodelay = False
 
     def _is_listening(self):
         import errno
@@ -1269,31 +1451,92 @@ class TLSSocket(object):
         elif direction=='out':
             return 'client' if self.client else 'server'
 
+    def _to_raw(self, pkt):
+        if not self.ctx.must_encrypt:
+            return str(pkt)
+        # A KeyUpdate the peer requested or the policy calls for goes first, pkt is protected under the new keys
+        key_update = None if pkt.haslayer(TLSKeyUpdate) else self._key_update()
+        if key_update is None:
+            return self._protect(pkt)
+        raw = self._protect(key_update)
+        self.tls_ctx.insert(key_update, self._get_pkt_origin('out'))
+        return raw + self._protect(pkt)
+
+    def _protect(self, pkt):
+        raw = str(tls_to_raw(pkt, self.tls_ctx, True, self.compress_hook, self.pre_encrypt_hook, self.encrypt_hook))
+        self.ctx.protected_bytes += len(raw)
+        return raw
+
+    def _key_update(self):
+        # Keys are only updated once the TLS 1.3 traffic keys are in use
+        if self.ctx.key_generation is None:
+            return None
+        if self.ctx.key_update_requested:
+            return tls13_key_update()
+        if self.key_update_policy is not None and self.key_update_policy.due(self.ctx):
+            return tls13_key_update(self.key_update_policy.request_update)
+        return None
+
     def sendall(self, pkt, timeout=2):
         prev_timeout = self._s.gettimeout()
         self._s.settimeout(timeout)
-        if self.ctx.must_encrypt:
-            self._s.sendall(str(tls_to_raw(pkt, self.tls_ctx, True, self.compress_hook, self.pre_encrypt_hook, self.encrypt_hook)))
-        else:
-            self._s.sendall(str(pkt))
+        self._s.sendall(self._to_raw(pkt))
         self.tls_ctx.insert(pkt, self._get_pkt_origin('out'))
         self._s.settimeout(prev_timeout)
 
-    def recvall(self, size=8192, timeout=0.5):
-        resp = []
+    def flight(self):
+        return TLSFlight(self)
+
+    def _set_nodelay(self):
+        # A flight is written at once, Nagle's algorithm would only delay it
+        if not self._nodelay:
+            self._nodelay = True
+            try:
+                self._s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error:
+                pass
+
+    def send_flight(self, flight, timeout=2):
+        """ Writes all records of flight, a TLSFlight, in a single write
+        """
+        self._set_nodelay()
         prev_timeout = self._s.gettimeout()
         self._s.settimeout(timeout)
-        while True:
-            try:
-                data = self._s.recv(size)
+        try:
+            self._s.sendall(flight.data)
+        finally:
+            self._s.settimeout(prev_timeout)
+
+    def recvall(self, size=8192, timeout=0.5, until=None):
+        """ Reads records until timeout, or until the until(raw_records) predicate holds, see the
+        ssl_tls_stream.received_* predicates. A partial record is kept for the next call. Bytes not framed as records
+        end the read, they are returned as Raw
+        """
+        self.parser.tls_ctx = self.tls_ctx
+        raw_records = []
+        records = []
+        prev_timeout = self._s.gettimeout()
+        self._s.settimeout(timeout)
+        try:
+            while until is None or not until(raw_records):
+                try:
+                    data = self._s.recv(size)
+                except socket.timeout:
+                    break
                 if not data:
                     break
-                resp.append(data)
-            except socket.timeout:
-                break
-        self._s.settimeout(prev_timeout)
-        records = TLS("".join(resp), ctx=self.tls_ctx, _origin=self._get_pkt_origin('in'))
-        return records
+                try:
+                    chunk = self.parser.split(data)
+                except ValueError:
+                    # Not TLS, e.g. a plaintext error page: the rest of the stream is returned as is
+                    records.extend(self.parser.flush())
+                    break
+                for raw_record in chunk:
+                    raw_records.append(raw_record)
+                    records.append(self.parser.parse(raw_record))
+        finally:
+            self._s.settimeout(prev_timeout)
+        return TLS(records=records, ctx=self.tls_ctx, _origin=self._get_pkt_origin('in'))
 
     def accept(self):
         client_socket, peer = self._s.accept()
@@ -1305,11 +1548,11 @@ class TLSSocket(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def do_handshake(self, version, ciphers, extensions=[]):
-        return tls_do_handshake(self, version, ciphers, extensions)
+    def do_handshake(self, version, ciphers, extensions=[], session_id=""):
+        return tls_do_handshake(self, version, ciphers, extensions, session_id)
 
-    def do_round_trip(self, pkt, recv=True):
-        return tls_do_round_trip(self, pkt, recv)
+    def do_round_trip(self, pkt, recv=True, until=None):
+        return tls_do_round_trip(self, pkt, recv, until)
 
 
 # entry class
@@ -1354,13 +1597,7 @@ class SSL(Packet):
         # We will incorrectly parse it
         while pos < len(raw_bytes) - record_header_len:
             payload_len = record(raw_bytes[pos:pos + record_header_len]).length
-            if self.tls_ctx is not None:
-                payload = record(raw_bytes[pos:pos + record_header_len + payload_len], ctx=self.tls_ctx)
-                # Perform inline decryption if required
-                payload = self.do_decrypt_payload(payload)
-                self.tls_ctx.insert(payload, origin=self._origin)
-            else:
-                payload = record(raw_bytes[pos:pos + record_header_len + payload_len])
+            payload = self.dissect_record(raw_bytes[pos:pos + record_header_len + payload_len])
             # Populate our list of found records
             records.append(payload)
             # Move to the next record
@@ -1369,10 +1606,23 @@ class SSL(Packet):
         # This will always be empty (equivalent to returning "")
         return raw_bytes[pos:]
 
+    def dissect_record(self, raw_record):
+        """ Dissects one complete record, decrypting it and inserting it into the session context if there is one
+        """
+        record = self.guessed_next_layer
+        if self.tls_ctx is not None:
+            payload = record(raw_record, ctx=self.tls_ctx)
+            # Perform inline decryption if required
+            payload = self.do_decrypt_payload(payload)
+            self.tls_ctx.insert(payload, origin=self._origin)
+        else:
+            payload = record(raw_record)
+        return payload
+
     def do_decrypt_payload(self, record):
         content_type = None
         encrypted_payload, layer = self._get_encrypted_payload(record)
-        if encrypted_payload is not None or self.tls_ctx.negotiated.version >= TLSVersion.TLS_1_3:
+        if encrypted_payload is not None:
             try:
                 if self.tls_ctx.client:
                     cleartext = self.tls_ctx.server_ctx.crypto_ctx.decrypt(encrypted_payload,
@@ -1421,6 +1671,70 @@ class SSL(Packet):
 TLS = SSL
 
 
+class TLSRecordParser(object):
+    """
+    Resumable record parser for stream transports. feed() accepts received data in chunks of any size and returns
+    the records it completes, dissected, and with a session context decrypted and inserted into it, each exactly
+    once. A trailing partial record is buffered until the next feed(), bytes already consumed are not parsed again.
+    """
+
+    def __init__(self, tls_ctx=None, origin=None):
+        self.tls_ctx = tls_ctx
+        self.origin = origin
+        self.buffer = bytearray()
+
+    def split(self, data):
+        """ Buffers data and returns the raw records it completes. Raises ValueError on data not framed as records
+        """
+        self.buffer.extend(data)
+        raw_records, offset = self._frame()
+        del self.buffer[:offset]
+        return raw_records
+
+    def _frame(self, strict=True):
+        raw_records = []
+        offset = 0
+        while True:
+            try:
+                length = tlss.tls_record_length(self.buffer, offset)
+            except ValueError:
+                if strict:
+                    raise
+                break
+            if length is None or offset + length > len(self.buffer):
+                break
+            raw_records.append(str(self.buffer[offset:offset + length]))
+            offset += length
+        return raw_records, offset
+
+    def flush(self):
+        """ Empties the buffer, e.g. once split() raised ValueError. Returns the records it still completes, dissected,
+        then the rest of the bytes as Raw
+        """
+        raw_records, offset = self._frame(strict=False)
+        records = [self.parse(raw_record) for raw_record in raw_records]
+        if offset < len(self.buffer):
+            records.append(Raw(load=str(self.buffer[offset:])))
+        self.buffer = bytearray()
+        return records
+
+    def parse(self, raw_record):
+        """ Dissects a raw record as returned by split()
+        """
+        ssl = SSL(ctx=self.tls_ctx, _origin=self.origin)
+        ssl.guessed_next_layer = SSLv2Record if ord(raw_record[0]) & 0x80 else TLSRecord
+        return ssl.dissect_record(raw_record)
+
+    def feed(self, data):
+        return [self.parse(raw_record) for raw_record in self.split(data)]
+
+    @property
+    def pending(self):
+        """ Number of buffered bytes, of a partial record
+        """
+        return len(self.buffer)
+
+
 def find_padding_start(payload, padding_byte=b"\x00"):
     for i, v in enumerate(payload[::-1]):
         if v != padding_byte:
@@ -1495,12 +1809,15 @@ class TLSProtocolError(Exception):
         Exception.__init__(self, args[0], **kwargs)
 
 
-def tls_do_round_trip(tls_socket, pkt, recv=True):
+def tls_do_round_trip(tls_socket, pkt, recv=True, until=None):
     resp = TLS()
     try:
-        tls_socket.sendall(pkt)
+        if isinstance(pkt, TLSFlight):
+            tls_socket.send_flight(pkt)
+        else:
+            tls_socket.sendall(pkt)
         if recv:
-            resp = tls_socket.recvall()
+            resp = tls_socket.recvall(until=until)
             if resp.haslayer(TLSAlert):
                 alert = resp[TLSAlert]
                 if alert.level != TLSAlertLevel.WARNING:
@@ -1512,26 +1829,192 @@ def tls_do_round_trip(tls_socket, pkt, recv=True):
     return resp
 
 
-def tls_do_handshake(tls_socket, version, ciphers, extensions=[]):
+def tls_do_handshake(tls_socket, version, ciphers, extensions=[], session_id=""):
+    """ Performs a full handshake, or the abbreviated one when tls_ctx.resume_session() was called and the server
+    accepts the session offered, through session_id or a SessionTicket extension
+    """
     if version <= TLSVersion.TLS_1_2:
         client_hello = TLSRecord(version=version) / \
                        TLSHandshakes(handshakes=[TLSHandshake() /
                                                  TLSClientHello(version=version,
+                                                                session_id=session_id,
                                                                 cipher_suites=ciphers,
                                                                 extensions=extensions)])
-        resp1 = tls_do_round_trip(tls_socket, client_hello)
+        resp1 = tls_do_round_trip(tls_socket, client_hello, until=tlss.received_server_flight)
+        flight = tls_socket.flight()
+        if tls_socket.tls_ctx.negotiated.resumption:
+            # Abbreviated handshake, the server flight ended with its ChangeCipherSpec and Finished
+            flight.add(TLSRecord(version=version) / TLSChangeCipherSpec())
+            flight.add(TLSHandshakes(handshakes=[TLSHandshake() / TLSFinished(data=tls_socket.tls_ctx.get_verify_data())]))
+            resp2 = tls_do_round_trip(tls_socket, flight, False)
+            return resp1, resp2
 
         client_key_exchange = TLSRecord(version=version) / \
                               TLSHandshakes(handshakes=[TLSHandshake() /
                                                         tls_socket.tls_ctx.get_client_kex_data()])
         client_ccs = TLSRecord(version=version) / TLSChangeCipherSpec()
-        tls_do_round_trip(tls_socket, TLS.from_records([client_key_exchange, client_ccs]), False)
-
-        resp2 = tls_do_round_trip(tls_socket, TLSHandshakes(handshakes=[TLSHandshake() /
-                                                                        TLSFinished(data=tls_socket.tls_ctx.get_verify_data())]))
+        flight.add(TLS.from_records([client_key_exchange, client_ccs]))
+        flight.add(TLSHandshakes(handshakes=[TLSHandshake() / TLSFinished(data=tls_socket.tls_ctx.get_verify_data())]))
+        resp2 = tls_do_round_trip(tls_socket, flight, until=tlss.received_any(tlss.received_finished, tlss.received_alert))
         return resp1, resp2
     else:
-        raise NotImplementedError("Do handshake not implemented for TLS 1.3")
+        return tls13_do_handshake(tls_socket, version, ciphers, extensions)
+
+
+def tls13_key_share(tls_ctx, groups):
+    """ Returns a client KeyShare extension with a new key pair for each of groups. The key pairs are installed in the
+    client context of tls_ctx, which derives the handshake secrets from the one matching the server share
+    """
+    import tinyec.registry as ec_reg
+    import ssl_tls_keystore as tlsk
+    client_shares = []
+    for group in groups:
+        keystore = tlsk.ECDHKeyStore.new_keypair(ec_reg.get_curve(TLS_SUPPORTED_GROUPS[group]))
+        tls_ctx.client_ctx.shares.append(keystore)
+        client_shares.append(TLSKeyShareEntry(named_group=group, key_exchange=tlsk.point_to_ansi_str(keystore.public)))
+    return TLSExtension() / TLSExtKeyShare() / TLSClientHelloKeyShare(client_shares=client_shares)
+
+
+def tls13_pre_shared_key(identity, obfuscated_ticket_age, binder_len):
+    """ Returns a ClientHello PreSharedKey extension offering identity, with a placeholder binder, see tls13_bind_psk()
+    """
+    return TLSExtension() / TLSExtPreSharedKey() / TLSClientHelloPreSharedKey(
+        identities=[TLSPSKIdentity(identity=identity, obfuscated_ticket_age=obfuscated_ticket_age)],
+        binders=[TLSPSKBinderEntry(binder_entry=b"\x00" * binder_len)])
+
+
+def tls13_bind_psk(tls_ctx, client_hello):
+    """ Computes the binder of the PreSharedKey extension of client_hello, a ClientHello handshake, in place. The PSK
+    is the one tls_ctx.resume_psk() was given. The binder covers the ClientHello up to the binders, the extension
+    must be the last one
+    """
+    pre_shared_key = client_hello[TLSClientHelloPreSharedKey]
+    binders_len = 2 + sum(1 + len(binder.binder_entry) for binder in pre_shared_key.binders)
+    binder = tls_ctx.get_psk_binder(str(client_hello)[:-binders_len])
+    pre_shared_key.binders = [TLSPSKBinderEntry(binder_entry=binder)]
+
+
+def tls13_client_hello(tls_ctx, version, ciphers, extensions=[], groups=(TLSSupportedGroup.SECP256R1,), early_data=False):
+    """
+    Returns a TLS 1.3 ClientHello record offering version, e.g. tls_draft_version(18), in a SupportedVersions
+    extension. A key share is sent for each of groups, unless extensions already hold a KeyShare, along with the
+    SupportedGroups and SignatureAlgorithms extensions TLS 1.3 requires, unless given. A PreSharedKey extension is
+    moved last and bound to the PSK of tls_ctx, early_data adds the EarlyData extension.
+    """
+    extensions = list(extensions)
+    if not any(extension.haslayer(TLSExtSupportedVersions) for extension in extensions):
+        extensions.append(TLSExtension() / TLSExtSupportedVersions(versions=[version]))
+    if not any(extension.haslayer(TLSExtSupportedGroups) for extension in extensions):
+        extensions.append(TLSExtension() / TLSExtSupportedGroups())
+    if not any(extension.haslayer(TLSExtSignatureAlgorithms) for extension in extensions):
+        extensions.append(TLSExtension() / TLSExtSignatureAlgorithms())
+    if not any(extension.haslayer(TLSExtKeyShare) for extension in extensions):
+        extensions.append(tls13_key_share(tls_ctx, groups))
+    if early_data and not any(extension.type == TLSExtensionType.EARLY_DATA for extension in extensions):
+        extensions.append(TLSExtension(type=TLSExtensionType.EARLY_DATA))
+    extensions.sort(key=lambda extension: extension.haslayer(TLSClientHelloPreSharedKey))
+    client_hello = TLSHandshake() / TLSClientHello(version=TLSVersion.TLS_1_2, cipher_suites=ciphers, extensions=extensions)
+    if client_hello.haslayer(TLSClientHelloPreSharedKey):
+        tls13_bind_psk(tls_ctx, client_hello)
+    return TLSRecord(version=TLSVersion.TLS_1_0) / TLSHandshakes(handshakes=[client_hello])
+
+
+def tls13_received_server_flight(tls_ctx):
+    """ Predicate for recv_records(): the TLS 1.3 server flight ended. Its Finished is encrypted, it is only seen once
+    tls_ctx processed it
+    """
+    return tlss.received_any(lambda records: bool(tls_ctx.server_ctx.finished_hashes), tlss.received_alert,
+                             tlss.received_handshake(TLSHandshakeType.HELLO_RETRY_REQUEST))
+
+
+def tls13_selected_group(resp):
+    """ Returns the group a server selected, from the key share of the ServerHello or HelloRetryRequest opening resp,
+    None without one
+    """
+    # Only the first handshake is looked at, looking further would decode certificates
+    hello = resp.getlayer(TLSHandshake)
+    if hello is None:
+        return None
+    if hello.haslayer(TLSHelloRetryRequestKeyShare):
+        return hello[TLSHelloRetryRequestKeyShare].selected_group
+    if hello.haslayer(TLSServerHelloKeyShare) and hello[TLSServerHelloKeyShare].server_share is not None:
+        return hello[TLSServerHelloKeyShare].server_share.named_group
+    return None
+
+
+def tls13_retry_group(client_hello, resp):
+    """ Returns the group the HelloRetryRequest in resp asks a key share of. The group must be one client_hello
+    supports but sent no key share for
+    """
+    group = tls13_selected_group(resp)
+    shared = [entry.named_group for entry in client_hello[TLSClientHelloKeyShare].client_shares] \
+        if client_hello.haslayer(TLSClientHelloKeyShare) else []
+    if group is None or group not in client_hello[TLSExtSupportedGroups].named_group_list or group in shared:
+        raise TLSProtocolError("Server requested a key share of a group not offered", client_hello, resp)
+    return group
+
+
+def tls13_client_finished(tls_ctx, client_hello, resp):
+    """ Returns the client Finished concluding resp, the server flight answering client_hello
+    """
+    if resp.haslayer(TLSHelloRetryRequest):
+        raise TLSProtocolError("Server requested a key share of another group", client_hello, resp)
+    if not tls_ctx.server_ctx.finished_hashes:
+        raise TLSProtocolError("Server flight ended without a Finished", client_hello, resp)
+    return TLSHandshakes(handshakes=[TLSHandshake() / TLSFinished(data=tls_ctx.get_verify_data())])
+
+
+def tls13_do_handshake(tls_socket, version, ciphers, extensions=[], groups=(TLSSupportedGroup.SECP256R1,),
+                       early_data=None, key_share_cache=None):
+    """
+    1-RTT TLS 1.3 handshake, see tls13_client_hello(). The server flight, from its ServerHello to its Finished, is
+    decrypted as it is read, in a single read. The client Finished is sent under the handshake keys, application data
+    is protected under the traffic keys from then on. Returns both server responses, the second is empty as the
+    client finishes last.
+    When the server answers with a HelloRetryRequest, the ClientHello is sent again with a key share of the group it
+    selected only, without PSK nor early data. With a KeyShareCache, see ssl_tls_session, a key share is only sent for
+    the group the server selected last, if known, and the group it selects is learnt.
+    With a PSK offered, see TLSSessionCtx.resume_psk(), early_data is sent along the ClientHello under the early
+    traffic keys (0-RTT). tls_ctx.negotiated.early_data tells whether the server accepted it, it was discarded
+    otherwise.
+    """
+    tls_ctx = tls_socket.tls_ctx
+    if early_data is not None and tls_ctx.psk is None:
+        raise ValueError("Early data requires a PSK, see TLSSessionCtx.resume_psk()")
+    if key_share_cache is not None:
+        host, port = tls_socket.getpeername()[:2]
+        groups = key_share_cache.predict(host, port, groups)
+    client_hello = tls13_client_hello(tls_ctx, version, ciphers, extensions, groups, early_data is not None)
+    flight = tls_socket.flight().add(client_hello)
+    if early_data is not None:
+        flight.add(TLSPlaintext(data=early_data))
+    resp1 = tls_do_round_trip(tls_socket, flight, until=tls13_received_server_flight(tls_ctx))
+    if resp1.haslayer(TLSHelloRetryRequest):
+        group = tls13_retry_group(client_hello, resp1)
+        if key_share_cache is not None:
+            key_share_cache.set(host, port, group)
+        # The binder of a PSK would have to cover the first exchange as well. Without it, the early keys are dropped
+        tls_ctx.abandon_psk()
+        extensions = [extension for extension in extensions if not
+                      (extension.haslayer(TLSExtKeyShare) or extension.haslayer(TLSClientHelloPreSharedKey))]
+        client_hello = tls13_client_hello(tls_ctx, version, ciphers, extensions, (group,))
+        resp1 = tls_do_round_trip(tls_socket, client_hello, until=tls13_received_server_flight(tls_ctx))
+    finished = tls13_client_finished(tls_ctx, client_hello, resp1)
+    if key_share_cache is not None:
+        key_share_cache.update(host, port, resp1)
+    flight = tls_socket.flight()
+    if tls_ctx.negotiated.early_data:
+        flight.add(TLSRecord() / TLSAlert(level=TLSAlertLevel.WARNING, description=TLSAlertDescription.END_OF_EARLY_DATA))
+    resp2 = tls_do_round_trip(tls_socket, flight.add(finished), False)
+    return resp1, resp2
+
+
+def tls13_key_update(request_update=False):
+    """ Returns a KeyUpdate, protected under the current traffic keys when sent. The sender uses the next generation of
+    its traffic keys from then on, as does the peer in turn when request_update is set
+    """
+    request = TLSKeyUpdateRequest.UPDATE_REQUESTED if request_update else TLSKeyUpdateRequest.UPDATE_NOT_REQUESTED
+    return TLSHandshakes(handshakes=[TLSHandshake() / TLSKeyUpdate(request_update=request)])
 
 
 def tls_fragment_payload(pkt, record=None, size=2**14):
@@ -1582,10 +2065,12 @@ bind_layers(TLSHandshake, TLSServerKeyExchange, {'type': TLSHandshakeType.SERVER
 bind_layers(TLSHandshake, TLSServerHelloDone, {'type': TLSHandshakeType.SERVER_HELLO_DONE})
 bind_layers(TLSHandshake, TLSClientKeyExchange, {'type': TLSHandshakeType.CLIENT_KEY_EXCHANGE})
 bind_layers(TLSHandshake, TLSFinished, {'type': TLSHandshakeType.FINISHED})
+bind_layers(TLSHandshake, TLS13SessionTicket, {'type': TLSHandshakeType.NEWSESSIONTICKET})
 bind_layers(TLSHandshake, TLSSessionTicket, {'type': TLSHandshakeType.NEWSESSIONTICKET})
 bind_layers(TLSHandshake, TLSCertificateRequest, {"type": TLSHandshakeType.CERTIFICATE_REQUEST})
 bind_layers(TLSHandshake, TLSCertificateVerify, {"type": TLSHandshakeType.CERTIFICATE_VERIFY})
 bind_layers(TLSHandshake, TLSEncryptedExtensions, {"type": TLSHandshakeType.ENCRYPTED_EXTENSIONS})
+bind_layers(TLSHandshake, TLSKeyUpdate, {"type": TLSHandshakeType.KEY_UPDATE})
 # <---
 
 # --> extensions
@@ -1606,6 +2091,7 @@ bind_layers(TLSExtension, TLSExtPadding, {'type': TLSExtensionType.PADDING})
 bind_layers(TLSExtension, TLSExtPSKKeyExchangeModes, {'type': TLSExtensionType.PSK_KEY_EXCHANGE_MODES})
 bind_layers(TLSExtension, TLSExtCertificateStatusRequest, {'type': TLSExtensionType.STATUS_REQUEST})
 bind_layers(TLSExtension, TLSExtPreSharedKey, {'type': TLSExtensionType.PRE_SHARED_KEY})
+bind_layers(TLSExtension, TLSExtTicketEarlyDataInfo, {'type': TLSExtensionType.TICKET_EARLY_DATA_INFO})
 # <--
 
 # DTLSRecord
@@ -0,0 +1,400 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import copy
+import errno
+import socket
+import sys
+import time
+import types
+
+from collections import deque
+
+import ssl_tls as tls
+import ssl_tls_stream as tlss
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class Return(Exception):
+    """ Raised by a coroutine to return value, a Python 2 generator cannot return one
+    """
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Wait(object):
+    """ Yielded by a coroutine to be resumed once sock is ready, socket.timeout is raised into it after timeout seconds
+    """
+    __slots__ = ("sock", "events", "timeout")
+
+    def __init__(self, sock, events, timeout=None):
+        self.sock = sock
+        self.events = events
+        self.timeout = timeout
+
+
+def readable(sock, timeout=None):
+    return Wait(sock, tlss.Poller.READ, timeout)
+
+
+def writable(sock, timeout=None):
+    return Wait(sock, tlss.Poller.WRITE, timeout)
+
+
+class Task(object):
+    """
+    Runs a coroutine, a generator yielding Wait objects or other coroutines. A yielded coroutine is run to completion
+    first, the yield then evaluates to the value it returned (see Return) or raises the exception it raised.
+    """
+
+    def __init__(self, coro):
+        self._stack = [coro]
+        self._exc_info = None
+        self.value = None
+        self.done = False
+
+    def step(self, value=None, exc_info=None):
+        """ Resumes the coroutine until it waits, returns the Wait, None once done
+        """
+        while self._stack:
+            coro = self._stack[-1]
+            try:
+                if exc_info is not None:
+                    yielded = coro.throw(*exc_info)
+                else:
+                    yielded = coro.send(value)
+            except Return as r:
+                self._stack.pop()
+                value, exc_info = r.value, None
+                continue
+            except StopIteration:
+                self._stack.pop()
+                value, exc_info = None, None
+                continue
+            except Exception:
+                self._stack.pop()
+                value, exc_info = None, sys.exc_info()
+                continue
+            value, exc_info = None, None
+            if isinstance(yielded, types.GeneratorType):
+                self._stack.append(yielded)
+            elif isinstance(yielded, Wait):
+                return yielded
+            else:
+                exc_info = (TypeError, TypeError("Coroutine yielded %r, not a Wait or a coroutine" % yielded), None)
+        self.done = True
+        self.value = value
+        self._exc_info = exc_info
+        return None
+
+    def result(self):
+        """ Returns the value returned by the coroutine, or raises the exception it raised
+        """
+        if not self.done:
+            raise RuntimeError("Task is not done")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self.value
+
+
+class EventLoop(object):
+    """
+    Runs coroutines concurrently from a single thread: a coroutine waiting on a socket is resumed once the socket is
+    ready, as reported by poll(). One coroutine at a time may wait on a given socket.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._ready = deque()
+        self._waiting = {}
+
+    def spawn(self, coro):
+        """ Schedules coro, returns its Task
+        """
+        task = Task(coro)
+        self._ready.append((task, None))
+        return task
+
+    def _wait(self, poller, task, wait):
+        fd = wait.sock.fileno()
+        if fd in self._waiting:
+            self._ready.append((task, (ValueError, ValueError("A task already waits on fd %d" % fd), None)))
+            return
+        deadline = None if wait.timeout is None else self.clock() + wait.timeout
+        self._waiting[fd] = (task, deadline)
+        poller.register(fd, wait.events)
+
+    def _resume(self, poller, fd, exc_info=None):
+        task, _ = self._waiting.pop(fd)
+        poller.unregister(fd)
+        self._ready.append((task, exc_info))
+
+    def run(self):
+        """ Runs until all tasks, including the ones spawned meanwhile, are done
+        """
+        poller = tlss.Poller()
+        while self._ready or self._waiting:
+            while self._ready:
+                task, exc_info = self._ready.popleft()
+                wait = task.step(exc_info=exc_info)
+                if wait is not None:
+                    self._wait(poller, task, wait)
+            if not self._waiting:
+                break
+            deadlines = [deadline for _, deadline in self._waiting.values() if deadline is not None]
+            timeout = max(0, min(deadlines) - self.clock()) if deadlines else None
+            for fd in poller.poll(timeout):
+                if fd in self._waiting:
+                    self._resume(poller, fd)
+            now = self.clock()
+            for fd, (_, deadline) in self._waiting.items():
+                if deadline is not None and deadline <= now:
+                    self._resume(poller, fd, (socket.timeout, socket.timeout("timed out"), None))
+
+    def run_until_complete(self, coro):
+        """ Runs coro, and all other tasks, returns what coro returned
+        """
+        task = self.spawn(coro)
+        self.run()
+        return task.result()
+
+
+def sendall(sock, data, timeout=None):
+    """ Coroutine writing data to the non blocking sock
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[sock.send(view):]
+        except socket.error as se:
+            if se.errno not in _WOULD_BLOCK:
+                raise
+            yield writable(sock, timeout)
+
+
+def recv(sock, size=8192, timeout=None):
+    """ Coroutine returning the next data read from the non blocking sock, "" once the peer closed
+    """
+    while True:
+        try:
+            raise Return(sock.recv(size))
+        except socket.error as se:
+            if se.errno not in _WOULD_BLOCK:
+                raise
+        yield readable(sock, timeout)
+
+
+class AsyncTLSSocket(tls.TLSSocket):
+    """
+    TLSSocket counterpart for EventLoop coroutines, its methods are coroutines to yield, e.g.
+    resp = yield tls_socket.do_round_trip(pkt). The socket is made non blocking.
+
+    Reads are framed by the record lengths rather than ended by a timeout: recv_records() returns as soon as
+    until(raw_records) holds, by default once one record arrived. timeout, None by default, only bounds the wait for
+    the next data, socket.timeout is raised when it expires.
+    """
+
+    def __init__(self, sock, client=None, tls_ctx=None, timeout=None):
+        super(AsyncTLSSocket, self).__init__(sock, client, tls_ctx)
+        self._s.setblocking(False)
+        self.timeout = timeout
+
+    def sendall(self, pkt):
+        yield sendall(self._s, self._to_raw(pkt), self.timeout)
+        self.tls_ctx.insert(pkt, self._get_pkt_origin('out'))
+
+    def send_flight(self, flight):
+        self._set_nodelay()
+        yield sendall(self._s, flight.data, self.timeout)
+
+    def recv_records(self, until=None, size=8192):
+        self.parser.tls_ctx = self.tls_ctx
+        until = until or tlss.received_records(1)
+        raw_records = []
+        records = []
+        while not until(raw_records):
+            data = yield recv(self._s, size, self.timeout)
+            if not data:
+                break
+            for raw_record in self.parser.split(data):
+                raw_records.append(raw_record)
+                records.append(self.parser.parse(raw_record))
+        raise Return(tls.TLS(records=records, ctx=self.tls_ctx, _origin=self._get_pkt_origin('in')))
+
+    def accept(self):
+        while True:
+            try:
+                client_socket, peer = self._s.accept()
+                break
+            except socket.error as se:
+                if se.errno not in _WOULD_BLOCK:
+                    raise
+            yield readable(self._s, self.timeout)
+        raise Return((AsyncTLSSocket(client_socket, client=False, tls_ctx=copy.copy(self.tls_ctx),
+                                     timeout=self.timeout), peer))
+
+    def do_round_trip(self, pkt, recv=True, until=None):
+        """ Coroutine counterpart of tls_do_round_trip()
+        """
+        resp = tls.TLS()
+        try:
+            if isinstance(pkt, tls.TLSFlight):
+                yield self.send_flight(pkt)
+            else:
+                yield self.sendall(pkt)
+            if recv:
+                resp = yield self.recv_records(until)
+                if resp.haslayer(tls.TLSAlert):
+                    alert = resp[tls.TLSAlert]
+                    if alert.level != tls.TLSAlertLevel.WARNING:
+                        level = tls.TLS_ALERT_LEVELS.get(alert.level, "unknown")
+                        description = tls.TLS_ALERT_DESCRIPTIONS.get(alert.description, "unknown description")
+                        raise tls.TLSProtocolError("%s alert returned by server: %s" %
+                                                   (level.upper(), description.upper()), pkt, resp)
+        except socket.error as se:
+            raise tls.TLSProtocolError(se, pkt, resp)
+        raise Return(resp)
+
+    def do_handshake(self, version, ciphers, extensions=[]):
+        """ Coroutine counterpart of tls_do_handshake()
+        """
+        if version > tls.TLSVersion.TLS_1_2:
+            client_hello = tls.tls13_client_hello(self.tls_ctx, version, ciphers, extensions)
+            resp1 = yield self.do_round_trip(client_hello, until=tls.tls13_received_server_flight(self.tls_ctx))
+            resp2 = yield self.do_round_trip(tls.tls13_client_finished(self.tls_ctx, client_hello, resp1), False)
+            raise Return((resp1, resp2))
+        client_hello = tls.TLSRecord(version=version) / \
+            tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                          tls.TLSClientHello(version=version, cipher_suites=ciphers,
+                                                             extensions=extensions)])
+        resp1 = yield self.do_round_trip(client_hello, until=tlss.received_server_flight)
+
+        client_key_exchange = tls.TLSRecord(version=version) / \
+            tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / self.tls_ctx.get_client_kex_data()])
+        client_ccs = tls.TLSRecord(version=version) / tls.TLSChangeCipherSpec()
+        flight = self.flight().add(tls.TLS.from_records([client_key_exchange, client_ccs]))
+        flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSFinished(data=self.tls_ctx.get_verify_data())]))
+        resp2 = yield self.do_round_trip(flight, until=tlss.received_any(tlss.received_finished, tlss.received_alert))
+        raise Return((resp1, resp2))
+
+
+class _PooledSocket(object):
+    __slots__ = ("tls_socket", "on_records", "on_close", "on_accept", "out")
+
+    def __init__(self, tls_socket, on_records=None, on_close=None, on_accept=None):
+        self.tls_socket = tls_socket
+        self.on_records = on_records
+        self.on_close = on_close
+        self.on_accept = on_accept
+        self.out = deque()
+
+
+class TLSSocketPool(object):
+    """
+    Drives many TLSSockets from one thread with callbacks, for code that is not written as coroutines.
+
+    Data read from a registered socket is split into records by its socket's parser, on_records(tls_socket, records)
+    is called with each batch of complete records as a TLS packet, a partial record waits for the rest. on_close(
+    tls_socket) is called once the peer closed the connection or it failed, the socket is then closed and
+    unregistered. Data not framed as records, or a callback raising, fails that socket only. send() serializes and encrypts a packet right away, so that records are protected in order, but
+    queues the bytes, they are written once the socket is writable. A TLSFlight is queued as a whole. A listening
+    TLSSocket registered with register_listener() accepts connections, on_accept(tls_socket, peer) typically
+    registers them.
+    """
+
+    def __init__(self):
+        self._poller = tlss.Poller()
+        self._sockets = {}
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def register(self, tls_socket, on_records, on_close=None):
+        tls_socket.setblocking(False)
+        self._sockets[tls_socket.fileno()] = _PooledSocket(tls_socket, on_records, on_close)
+        self._poller.register(tls_socket.fileno(), tlss.Poller.READ)
+
+    def register_listener(self, tls_socket, on_accept):
+        tls_socket.setblocking(False)
+        self._sockets[tls_socket.fileno()] = _PooledSocket(tls_socket, on_accept=on_accept)
+        self._poller.register(tls_socket.fileno(), tlss.Poller.READ)
+
+    def unregister(self, tls_socket):
+        self._poller.unregister(tls_socket.fileno())
+        return self._sockets.pop(tls_socket.fileno(), None)
+
+    def send(self, tls_socket, pkt):
+        pooled = self._sockets[tls_socket.fileno()]
+        if isinstance(pkt, tls.TLSFlight):
+            pooled.out.append(pkt.data)
+        else:
+            pooled.out.append(tls_socket._to_raw(pkt))
+            tls_socket.tls_ctx.insert(pkt, tls_socket._get_pkt_origin('out'))
+        self._poller.register(tls_socket.fileno(), tlss.Poller.READ | tlss.Poller.WRITE)
+
+    def _close(self, pooled):
+        self.unregister(pooled.tls_socket)
+        pooled.tls_socket.close()
+        if pooled.on_close is not None:
+            pooled.on_close(pooled.tls_socket)
+
+    def _flush(self, fd, pooled):
+        while pooled.out:
+            data = pooled.out[0]
+            sent = pooled.tls_socket.send(data)
+            if sent < len(data):
+                pooled.out[0] = data[sent:]
+                return
+            pooled.out.popleft()
+        self._poller.register(fd, tlss.Poller.READ)
+
+    def _read(self, pooled, size):
+        tls_socket = pooled.tls_socket
+        data = tls_socket.recv(size)
+        if not data:
+            self._close(pooled)
+            return
+        tls_socket.parser.tls_ctx = tls_socket.tls_ctx
+        records = [tls_socket.parser.parse(raw_record) for raw_record in tls_socket.parser.split(data)]
+        if records:
+            pooled.on_records(tls_socket, tls.TLS(records=records, ctx=tls_socket.tls_ctx,
+                                                  _origin=tls_socket._get_pkt_origin('in')))
+
+    def poll(self, timeout=None, size=8192):
+        """ Handles the sockets ready within timeout seconds, returns their number
+        """
+        ready = self._poller.poll_events(timeout)
+        for fd, events in ready:
+            pooled = self._sockets.get(fd)
+            if pooled is None:
+                continue
+            try:
+                if pooled.on_accept is not None:
+                    pooled.on_accept(*pooled.tls_socket.accept())
+                    continue
+                if events & tlss.Poller.WRITE and pooled.out:
+                    self._flush(fd, pooled)
+                if events & tlss.Poller.READ:
+                    self._read(pooled, size)
+            except socket.error as se:
+                if se.errno not in _WOULD_BLOCK:
+                    self._fail(fd, pooled)
+            except Exception:
+                # Data not framed as records, or a failing callback: only this socket is dropped
+                self._fail(fd, pooled)
+        return len(ready)
+
+    def _fail(self, fd, pooled):
+        # Unless a callback already unregistered it
+        if self._sockets.get(fd) is pooled:
+            self._close(pooled)
+
+    def run(self, idle_timeout=None, size=8192):
+        """ Polls until no socket is left, or no socket got ready for idle_timeout seconds
+        """
+        while self._sockets and self.poll(idle_timeout, size):
+            pass
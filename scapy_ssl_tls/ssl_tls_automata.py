@@ -7,6 +7,7 @@ import functools
 
 from ssl_tls import *
 from ssl_tls_crypto import *
+import ssl_tls_session as tlssess
 
 from scapy.automaton import Automaton, ATMT
 
@@ -310,6 +311,9 @@ class TLSServerAutomata(Automaton):
                                  cipher_suite=TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
                                  response="HTTP/1.1 200 OK\r\n\r\n")
         auto_srv.run()
+
+        Sessions are resumed in an abbreviated handshake when a session_store, ServerSessionStore, or ticket_keys,
+        TicketKeys, is given. Both outlive a run, and are typically shared by the automata serving the same clients.
     """
 
     def __init__(self, *args, **kwargs):
@@ -350,6 +354,8 @@ class TLSServerAutomata(Automaton):
                    response="HTTP/1.1 200 OK\r\n\r\n",
                    cipher_suite=TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
                    timeout=4.0,
+                   session_store=None,
+                   ticket_keys=None,
                    **kwargs):
         Automaton.parse_args(self, **kwargs)
         self.bind = bind
@@ -362,6 +368,14 @@ class TLSServerAutomata(Automaton):
         self.tlssock = None
         self.srv_sock = None
         self.peer = None
+        self.session_store = session_store
+        self.ticket_keys = ticket_keys
+        self.session = None
+        self.session_id = None
+        self.issue_ticket = False
+        self.client_finished = False
+        self.client_records = []
+        self.flight = None
 
         pemo = pem_get_objects(self.pemcert)
         for key_pk in (k for k in pemo.keys() if "CERTIFICATE" in k.upper()):
@@ -374,6 +388,21 @@ class TLSServerAutomata(Automaton):
         self.debug(1, "register callback: %s - %s" % (fname, repr(f)))
         self.callbacks[fname] = f
 
+    def add_to_flight(self, pkt):
+        # Server records are written a flight at a time, see send_flight()
+        if self.flight is None:
+            self.flight = self.tlssock.flight()
+        self.flight.add(pkt)
+
+    def send_flight(self):
+        if self.flight is not None:
+            self.tlssock.send_flight(self.flight)
+            if self.debug_level >= 1:
+                # Only once sent, showing a certificate dissects it
+                for pkt in self.flight.packets:
+                    pkt.show()
+            self.flight = None
+
     def run(self, *args, **kwargs):
         """tin: ugly hack Part II:
                 fix {state:condition_funcs} map to use hookable(f) instead of f
@@ -418,12 +447,30 @@ class TLSServerAutomata(Automaton):
     @hookable
     @ATMT.condition(WAIT_FOR_CLIENT_CONNECTION)
     def recv_client_hello(self):
-        p = self.tlssock.recvall(timeout=self.timeout)
+        p = self.tlssock.recvall(timeout=self.timeout,
+                                 until=tlss.received_handshake(TLSHandshakeType.CLIENT_HELLO))
         if self.debug_level >= 1:
             p.show()
         if not p.haslayer(TLSClientHello):
             raise self.ERROR(p)
-        self.tls_version = p[TLSClientHello].version
+        client_hello = p[TLSClientHello]
+        self.tls_version = client_hello.version
+        self.session = tlssess.find_session(client_hello, self.session_store, self.ticket_keys)
+        self.issue_ticket = self.ticket_keys is not None and tlssess.offers_ticket(client_hello)
+        self.client_finished = False
+        self.client_records = []
+        self.flight = None
+        if self.session is not None:
+            # Echoing the session_id offered accepts the session
+            self.session_id = client_hello.session_id
+            self.tlssock.tls_ctx.resume_session(self.session.master_secret)
+        elif self.session_store is not None:
+            self.session_id = self.session_store.new_session_id()
+        elif self.ticket_keys is not None:
+            # Without a store, a session_id could not be resumed
+            self.session_id = ""
+        else:
+            self.session_id = None
         raise self.CLIENT_HELLO_RECV()
 
     @hookable
@@ -438,13 +485,16 @@ class TLSServerAutomata(Automaton):
     @hookable
     @ATMT.action(send_server_hello)
     def do_send_server_hello(self):
-        server_hello = TLSRecord(version=self.tls_version) / \
-                       TLSHandshakes(handshakes=[TLSHandshake() /
-                                                 TLSServerHello(version=self.tls_version,
-                                                                compression_method=TLSCompressionMethod.NULL,
-                                                                cipher_suite=self.cipher_suite)])
-        server_hello.show()
-        self.tlssock.sendall(server_hello)
+        server_hello = TLSServerHello(version=self.tls_version,
+                                      compression_method=TLSCompressionMethod.NULL,
+                                      cipher_suite=self.session.cipher_suite if self.session else self.cipher_suite)
+        if self.session_id is not None:
+            server_hello.session_id = self.session_id
+        if self.issue_ticket:
+            # A NewSessionTicket follows
+            server_hello.extensions = [TLSExtension() / TLSExtSessionTicketTLS()]
+        server_hello = TLSRecord(version=self.tls_version) / TLSHandshakes(handshakes=[TLSHandshake() / server_hello])
+        self.add_to_flight(server_hello)
 
     @hookable
     @ATMT.state()
@@ -453,6 +503,13 @@ class TLSServerAutomata(Automaton):
 
     @hookable
     @ATMT.condition(SERVER_HELLO_SENT)
+    def resume_session(self):
+        # Abbreviated handshake, straight to ChangeCipherSpec and Finished
+        if self.session is not None:
+            raise self.SERVER_KEY_EXCHANGE_SENT()
+
+    @hookable
+    @ATMT.condition(SERVER_HELLO_SENT, prio=1)
     def send_server_certificates(self):
         raise self.SERVER_CERTIFICATES_SENT()
 
@@ -466,10 +523,8 @@ class TLSServerAutomata(Automaton):
 
         server_certificates = TLSRecord(version=self.tls_version) / \
                               TLSHandshakes(handshakes=[TLSHandshake() /
-                                                        TLSCertificateList() / cls_cert(certificates=[TLSCertificate(data=x509.X509_Cert(self.dercert))])])
-
-        server_certificates.show()
-        self.tlssock.sendall(server_certificates)
+                                                        TLSCertificateList() / cls_cert(certificates=[TLSCertificate(data=LazyX509Cert(self.dercert))])])
+        self.add_to_flight(server_certificates)
 
     @hookable
     @ATMT.state()
@@ -487,7 +542,8 @@ class TLSServerAutomata(Automaton):
         server_hello_done = TLSRecord(version=self.tls_version) / \
                             TLSHandshakes(handshakes=[TLSHandshake() /
                                                       TLSServerHelloDone()])
-        self.tlssock.sendall(server_hello_done)
+        self.add_to_flight(server_hello_done)
+        self.send_flight()
 
     @hookable
     @ATMT.state()
@@ -497,7 +553,7 @@ class TLSServerAutomata(Automaton):
     @hookable
     @ATMT.condition(SERVER_HELLO_DONE_SENT)
     def recv_client_key_exchange(self):
-        p = self.tlssock.recvall()
+        p = self.tlssock.recvall(until=tlss.received_any(tlss.received_finished, tlss.received_alert))
         if self.debug_level >= 1:
             p.show()
         if not p.haslayer(TLSClientKeyExchange):
@@ -541,10 +597,23 @@ class TLSServerAutomata(Automaton):
 
     @hookable
     @ATMT.action(send_server_ccs)
+    def do_send_session_ticket(self):
+        if self.issue_ticket:
+            tls_ctx = self.tlssock.tls_ctx
+            ticket = self.ticket_keys.seal(tlssess.TLSSession(master_secret=tls_ctx.master_secret,
+                                                              cipher_suite=tls_ctx.negotiated.ciphersuite,
+                                                              version=tls_ctx.negotiated.version))
+            self.add_to_flight(TLSRecord(version=tls_ctx.negotiated.version) /
+                               TLSHandshakes(handshakes=[TLSHandshake() /
+                                                         TLSSessionTicket(lifetime=self.ticket_keys.lifetime,
+                                                                          ticket=ticket)]))
+
+    @hookable
+    @ATMT.action(send_server_ccs, prio=1)
     def do_send_server_ccs(self):
         tls_version = self.tlssock.tls_ctx.negotiated.version
         client_ccs = TLSRecord(version=tls_version) / TLSChangeCipherSpec()
-        self.tlssock.sendall(client_ccs)
+        self.add_to_flight(client_ccs)
 
     @hookable
     @ATMT.state()
@@ -560,7 +629,10 @@ class TLSServerAutomata(Automaton):
     @ATMT.action(send_server_finish)
     def do_send_server_finish(self):
         # TODO: fix server finish calculation
-        self.tlssock.sendall( TLSHandshakes(handshakes=[TLSHandshake() / TLSFinished(data=self.tlssock.tls_ctx.get_verify_data())]))
+        self.add_to_flight(TLSHandshakes(handshakes=[TLSHandshake() / TLSFinished(data=self.tlssock.tls_ctx.get_verify_data())]))
+        self.send_flight()
+        if self.session is None and self.session_store is not None:
+            self.session_store.store(self.session_id, self.tlssock.tls_ctx)
 
     @hookable
     @ATMT.state()
@@ -569,17 +641,28 @@ class TLSServerAutomata(Automaton):
 
     @hookable
     @ATMT.condition(SERVER_FINISH_SENT)
+    def recv_client_finish(self):
+        # In an abbreviated handshake, the client finishes last
+        if self.session is not None and not self.client_finished:
+            p = self.tlssock.recvall(timeout=self.timeout, until=tlss.received_any(tlss.received_finished,
+                                                                                   tlss.received_alert))
+            if self.debug_level >= 1:
+                p.show()
+            if not p.haslayer(TLSFinished):
+                raise self.ERROR(p)
+            self.client_finished = True
+            # Application data may have been read along
+            self.client_records = [record for record in p.records if record.haslayer(TLSRecord) and
+                                   record[TLSRecord].content_type == TLSContentType.APPLICATION_DATA]
+            raise self.SERVER_FINISH_SENT()
+
+    @hookable
+    @ATMT.condition(SERVER_FINISH_SENT, prio=1)
     def recv_client_appdata(self):
-        chunk_p = True
-        p = SSL()
-        self.debug(1, "polling in 5sec intervals until data arrives.")
-        while chunk_p:
-            chunk_p = self.tlssock.recvall(timeout=5)
-            if chunk_p.haslayer(SSL) and len(chunk_p[SSL].records) > 0:
-                p.records.append(chunk_p)
-            else:
-                if len(p[SSL].records) > 0:
-                    break
+        p = SSL(records=self.client_records)
+        if not p.records:
+            self.debug(1, "waiting up to 5sec for data to arrive.")
+            p = self.tlssock.recvall(timeout=5, until=tlss.received_records(1))
 
         if self.debug_level >= 1:
             p.show()
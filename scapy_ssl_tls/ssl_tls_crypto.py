@@ -19,7 +19,7 @@ import ssl_tls_keystore as tlsk
 import tinyec.ec as ec
 import tinyec.registry as ec_reg
 
-from collections import namedtuple
+from collections import deque
 from Cryptodome.Cipher import AES, ARC2, ARC4, DES, DES3, PKCS1_v1_5
 from Cryptodome.Hash import HMAC, MD5, SHA, SHA256, SHA384
 from Cryptodome.PublicKey import DSA, RSA
@@ -55,6 +55,11 @@ def pem_get_objects(data):
 
 
 class TLSContext(object):
+    __slots__ = ("name", "handshake", "sequence", "nonce", "random", "session_id", "crypto_ctx", "compression",
+                 "finished_secret", "finished_hashes", "shares", "sym_keystore_history", "asym_keystore", "kex_keystore",
+                 "__sym_keystore", "must_encrypt", "key_generation", "protected_bytes", "key_update_requested")
+    # Keystores kept in sym_keystore_history, each KeyUpdate installs a new one
+    SYM_KEYSTORE_HISTORY_SIZE = 8
 
     def __init__(self, name):
         self.name = name
@@ -68,11 +73,17 @@ class TLSContext(object):
         self.finished_secret = None
         self.finished_hashes = []
         self.shares = []
-        self.sym_keystore_history = []
+        self.sym_keystore_history = deque(maxlen=self.SYM_KEYSTORE_HISTORY_SIZE)
         self.asym_keystore = tlsk.EmptyAsymKeystore()
         self.kex_keystore = tlsk.EmptyKexKeystore()
         self.__sym_keystore = tlsk.EmptySymKeyStore()
         self.must_encrypt = False
+        # TLS 1.3 traffic keys in use, None before, incremented on each KeyUpdate
+        self.key_generation = None
+        # Bytes written under the current keys
+        self.protected_bytes = 0
+        # The peer asked for a KeyUpdate
+        self.key_update_requested = False
 
     @property
     def sym_keystore(self):
@@ -80,7 +91,7 @@ class TLSContext(object):
 
     @sym_keystore.setter
     def sym_keystore(self, value):
-        if value not in self.sym_keystore_history:
+        if not self.sym_keystore_history or self.sym_keystore_history[-1] is not value:
             self.sym_keystore_history.append(value)
         self.__sym_keystore = value
 
@@ -127,30 +138,60 @@ class TLSContext(object):
                                sym_history=flatten_list(self.sym_keystore_history, str))
 
 
-class TLSSessionCtx(object):
+class TLSNegotiated(object):
+    __slots__ = ("ciphersuite", "key_exchange", "encryption", "mac", "compression", "compression_algo", "version", "sig",
+                 "resumption", "early_data")
+
+    def __init__(self):
+        self.ciphersuite = None
+        self.key_exchange = None
+        self.encryption = None
+        self.mac = None
+        self.compression = None
+        self.compression_algo = None
+        self.version = None
+        self.sig = None
+        self.resumption = False
+        self.early_data = False
 
-    def __init__(self, client=True):
+
+class TLSSessionCtx(object):
+    """
+    State of a TLS session, filled by the records inserted. history_policy bounds the records kept in history:
+    HISTORY_ALL keeps them all, HISTORY_HANDSHAKE the handshake records only, HISTORY_NONE none, and an int N a ring
+    buffer of the last N records. Whatever the policy, the handshake records the transcript hashes are computed over
+    are kept apart, in transcript. With a policy other than HISTORY_ALL, they are released once both Finished are
+    processed, handshake hashes cannot be computed anymore.
+    """
+    __slots__ = ("client", "server", "client_ctx", "server_ctx", "history_policy", "history", "transcript",
+                 "requires_iv", "sec_params", "cipher_properties", "negotiated", "ticket", "encrypted_premaster_secret",
+                 "premaster_secret", "master_secret", "group_secret", "early_secrets", "handshake_secrets",
+                 "master_secrets", "resumption_secret", "psk", "psk_ciphersuite", "prf", "__finish_count",
+                 "__ccs_count", "__early_keys")
+    HISTORY_ALL = "all"
+    HISTORY_HANDSHAKE = "handshake"
+    HISTORY_NONE = "none"
+
+    def __init__(self, client=True, history_policy=HISTORY_ALL):
         self.client = client
         self.server = not self.client
         self.client_ctx = TLSContext("Client TLS context")
         self.server_ctx = TLSContext("Server TLS context")
 
         # packet history
-        self.history = []
+        if history_policy in (self.HISTORY_ALL, self.HISTORY_HANDSHAKE, self.HISTORY_NONE):
+            self.history = []
+        elif isinstance(history_policy, (int, long)) and history_policy >= 0:
+            self.history = deque(maxlen=history_policy)
+        else:
+            raise ValueError("Unknown history policy: %r" % (history_policy,))
+        self.history_policy = history_policy
+        # Handshake records, None once released
+        self.transcript = []
         self.requires_iv = False
         self.sec_params = None
         self.cipher_properties = {}
-        self.negotiated = namedtuple("negotiated", ["ciphersuite", "key_exchange", "encryption", "mac", "compression",
-                                                    "compression_algo", "version", "sig", "resumption"])
-        self.negotiated.ciphersuite = None
-        self.negotiated.key_exchange = None
-        self.negotiated.encryption = None
-        self.negotiated.mac = None
-        self.negotiated.compression = None
-        self.negotiated.compression_algo = None
-        self.negotiated.version = None
-        self.negotiated.sig = None
-        self.negotiated.resumption = False
+        self.negotiated = TLSNegotiated()
 
         self.ticket = None
         self.encrypted_premaster_secret = None
@@ -162,11 +203,16 @@ class TLSSessionCtx(object):
         self.handshake_secrets = None
         self.master_secrets = None
         self.resumption_secret = None
+        # TLS 1.3 PSK offered, see resume_psk()
+        self.psk = None
+        self.psk_ciphersuite = None
 
         self.prf = None
 
         self.__finish_count = 0
         self.__ccs_count = 0
+        # Client records are protected under the early traffic keys, until the end of early data
+        self.__early_keys = False
 
     def __str__(self):
         template = """
@@ -178,6 +224,7 @@ TLS Session Context:
     negotiated.mac: {hmac}
     negotiated.compression: {comp}
     negotiated.resumption: {resume}
+    negotiated.early_data: {early_data}
     ticket: {ticket}
     encrypted_premaster_secret: {epms}
     premaster_secret: {pms}
@@ -193,7 +240,7 @@ TLS Session Context:
                                kex=self.negotiated.key_exchange, enc=self.negotiated.encryption,
                                hmac=self.negotiated.mac,
                                comp=tls.TLS_COMPRESSION_METHODS.get(self.negotiated.compression, tls.TLSCompressionMethod.NULL),
-                               resume=self.negotiated.resumption, epms=repr(self.encrypted_premaster_secret),
+                               resume=self.negotiated.resumption, early_data=self.negotiated.early_data, epms=repr(self.encrypted_premaster_secret),
                                pms=repr(self.premaster_secret), ms=repr(self.master_secret), early_secrets=self.early_secrets,
                                handshake_secrets=self.handshake_secrets, master_secrets=self.master_secrets,
                                resumption_secret=repr(self.resumption_secret), client_ctx=self.client_ctx,
@@ -211,8 +258,19 @@ TLS Session Context:
             ps = [pkt]
 
         for pkt in ps:
-            self.history.append(pkt)
+            self.__record(pkt)
             self._process(pkt, origin=origin)
+            # Both Finished processed, the transcript hashes are final
+            if self.__finish_count >= 2 and self.history_policy != self.HISTORY_ALL:
+                self.transcript = None
+
+    def __record(self, pkt):
+        is_handshake = pkt.haslayer(tls.TLSHandshakes)
+        if is_handshake and self.transcript is not None:
+            self.transcript.append(pkt)
+        if self.history_policy == self.HISTORY_NONE or (self.history_policy == self.HISTORY_HANDSHAKE and not is_handshake):
+            return
+        self.history.append(pkt)
 
     def __handle_client_hello(self, client_hello):
         # Update client context with random, session_id and generate a dummy PMS
@@ -221,7 +279,9 @@ TLS Session Context:
         self.client_ctx.random = struct.pack("!I", client_hello.gmt_unix_time) + client_hello.random_bytes
         # This is a TLS 1.3 hello, retrieve and store key shares
         if client_hello.haslayer(tls.TLSExtSupportedVersions):
-            # TODO: If psks are used, initialize the PRF here
+            if self.psk is not None and client_hello.haslayer(tls.TLSClientHelloPreSharedKey) and \
+                    any(extension.type == tls.TLSExtensionType.EARLY_DATA for extension in client_hello.extensions):
+                self.__install_early_keys(client_hello)
             if client_hello.haslayer(tls.TLSClientHelloKeyShare):
                 client_shares = client_hello[tls.TLSClientHelloKeyShare].client_shares
                 for client_share in client_shares:
@@ -260,6 +320,11 @@ TLS Session Context:
 
         self.prf = TLSPRF(self.negotiated.version, self.cipher_properties.get("prf", {}).get("type"))
 
+        if self.negotiated.resumption and self.client_ctx.session_id and \
+                server_hello.session_id != self.client_ctx.session_id:
+            # The server did not accept the session offered, fall back to a full handshake
+            self.negotiated.resumption = False
+            self.master_secret = None
         if self.negotiated.resumption:
             self.sec_params = TLSSecurityParameters.from_master_secret(self.prf,
                                                                        self.negotiated.ciphersuite,
@@ -268,8 +333,38 @@ TLS Session Context:
                                                                        self.server_ctx.random)
             self.__generate_secrets()
 
+    def __install_early_keys(self, client_hello):
+        # 0-RTT: the cipher suite of the PSK protects early data, before the ServerHello negotiates one
+        self.negotiated.version = client_hello[tls.TLSExtSupportedVersions].versions[0]
+        self.negotiated.ciphersuite = self.psk_ciphersuite
+        self.cipher_properties = TLSSecurityParameters.crypto_params[self.psk_ciphersuite]
+        self.prf = TLS13PRF(self.cipher_properties["prf"]["type"])
+        # TLS 1.3 does not use the server random, which is not known yet
+        self.sec_params = TLSSecurityParameters(self.prf, self.psk_ciphersuite, self.client_ctx.random, b"\x00" * 32)
+        self.early_secrets = self.prf.derive_early_secrets(self.psk, self.get_handshake_hash(self.prf.digest, tls.TLSClientHello))
+        early_secrets = self.prf.derive_write_keys(self.early_secrets.client_early_traffic_secret, self.cipher_properties["cipher"])
+        self.client_ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, early_secrets.write_key, iv=early_secrets.write_iv)
+        self.client_ctx.crypto_ctx = CryptoContextFactory(self).new(self.client_ctx)
+        self.client_ctx.must_encrypt = True
+        self.__early_keys = True
+
+    def __install_client_handshake_keys(self):
+        self.__early_keys = False
+        self.client_ctx.sequence = 0
+        self.client_ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.handshake_secrets.client.write_key,
+                                                           iv=self.handshake_secrets.client.write_iv)
+        self.client_ctx.crypto_ctx = CryptoContextFactory(self).new(self.client_ctx)
+        self.client_ctx.must_encrypt = True
+
     def __handle_tls13_server_hello(self, server_hello):
         self.server_ctx.random = server_hello.random
+        prf = TLSSecurityParameters.crypto_params[self.negotiated.ciphersuite].get("prf")
+        if prf is None:
+            raise tls.TLSProtocolError("Trying to use a TLS 1.3 cipher without a defined PRF", response=server_hello)
+        self.prf = TLS13PRF(prf["type"])
+        # The server selects the PSK offered, the only one
+        psk = self.psk if server_hello.haslayer(tls.TLSServerHelloPreSharedKey) else None
+        self.negotiated.resumption = psk is not None
 
         if server_hello.haslayer(tls.TLSServerHelloKeyShare):
             server_share = server_hello[tls.TLSServerHelloKeyShare].server_share
@@ -284,36 +379,43 @@ TLS Session Context:
                         secret_point = ec.ECDH(self.client_ctx.kex_keystore.keys).get_secret(self.server_ctx.kex_keystore.keys)
                     except ValueError as ve:
                         warnings.warn("Did you install a KEX keystore?: %s" % ve)
-                    else:
-                        # PMS is x coordinate of secret
-                        self.group_secret = tlsk.int_to_str(secret_point.x)
-                        prf = TLSSecurityParameters.crypto_params[self.negotiated.ciphersuite].get("prf")
-                        if prf is None:
-                            raise tls.TLSProtocolError("Trying to use a TLS 1.3 cipher without a defined PRF", response=server_hello)
-
-                        self.prf = TLS13PRF(prf["type"])
-                        self.sec_params = TLSSecurityParameters(self.prf, self.negotiated.ciphersuite, self.client_ctx.random, self.server_ctx.random)
-                        cipher = TLSSecurityParameters.crypto_params[self.negotiated.ciphersuite]["cipher"]
-                        self.early_secrets = self.prf.derive_early_secrets(client_hello_hash=self.get_handshake_hash(self.prf.digest, tls.TLSClientHello))
-
-                        self.handshake_secrets = self.prf.derive_handshake_secrets(self.group_secret, self.early_secrets.early_secret,
-                                                                                   self.get_handshake_hash(self.prf.digest, tls.TLSServerHello), cipher)
-                        self.client_ctx.finished_secret = self.prf.derive_finish_secret(self.handshake_secrets.client.secret)
-                        self.server_ctx.finished_secret = self.prf.derive_finish_secret(self.handshake_secrets.server.secret)
-                        self.client_ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.handshake_secrets.client.write_key,
-                                                                           iv=self.handshake_secrets.client.write_iv)
-                        self.server_ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.handshake_secrets.server.write_key,
-                                                                           iv=self.handshake_secrets.server.write_iv)
-                        factory = CryptoContextFactory(self)
-                        self.client_ctx.crypto_ctx = factory.new(self.client_ctx)
-                        self.server_ctx.crypto_ctx = factory.new(self.server_ctx)
-                        self.client_ctx.must_encrypt = True
-                        self.server_ctx.must_encrypt = True
+                        return
+                    # PMS is x coordinate of secret
+                    self.group_secret = tlsk.int_to_str(secret_point.x)
             if not keyshare_match:
                 raise tls.TLSProtocolError("No keyshare match between client and server")
+        # psk_ke, no (EC)DHE
+        elif psk is not None:
+            self.group_secret = b"\x00" * self.prf.digest_size
         else:
             raise tls.TLSProtocolError("TLS 1.3 server hello without KeyShare extension")
 
+        self.sec_params = TLSSecurityParameters(self.prf, self.negotiated.ciphersuite, self.client_ctx.random, self.server_ctx.random)
+        cipher = TLSSecurityParameters.crypto_params[self.negotiated.ciphersuite]["cipher"]
+        self.early_secrets = self.prf.derive_early_secrets(psk, self.get_handshake_hash(self.prf.digest, tls.TLSClientHello))
+        self.handshake_secrets = self.prf.derive_handshake_secrets(self.group_secret, self.early_secrets.early_secret,
+                                                                   self.get_handshake_hash(self.prf.digest, tls.TLSServerHello), cipher)
+        self.client_ctx.finished_secret = self.prf.derive_finish_secret(self.handshake_secrets.client.secret)
+        self.server_ctx.finished_secret = self.prf.derive_finish_secret(self.handshake_secrets.server.secret)
+        self.server_ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.handshake_secrets.server.write_key,
+                                                           iv=self.handshake_secrets.server.write_iv)
+        self.server_ctx.crypto_ctx = CryptoContextFactory(self).new(self.server_ctx)
+        self.server_ctx.must_encrypt = True
+        # Early data is only accepted along the PSK, the client keeps the early keys until the EncryptedExtensions tell
+        if not self.__early_keys or psk is None:
+            self.__install_client_handshake_keys()
+
+    def __handle_encrypted_extensions(self, encrypted_extensions):
+        if self.__early_keys:
+            if any(extension.type == tls.TLSExtensionType.EARLY_DATA for extension in encrypted_extensions.extensions or []):
+                self.negotiated.early_data = True
+            else:
+                self.__install_client_handshake_keys()
+
+    def __handle_end_of_early_data(self):
+        if self.__early_keys:
+            self.__install_client_handshake_keys()
+
     def __handle_server_hello(self, server_hello):
         # Update the server context with random, session_id
         self.server_ctx.handshake = server_hello
@@ -466,6 +568,13 @@ TLS Session Context:
             self.server_ctx.must_encrypt = True
         self.__ccs_count += 1
 
+    def __install_traffic_keys(self, ctx, write_secrets, generation):
+        ctx.sequence = 0
+        ctx.protected_bytes = 0
+        ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, write_secrets.write_key, iv=write_secrets.write_iv)
+        ctx.crypto_ctx = CryptoContextFactory(self).new(ctx)
+        ctx.key_generation = generation
+
     def __handle_finished(self, finished):
         if self.negotiated.version >= tls.TLSVersion.TLS_1_3:
             ctx = self.client_ctx
@@ -476,27 +585,51 @@ TLS Session Context:
                 verify_data = self.derive_server_finished()
                 self.master_secrets = self.prf.derive_traffic_secrets(self.handshake_secrets.handshake_secret, self.get_handshake_hash(self.prf.digest),
                                                                       self.cipher_properties["cipher"])
-                ctx.sequence = 0
-                ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.master_secrets.server.write_key,
-                                                       iv=self.master_secrets.server.write_iv)
+                self.__install_traffic_keys(ctx, self.master_secrets.server, 0)
             # First client finished. Transition to traffic secrets
             elif self.__finish_count == 1:
-                ctx.sequence = 0
-                ctx.sym_keystore = tlsk.CipherKeyStore(self.cipher_properties, self.master_secrets.client.write_key,
-                                                       iv=self.master_secrets.client.write_iv)
+                self.__install_traffic_keys(ctx, self.master_secrets.client, 0)
+                # The PSK of sessions resumed from tickets of this connection
+                self.resumption_secret = self.prf.derive_resumption_secret(self.handshake_secrets.handshake_secret,
+                                                                           self.get_handshake_hash(self.prf.digest))
 
             ctx.finished_hashes.append(finished.data)
             if finished.data != verify_data and finished.data != "":
                 warnings.warn("Finished hash does not match. Wanted %s, got %s" % (repr(verify_data), repr(finished.data)))
         self.__finish_count += 1
 
+    def __handle_key_update(self, key_update, origin):
+        if self.master_secrets is None:
+            warnings.warn("KeyUpdate received before the traffic secrets were derived, keys not updated")
+            return
+        # Without origin, the KeyUpdate was read from the peer
+        if origin is None:
+            origin = "server" if self.client else "client"
+        cipher = self.cipher_properties["cipher"]
+        if origin == "client":
+            ctx, peer_ctx = self.client_ctx, self.server_ctx
+            self.master_secrets.client = self.prf.derive_write_keys(
+                self.prf.derive_update_secret(self.master_secrets.client.secret), cipher)
+            write_secrets = self.master_secrets.client
+        else:
+            ctx, peer_ctx = self.server_ctx, self.client_ctx
+            self.master_secrets.server = self.prf.derive_write_keys(
+                self.prf.derive_update_secret(self.master_secrets.server.secret), cipher)
+            write_secrets = self.master_secrets.server
+        self.__install_traffic_keys(ctx, write_secrets, (ctx.key_generation or 0) + 1)
+        ctx.key_update_requested = False
+        if key_update.request_update == tls.TLSKeyUpdateRequest.UPDATE_REQUESTED:
+            peer_ctx.key_update_requested = True
+
     def __handle_session_ticket(self, handshake):
         if handshake.haslayer(tls.TLSSessionTicket):
             # server provided ticket, lifetime..
             self.ticket = handshake[tls.TLSSessionTicket]
+        elif handshake.haslayer(tls.TLS13SessionTicket):
+            self.ticket = handshake[tls.TLS13SessionTicket]
         elif handshake.haslayer(tls.TLSExtSessionTicketTLS):
-            # client provided raw session ticket
-            self.ticket = tls.TLSSessionTicket(ticket=handshake[tls.TLSExtSessionTicketTLS].data)
+            # client provided raw session ticket. Its lifetime is only known from the NewSessionTicket it came with
+            self.ticket = tls.TLSSessionTicket(lifetime=0, ticket=handshake[tls.TLSExtSessionTicketTLS].data)
 
     def __generate_secrets(self):
         if isinstance(self.client_ctx.sym_keystore, tlsk.EmptySymKeyStore):
@@ -519,6 +652,8 @@ TLS Session Context:
                 self.__handle_client_hello(pkt[tls.TLSClientHello])
             if pkt.haslayer(tls.TLSServerHello):
                 self.__handle_server_hello(pkt[tls.TLSServerHello])
+            if pkt.haslayer(tls.TLSEncryptedExtensions):
+                self.__handle_encrypted_extensions(pkt[tls.TLSEncryptedExtensions])
             if pkt.haslayer(tls.TLSCertificateList):
                 self.__handle_cert_list(pkt[tls.TLSCertificateList])
             if pkt.haslayer(tls.TLSServerKeyExchange):
@@ -527,9 +662,13 @@ TLS Session Context:
                 self.__handle_client_kex(pkt[tls.TLSClientKeyExchange])
             if pkt.haslayer(tls.TLSFinished):
                 self.__handle_finished(pkt[tls.TLSFinished])
+            if pkt.haslayer(tls.TLSKeyUpdate):
+                self.__handle_key_update(pkt[tls.TLSKeyUpdate], origin)
             self.__handle_session_ticket(pkt)
         if pkt.haslayer(tls.TLSChangeCipherSpec):
             self.__handle_ccs(pkt[tls.TLSChangeCipherSpec], origin=origin)
+        if pkt.haslayer(tls.TLSAlert) and pkt[tls.TLSAlert].description == tls.TLSAlertDescription.END_OF_EARLY_DATA:
+            self.__handle_end_of_early_data()
 
     def _generate_random_pms(self, version):
         return "%s%s" % (struct.pack("!H", version), os.urandom(46))
@@ -595,7 +734,9 @@ TLS Session Context:
         return tls.TLSServerDHParams(p=tlsk.int_to_str(dhk.p), g=tlsk.int_to_str(dhk.g), y_s=tlsk.int_to_str(dhk.public), sig=ske_sig)
 
     def _walk_handshake_msgs(self):
-        for pkt in self.history:
+        if self.transcript is None:
+            raise ValueError("Handshake transcript released once the handshake completed, see history_policy")
+        for pkt in self.transcript:
             if pkt.haslayer(tls.TLSHandshakes):
                 for handshake in pkt[tls.TLSHandshakes].handshakes:
                     if not handshake.haslayer(tls.TLSHelloRequest):
@@ -656,7 +797,8 @@ TLS Session Context:
     def get_handshake_hash(self, digest, up_to=None, include=True):
         digest = digest.new()
         for handshake in self._walk_handshake_msgs():
-            if handshake.haslayer(up_to):
+            # Looking for no layer would descend into, and decode, certificates
+            if up_to is not None and handshake.haslayer(up_to):
                 if include:
                     digest.update(str(handshake))
                 break
@@ -705,6 +847,36 @@ TLS Session Context:
         self.master_secret = master_secret
         self.negotiated.resumption = True
 
+    def resume_psk(self, psk, cipher_suite):
+        """ Offers psk, the resumption secret of a TLS 1.3 session negotiated with cipher_suite. negotiated.resumption
+        tells whether the server selected it
+        """
+        self.psk = psk
+        self.psk_ciphersuite = cipher_suite
+        self.negotiated.resumption = True
+
+    def abandon_psk(self):
+        """ Drops the PSK offered, e.g. on a HelloRetryRequest: the ClientHello is sent again without it, in the clear.
+        Early data was discarded
+        """
+        self.psk = None
+        self.psk_ciphersuite = None
+        self.early_secrets = None
+        self.negotiated.resumption = False
+        self.negotiated.early_data = False
+        if self.__early_keys:
+            self.__early_keys = False
+            self.client_ctx.sequence = 0
+            self.client_ctx.sym_keystore = tlsk.EmptySymKeyStore()
+            self.client_ctx.crypto_ctx = None
+            self.client_ctx.must_encrypt = False
+
+    def get_psk_binder(self, truncated_client_hello):
+        """ Returns the binder of the PSK offered over the ClientHello handshake, up to its binders
+        """
+        prf = TLS13PRF(TLSSecurityParameters.crypto_params[self.psk_ciphersuite]["prf"]["type"])
+        return prf.derive_binder(prf.derive_binder_key(self.psk), prf.digest.new(truncated_client_hello).digest())
+
 
 class TLSPRF(object):
     TLS_MD_CLIENT_FINISH_CONST = "client finished"
@@ -854,22 +1026,29 @@ class TLS13PRF(object):
 
     def derive_early_secrets(self, psk=None, client_hello_hash=b"", resumption_psk=True):
         psk = psk or "\x00" * self.digest_size
-        binder_label = TLS13PRF.LABEL_RESUMPTION_PSK_BINDER_KEY if resumption_psk else TLS13PRF.LABEL_EXTERNAL_PSK_BINDER_KEY
         hkdf = HKDF(self.digest).extract(psk)
         if client_hello_hash == b"":
             return TLS13PRF.TLSPRFEarlySecrets(hkdf.prk)
         else:
             return TLS13PRF.TLSPRFEarlySecrets(hkdf.prk,
-                                               self.expand_label(hkdf.prk, binder_label, b""),
+                                               self.derive_binder_key(psk, resumption_psk),
                                                self.expand_label(hkdf.prk, TLS13PRF.LABEL_EARLY_TRAFFIC_SECRET, client_hello_hash),
                                                self.expand_label(hkdf.prk, TLS13PRF.LABEL_EARLY_EXPORTER_MASTER_SECRET, client_hello_hash))
 
+    def derive_binder_key(self, psk, resumption_psk=True):
+        binder_label = TLS13PRF.LABEL_RESUMPTION_PSK_BINDER_KEY if resumption_psk else TLS13PRF.LABEL_EXTERNAL_PSK_BINDER_KEY
+        # Derive-Secret() over no messages, the hash of an empty string
+        return self.expand_label(self.extract(psk), binder_label, self.digest.new().digest())
+
+    def derive_binder(self, binder_key, truncated_hello_hash):
+        return HMAC.new(self.derive_finish_secret(binder_key), truncated_hello_hash, digestmod=self.digest).digest()
+
     def derive_handshake_secrets(self, group_key, early_secret, hellos_hash, cipher):
         hkdf = HKDF(self.digest).extract(group_key, early_secret)
         secrets = []
         for label in [TLS13PRF.LABEL_CLIENT_HANDSHAKE_SECRET, TLS13PRF.LABEL_SERVER_HANDSHAKE_SECRET]:
             secret = self.expand_label(hkdf.prk, label, hellos_hash)
-            write_secrets = self._derive_write_keys(secret, cipher)
+            write_secrets = self.derive_write_keys(secret, cipher)
             secrets.append(write_secrets)
         return TLS13PRF.TLSPRFHandshakeSecrets(hkdf.prk, *secrets)
 
@@ -877,6 +1056,10 @@ class TLS13PRF(object):
         hkdf = HKDF(self.digest).extract(b"\x00" * self.digest_size, handshake_secret)
         return self.expand_label(hkdf.prk, TLS13PRF.LABEL_RESUMPTION_MASTER_SECRET, client_finish_hash)
 
+    def derive_update_secret(self, traffic_secret):
+        # The next generation of an application traffic secret, after a KeyUpdate
+        return self.expand_label(traffic_secret, TLS13PRF.LABEL_UPDATE_TRAFFIC_SECRET, b"")
+
     def derive_finish_secret(self, handshake_secret):
         return self.expand_label(handshake_secret, TLS13PRF.LABEL_FINISHED, b"")
 
@@ -885,12 +1068,12 @@ class TLS13PRF(object):
         secrets = []
         for label in [TLS13PRF.LABEL_CLIENT_TRAFFIC_SECRET, TLS13PRF.LABEL_SERVER_TRAFFIC_SECRET]:
             secret = self.expand_label(hkdf.prk, label, finish_hash)
-            write_secrets = self._derive_write_keys(secret, cipher)
+            write_secrets = self.derive_write_keys(secret, cipher)
             secrets.append(write_secrets)
         exporter_secret = self.expand_label(hkdf.prk, TLS13PRF.LABEL_EXPORTER_MASTER_SECRET, finish_hash)
         return TLS13PRF.TLSPRFTrafficSecrets(hkdf.prk, secrets[0], secrets[1], exporter_secret)
 
-    def _derive_write_keys(self, secret, cipher):
+    def derive_write_keys(self, secret, cipher):
         key = self.expand_label(secret, TLS13PRF.LABEL_WRITE_KEY, b"", cipher["key_len"])
         iv = self.expand_label(secret, TLS13PRF.LABEL_WRITE_IV, b"", cipher["iv_len"])
         return TLS13PRF.TLSPRFWriteSecrets(secret, key, iv)
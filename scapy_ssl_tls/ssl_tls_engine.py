@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import ssl_tls as tls
+import ssl_tls_crypto as tlsc
+
+
+class TLSEngine(object):
+    """
+    Sans-IO TLS endpoint wrapping a TLSSessionCtx, in the spirit of ssl.MemoryBIO: it never touches a socket.
+    feed_incoming() takes bytes received from the peer, in chunks of any size, and returns the records they complete,
+    decrypted. send() takes a packet and returns the bytes to write to the peer. The transport is up to the caller,
+    a blocking socket, an event loop multiplexing thousands of engines, or an in memory loopback.
+
+    start_handshake() and accept_handshake() drive a TLS 1.2 or lower handshake, as client or as RSA server: the
+    handshake messages due in reply to fed records are queued, data_to_send() returns them. A fatal alert received
+    raises TLSProtocolError.
+    """
+    IDLE = "idle"
+    # Client side
+    WAIT_SERVER_HELLO_DONE = "wait_server_hello_done"
+    # Server side
+    WAIT_CLIENT_HELLO = "wait_client_hello"
+    # Both sides
+    WAIT_FINISHED = "wait_finished"
+    ESTABLISHED = "established"
+    FAILED = "failed"
+
+    def __init__(self, client=True, tls_ctx=None):
+        self.client = client
+        self.tls_ctx = tls_ctx if tls_ctx is not None else tlsc.TLSSessionCtx(client)
+        self.ctx = self.tls_ctx.client_ctx if client else self.tls_ctx.server_ctx
+        self.parser = tls.TLSRecordParser(self.tls_ctx, self._origin(outgoing=False))
+        self.compress_hook = None
+        self.pre_encrypt_hook = None
+        self.encrypt_hook = None
+        self.state = self.IDLE
+        self.version = None
+        self._outgoing = []
+        self._certificates = None
+        self._cipher_suite = None
+
+    def _origin(self, outgoing):
+        return "client" if self.client == outgoing else "server"
+
+    @property
+    def handshake_complete(self):
+        return self.state == self.ESTABLISHED
+
+    def send(self, pkt):
+        """ Returns the bytes to write for pkt, encrypted once the session keys are in use
+        """
+        if self.ctx.must_encrypt:
+            data = str(tls.tls_to_raw(pkt, self.tls_ctx, True, self.compress_hook, self.pre_encrypt_hook,
+                                      self.encrypt_hook))
+        else:
+            data = str(pkt)
+        self.tls_ctx.insert(pkt, self._origin(outgoing=True))
+        return data
+
+    def data_to_send(self):
+        """ Returns the bytes queued in reply to fed records, "" if there are none
+        """
+        data = "".join(self._outgoing)
+        del self._outgoing[:]
+        return data
+
+    def feed_incoming(self, data):
+        """ Returns the records completed by data, a partial record is kept for the next call
+        """
+        records = self.parser.feed(data)
+        for record in records:
+            if record.haslayer(tls.TLSAlert) and record[tls.TLSAlert].level == tls.TLSAlertLevel.FATAL:
+                self.state = self.FAILED
+                alert = record[tls.TLSAlert]
+                raise tls.TLSProtocolError("FATAL alert returned by peer: %s" %
+                                           tls.TLS_ALERT_DESCRIPTIONS.get(alert.description, "unknown").upper(),
+                                           tls.TLS(), tls.TLS.from_records(records))
+            self._advance(record)
+        return records
+
+    def start_handshake(self, version, ciphers, extensions=()):
+        """ Client side: returns the ClientHello bytes, the rest of the handshake follows from fed records
+        """
+        self.version = version
+        self.state = self.WAIT_SERVER_HELLO_DONE
+        return self.send(tls.TLSRecord(version=version) /
+                         tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                       tls.TLSClientHello(version=version, cipher_suites=ciphers,
+                                                                          extensions=list(extensions))]))
+
+    def accept_handshake(self, certificates, cipher_suite=None):
+        """ Server side: waits for a ClientHello and answers it presenting certificates, TLSCertificate packets. The
+        RSA key of the first one must be loaded into tls_ctx.server_ctx. The cipher suite is the client's first one
+        unless given
+        """
+        self._certificates = certificates
+        self._cipher_suite = cipher_suite
+        self.state = self.WAIT_CLIENT_HELLO
+
+    def _advance(self, record):
+        if self.state == self.WAIT_SERVER_HELLO_DONE and record.haslayer(tls.TLSHandshakes) and \
+                any(handshake.type == tls.TLSHandshakeType.SERVER_HELLO_DONE
+                    for handshake in record[tls.TLSHandshakes].handshakes):
+            # ServerHelloDone has no body, hence no layer of its own
+            client_key_exchange = tls.TLSRecord(version=self.version) / \
+                tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / self.tls_ctx.get_client_kex_data()])
+            client_ccs = tls.TLSRecord(version=self.version) / tls.TLSChangeCipherSpec()
+            self._outgoing.append(self.send(tls.TLS.from_records([client_key_exchange, client_ccs])))
+            self._send_finished()
+        elif self.state == self.WAIT_CLIENT_HELLO and record.haslayer(tls.TLSClientHello):
+            client_hello = record[tls.TLSClientHello]
+            self.version = client_hello.version
+            cipher_suite = self._cipher_suite if self._cipher_suite is not None else client_hello.cipher_suites[0]
+            self._outgoing.append(self.send(
+                tls.TLSRecord(version=self.version) /
+                tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSServerHello(version=self.version,
+                                                                                      cipher_suite=cipher_suite),
+                                              tls.TLSHandshake() / tls.TLSCertificateList() /
+                                              tls.TLS10Certificate(certificates=self._certificates),
+                                              tls.TLSHandshake(type=tls.TLSHandshakeType.SERVER_HELLO_DONE)])))
+            self.state = self.WAIT_FINISHED
+        elif self.state == self.WAIT_FINISHED and record.haslayer(tls.TLSFinished):
+            if not self.client:
+                self._outgoing.append(self.send(tls.TLSRecord(version=self.version) / tls.TLSChangeCipherSpec()))
+                self._send_finished()
+            self.state = self.ESTABLISHED
+
+    def _send_finished(self):
+        self._outgoing.append(self.send(tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSFinished(data=self.tls_ctx.get_verify_data())])))
+        if self.client:
+            self.state = self.WAIT_FINISHED
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import binascii
+import hashlib
 import math
 import random
 import struct
 import warnings
 
+from collections import OrderedDict
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Util.asn1 import DerSequence
 from scapy.asn1.asn1 import ASN1_SEQUENCE
@@ -13,17 +15,21 @@ import tinyec.ec as ec
 import tinyec.registry as ec_reg
 
 
-def rsa_public_from_der_certificate(certificate):
+def rsa_public_from_der_certificate(certificate, cache=None):
+    # Parsing is done once per distinct certificate, see CertificateCache
+    if cache is None:
+        cache = certificate_cache
+    return cache.get_info(certificate).public
+
+
+def _rsa_public_from_der_certificate(certificate):
     # Extract subject_public_key_info field from X.509 certificate (see RFC3280)
+    # certificate may be raw DER or a scapy.layers.x509 X509_Cert. Walking the DER headers is much
+    # cheaper than going through the ASN.1 tree of the X509_Cert
+    certificate = str(certificate)
     try:
-        # try to extract pubkey from scapy.layers.x509 X509Cert type in case
-        # der_certificate is of type X509Cert
-        # Note: der_certificate may not be of type X509Cert if it wasn't
-        # received completely, in that case, we'll try to extract it anyway
-        # using the old method.
-        # TODO: get rid of the old method and always expect X509Cert obj ?
-        return RSA.importKey(str(certificate.tbsCertificate.subjectPublicKeyInfo))
-    except AttributeError:
+        return RSA.importKey(der_subject_public_key_info(certificate))
+    except (ValueError, IndexError):
         pass
 
     # Fallback method, may pot. allow to extract pubkey from incomplete der streams
@@ -49,6 +55,133 @@ def rsa_public_from_der_certificate(certificate):
     return RSA.importKey(subject_public_key_info)
 
 
+def _der_header(der, offset):
+    # Returns the tag, header length and value length of the DER element starting at offset
+    tag = ord(der[offset])
+    length = ord(der[offset + 1])
+    header_len = 2
+    if length & 0x80:
+        num_bytes = length & 0x7f
+        if num_bytes == 0 or num_bytes > 4:
+            raise ValueError("Unsupported DER length encoding")
+        length = str_to_int(der[offset + header_len:offset + header_len + num_bytes])
+        header_len += num_bytes
+    return tag, header_len, length
+
+
+def der_subject_public_key_info(certificate):
+    """ Returns the DER encoded SubjectPublicKeyInfo of an X.509 certificate, by walking the TLV headers
+    of the certificate. Nothing but the headers up to the public key is decoded.
+    """
+    der = str(certificate)
+    # Certificate ::= SEQUENCE { tbsCertificate TBSCertificate, ... }
+    tag, header_len, _ = _der_header(der, 0)
+    if tag != 0x30:
+        raise ValueError("Certificate is not a DER SEQUENCE")
+    offset = header_len
+    tag, header_len, _ = _der_header(der, offset)
+    if tag != 0x30:
+        raise ValueError("TBSCertificate is not a DER SEQUENCE")
+    offset += header_len
+    # version [0] EXPLICIT is optional
+    tag, header_len, length = _der_header(der, offset)
+    if tag == 0xa0:
+        offset += header_len + length
+    # Skip serialNumber, signature, issuer, validity and subject
+    for _ in range(5):
+        _, header_len, length = _der_header(der, offset)
+        offset += header_len + length
+    tag, header_len, length = _der_header(der, offset)
+    end = offset + header_len + length
+    if tag != 0x30 or end > len(der):
+        raise ValueError("Could not locate SubjectPublicKeyInfo in certificate")
+    return der[offset:end]
+
+
+class LRUCache(object):
+    """ Bounded mapping which evicts the least recently used entry once maxsize is reached
+    """
+
+    def __init__(self, maxsize=1024):
+        if maxsize <= 0:
+            raise ValueError("Cache size must be strictly positive")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Re-insert to mark the entry as most recently used
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CertificateInfo(object):
+    """ Data extracted once from a DER certificate, shared by everyone seeing the same certificate
+    """
+
+    def __init__(self, fingerprint, public):
+        self.fingerprint = fingerprint
+        self.public = public
+        self.size = nb_bits(public.n)
+
+    def __str__(self):
+        template = """Certificate info:
+            fingerprint: {fingerprint}
+            size: {size}
+            public: {public}"""
+        return template.format(fingerprint=binascii.hexlify(self.fingerprint), size=self.size, public=self.public)
+
+
+class CertificateCache(LRUCache):
+    """ Content addressed cache of parsed certificates, keyed by the SHA-256 digest of the DER encoding
+    """
+
+    def __init__(self, maxsize=4096):
+        super(CertificateCache, self).__init__(maxsize)
+
+    @staticmethod
+    def fingerprint(certificate):
+        return hashlib.sha256(str(certificate)).digest()
+
+    def get_info(self, certificate):
+        fingerprint = self.fingerprint(certificate)
+        info = self.get(fingerprint)
+        if info is None:
+            info = CertificateInfo(fingerprint, _rsa_public_from_der_certificate(certificate))
+            self.set(fingerprint, info)
+        return info
+
+
+certificate_cache = CertificateCache()
+
+
 def rsa_public_from_pem_certificate(certificate):
     return rsa_public_from_der_certificate(pem_to_der(certificate))
 
@@ -154,8 +287,8 @@ class RSAKeystore(AsymKeyStore):
         super(RSAKeystore, self).__init__("RSA Keystore", public, private)
 
     @classmethod
-    def from_der_certificate(cls, certificate):
-        public = rsa_public_from_der_certificate(certificate)
+    def from_der_certificate(cls, certificate, cache=None):
+        public = rsa_public_from_der_certificate(certificate, cache)
         keystore = cls(public)
         keystore.certificate = certificate
         return keystore
@@ -246,6 +379,12 @@ class ECDHKeyStore(KexKeyStore):
     def from_keypair(cls, curve, keypair):
         return cls(curve, keypair.pub, keypair.priv)
 
+    @classmethod
+    def new_keypair(cls, curve, private=None):
+        if private is None:
+            return cls.from_keypair(curve, ec.make_keypair(curve))
+        return cls.from_keypair(curve, ec.Keypair(curve, private))
+
     def __str__(self):
         template = """{name}:
             curve: {curve}
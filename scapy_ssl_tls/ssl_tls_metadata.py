@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import csv
+import json
+import struct
+
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import ssl_tls as tls
+import ssl_tls_keystore as tlsk
+
+
+def _version_name(version):
+    return tls.TLS_VERSIONS.get(version, "0x%04x" % version)
+
+
+def _cipher_name(cipher):
+    return tls.TLS_CIPHER_SUITES.get(cipher, "0x%04x" % cipher)
+
+
+def _text(data):
+    # Peer supplied names are not guaranteed to be valid UTF-8
+    return data.decode("utf-8", "replace").encode("utf-8")
+
+
+class HandshakeMetadata(object):
+    """
+    What can be learnt from the cleartext part of one TLS handshake. List fields are empty and scalar fields None
+    when not seen, e.g. the certificate of a TLS 1.3 or resumed handshake.
+    """
+    FIELDS = ("first_seen", "last_seen", "client_ip", "client_port", "server_ip", "server_port",
+              "versions_offered", "version", "sni", "alpn_offered", "alpn", "ciphers_offered", "cipher",
+              "cert_sha256", "alerts")
+    LIST_FIELDS = ("versions_offered", "alpn_offered", "ciphers_offered", "alerts")
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name, [] if name in self.LIST_FIELDS else None))
+
+    def as_dict(self):
+        return OrderedDict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def __repr__(self):
+        return "<HandshakeMetadata %s>" % " ".join("%s=%r" % item for item in self.as_dict().items())
+
+
+class HandshakeExtractor(object):
+    """
+    Metadata only extraction: builds one HandshakeMetadata per flow from its reassembled records, without session
+    contexts. Only cleartext handshake and alert records are dissected, records following a ChangeCipherSpec or
+    application data are recognized by their header alone, and no packet or record is kept. Handshake messages
+    fragmented over several records are reassembled per direction before being dissected.
+
+    handle_record() is a record handler for FlowTable.reassemble() consumers or ShardedPipeline, handle_evict() its
+    on_evict counterpart, which returns the metadata of a flow when it is evicted.
+    """
+    # Longer handshake messages are not buffered, the direction is taken for encrypted and not dissected further
+    MAX_HANDSHAKE_LENGTH = 2 ** 18
+
+    def handle_record(self, flow, source, record):
+        metadata = flow.info.get("handshake")
+        if metadata is None:
+            metadata = flow.info["handshake"] = HandshakeMetadata()
+            flow.info["encrypted"] = set()
+            flow.info["fragments"] = {}
+        encrypted = flow.info["encrypted"]
+        content_type = ord(record[0])
+        if source in encrypted or content_type in (tls.TLSContentType.CHANGE_CIPHER_SPEC,
+                                                   tls.TLSContentType.APPLICATION_DATA):
+            # TLS 1.3 disguises its encrypted handshake as application data
+            encrypted.add(source)
+            if content_type == tls.TLSContentType.ALERT:
+                metadata.alerts.append("encrypted")
+            return ()
+        if content_type == tls.TLSContentType.HANDSHAKE:
+            for message in self._handshake_messages(flow, source, record[5:]):
+                self._extract(flow, source, tls.TLSHandshake(message), metadata)
+        else:
+            self._extract(flow, source, tls.SSL(record), metadata)
+        return ()
+
+    def _handshake_messages(self, flow, source, fragment):
+        """ Returns the handshake messages completed by fragment, a trailing partial message is kept for the next
+        handshake record of source
+        """
+        fragments = flow.info["fragments"]
+        data = fragments.pop(source, "") + fragment
+        messages = []
+        pos = 0
+        while len(data) - pos >= 4:
+            length = struct.unpack("!I", "\x00" + data[pos + 1:pos + 4])[0]
+            if length > self.MAX_HANDSHAKE_LENGTH:
+                flow.info["encrypted"].add(source)
+                return messages
+            if len(data) - pos < 4 + length:
+                break
+            messages.append(data[pos:pos + 4 + length])
+            pos += 4 + length
+        if pos < len(data):
+            fragments[source] = data[pos:]
+        return messages
+
+    def _extract(self, flow, source, p_ssl, metadata):
+        if p_ssl.haslayer(tls.TLSClientHello):
+            flow.set_client(source)
+            hello = p_ssl[tls.TLSClientHello]
+            versions = hello.getlayer(tls.TLSExtSupportedVersions)
+            metadata.versions_offered = [_version_name(version) for version in
+                                         (versions.versions if versions is not None else [hello.version])]
+            metadata.ciphers_offered = [_cipher_name(cipher) for cipher in hello.cipher_suites]
+            sni = hello.getlayer(tls.TLSExtServerNameIndication)
+            if sni is not None and sni.server_names:
+                metadata.sni = _text(sni.server_names[0].data)
+            alpn = hello.getlayer(tls.TLSExtALPN)
+            if alpn is not None:
+                metadata.alpn_offered = [_text(protocol.data) for protocol in alpn.protocol_name_list]
+        elif p_ssl.haslayer(tls.SSLv2ClientHello):
+            flow.set_client(source)
+            hello = p_ssl[tls.SSLv2ClientHello]
+            metadata.versions_offered = [_version_name(hello.version)]
+            metadata.ciphers_offered = [tls.SSLv2_CIPHER_SUITES.get(cipher, "0x%06x" % cipher)
+                                        for cipher in hello.cipher_suites]
+        if p_ssl.haslayer(tls.TLSServerHello):
+            hello = p_ssl[tls.TLSServerHello]
+            versions = hello.getlayer(tls.TLSExtSupportedVersions)
+            metadata.version = _version_name(versions.versions[0] if versions is not None and versions.versions
+                                             else hello.version)
+            metadata.cipher = _cipher_name(hello.cipher_suite)
+            alpn = hello.getlayer(tls.TLSExtALPN)
+            if alpn is not None and alpn.protocol_name_list:
+                metadata.alpn = _text(alpn.protocol_name_list[0].data)
+        if metadata.cert_sha256 is None:
+            certificate = p_ssl.getlayer(tls.TLSCertificate)
+            if certificate is not None:
+                metadata.cert_sha256 = tlsk.CertificateCache.fingerprint(certificate.data).encode("hex")
+            else:
+                certificate = p_ssl.getlayer(tls.TLSCertificateEntry)
+                if certificate is not None:
+                    metadata.cert_sha256 = tlsk.CertificateCache.fingerprint(certificate.cert_data).encode("hex")
+        for alert in p_ssl.records if p_ssl.haslayer(tls.TLSAlert) else ():
+            if alert.haslayer(tls.TLSAlert):
+                alert = alert[tls.TLSAlert]
+                metadata.alerts.append("%s:%s" % (tls.TLS_ALERT_LEVELS.get(alert.level, alert.level),
+                                                  tls.TLS_ALERT_DESCRIPTIONS.get(alert.description,
+                                                                                 alert.description)))
+
+    def handle_evict(self, flow, reason):
+        metadata = flow.info.get("handshake")
+        if metadata is None:
+            return ()
+        metadata.first_seen = flow.first_seen
+        metadata.last_seen = flow.last_seen
+        metadata.client_ip, metadata.client_port = flow.client
+        metadata.server_ip, metadata.server_port = flow.server
+        return [metadata]
+
+
+class MetadataWriter(object):
+    """
+    Buffers HandshakeMetadata and writes it to fileobj batch_size lines at a time. flush() or close() writes what is
+    left, the writer can be used as a context manager.
+    """
+
+    def __init__(self, fileobj, batch_size=1024):
+        self.fileobj = fileobj
+        self.batch_size = batch_size
+        self.lines = []
+        self.written = 0
+
+    def format(self, metadata):
+        raise NotImplementedError()
+
+    def write(self, metadata):
+        self.lines.append(self.format(metadata))
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+
+    def writeall(self, metadatas):
+        for metadata in metadatas:
+            self.write(metadata)
+
+    def flush(self):
+        if self.lines:
+            self.fileobj.write("".join(self.lines))
+            self.written += len(self.lines)
+            del self.lines[:]
+        self.fileobj.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class NDJSONWriter(MetadataWriter):
+    """ One JSON object per line
+    """
+
+    def format(self, metadata):
+        return json.dumps(metadata.as_dict(), separators=(",", ":")) + "\n"
+
+
+class CSVWriter(MetadataWriter):
+    """ CSV with a header line, list fields are joined with separator
+    """
+
+    def __init__(self, fileobj, batch_size=1024, separator=";"):
+        super(CSVWriter, self).__init__(fileobj, batch_size)
+        self.separator = separator
+        self.buffer = StringIO()
+        self.csv = csv.writer(self.buffer, lineterminator="\n")
+        self.fileobj.write(self._format_row(HandshakeMetadata.FIELDS))
+
+    def _format_row(self, row):
+        self.csv.writerow(row)
+        line = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return line
+
+    def format(self, metadata):
+        return self._format_row([self.separator.join(value) if name in HandshakeMetadata.LIST_FIELDS else value
+                                 for name, value in metadata.as_dict().items()])
@@ -0,0 +1,425 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import multiprocessing
+import Queue
+import socket
+import struct
+import time
+import traceback
+import zlib
+
+from collections import OrderedDict
+
+import ssl_tls_stream as tlss
+
+from scapy.config import conf
+from scapy.utils import RawPcapNgReader
+
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = (12, 14, 101)
+DLT_LINUX_SLL = 113
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+ETH_P_VLAN = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+# Large enough for segments captured with TCP segmentation offload
+MAX_CAPTURE_LEN = 2 ** 18
+
+
+def iter_pcap(pcap):
+    """ Streams (linktype, timestamp, raw_bytes) tuples out of a pcap or pcapng file, one packet at a time
+    """
+    reader = RawPcapNgReader(pcap)
+    try:
+        while True:
+            packet = reader.read_packet(size=MAX_CAPTURE_LEN)
+            if packet is None:
+                break
+            data, meta = packet
+            if hasattr(meta, "tsresol"):
+                timestamp = ((meta.tshigh or 0) << 32 | (meta.tslow or 0)) / float(meta.tsresol)
+                yield meta.linktype, timestamp, data
+            else:
+                timestamp = meta.sec + (1e-9 if reader.nano else 1e-6) * meta.usec
+                yield reader.linktype, timestamp, data
+    finally:
+        reader.close()
+
+
+def decode_packets(raw_packets):
+    """ Lazily dissects (linktype, timestamp, raw_bytes) tuples into scapy packets
+    """
+    for linktype, timestamp, data in raw_packets:
+        pkt = conf.l2types[linktype](data)
+        pkt.time = timestamp
+        yield pkt
+
+
+class ProgressMeter(object):
+    """
+    Wraps a stream of (linktype, timestamp, raw_bytes) tuples and calls report(meter) at most every interval
+    seconds, and once at the end. total, if known, is the expected number of bytes (e.g. the capture file size).
+    """
+
+    def __init__(self, report, total=None, interval=1.0, clock=time.time):
+        self.report = report
+        self.total = total
+        self.interval = interval
+        self.clock = clock
+        self.bytes = 0
+        self.packets = 0
+        self.started = None
+        self.now = None
+
+    def __call__(self, raw_packets):
+        self.started = self.now = self.clock()
+        next_report = self.started + self.interval
+        for packet in raw_packets:
+            self.bytes += len(packet[2])
+            self.packets += 1
+            yield packet
+            self.now = self.clock()
+            if self.now >= next_report:
+                self.report(self)
+                next_report = self.now + self.interval
+        self.now = self.clock()
+        self.report(self)
+
+    @property
+    def elapsed(self):
+        return (self.now or 0) - (self.started or 0)
+
+    @property
+    def rate(self):
+        """ Bytes per second
+        """
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        done = " (%d%%)" % (100 * self.bytes // self.total) if self.total else ""
+        return "%.1f MB%s read in %.1fs, %.2f MB/s, %d packets" % (self.bytes / 1e6, done, self.elapsed,
+                                                                   self.rate / 1e6, self.packets)
+
+
+def _ip_offset(linktype, data):
+    # Returns the offset of the IP header in a link layer frame, None if there is none
+    if linktype == DLT_EN10MB:
+        offset = 12
+        ethertype, = struct.unpack_from("!H", data, offset)
+        while ethertype in ETH_P_VLAN:
+            offset += 4
+            ethertype, = struct.unpack_from("!H", data, offset)
+        return offset + 2 if ethertype in (ETH_P_IP, ETH_P_IPV6) else None
+    elif linktype in DLT_RAW:
+        return 0
+    elif linktype == DLT_LINUX_SLL:
+        ethertype, = struct.unpack_from("!H", data, 14)
+        return 16 if ethertype in (ETH_P_IP, ETH_P_IPV6) else None
+    elif linktype == DLT_NULL:
+        return 4
+    return None
+
+
+def raw_tcp_segment(linktype, data):
+    """ Locates the TCP segment of a captured packet without dissecting it. Returns (source, destination, seq, flags,
+    payload_start, payload_end), source and destination being (packed address, port), and payload_end excluding
+    link layer padding. Returns None for anything but TCP over IPv4/IPv6 (IPv6 extension headers and non first IP
+    fragments included).
+    """
+    try:
+        offset = _ip_offset(linktype, data)
+        if offset is None:
+            return None
+        version = ord(data[offset]) >> 4
+        if version == 4:
+            ihl = (ord(data[offset]) & 0x0f) * 4
+            length, frag, proto = struct.unpack_from("!2xH2xHxB", data, offset)
+            if proto != IPPROTO_TCP or frag & 0x1fff:
+                return None
+            src, dst = data[offset + 12:offset + 16], data[offset + 16:offset + 20]
+            end = offset + length
+            offset += ihl
+        elif version == 6:
+            length, next_header = struct.unpack_from("!4xHB", data, offset)
+            if next_header != IPPROTO_TCP:
+                return None
+            src, dst = data[offset + 8:offset + 24], data[offset + 24:offset + 40]
+            offset += 40
+            end = offset + length
+        else:
+            return None
+        sport, dport, seq, data_offset, flags = struct.unpack_from("!HHI4xBB", data, offset)
+    except (IndexError, struct.error):
+        return None
+    # Captures of TSO segments may carry a zero IP length
+    end = min(end, len(data)) if end > offset else len(data)
+    return (src, sport), (dst, dport), seq, flags, offset + (data_offset >> 4) * 4, end
+
+
+def raw_flow_key(linktype, data):
+    """ Extracts the direction independent ((address, port), (address, port)) key of a TCP packet straight from
+    the captured bytes, without dissecting it. Addresses are packed. Returns None for anything but TCP over
+    IPv4/IPv6, see raw_tcp_segment().
+    """
+    segment = raw_tcp_segment(linktype, data)
+    return None if segment is None else tuple(sorted(segment[:2]))
+
+
+def address_text(address):
+    """ Packed IPv4 or IPv6 address to text, as used by FlowTable
+    """
+    return socket.inet_ntoa(address) if len(address) == 4 else socket.inet_ntop(socket.AF_INET6, address)
+
+
+class TLSPreFilter(object):
+    """
+    Drops packets that can't contribute to a TLS record before they are dissected. Pure ACKs are dropped, and so
+    is the payload of flows that haven't started with a plausible TLS or SSLv2 record header yet, whatever their
+    ports. FIN and RST segments are always kept, the flow table tracks connections with them. SYN segments are kept
+    for flows already seen to carry TLS only: a flow may start with a plaintext preamble, e.g. STARTTLS, whose
+    dropped payload would leave a gap in the stream after the SYN. Without it, the flow table picks the flow up at
+    the first record.
+
+    Flows seen to carry TLS are remembered, at most max_flows of them, least recently seen first out.
+    """
+    KEEP_FLAGS = tlss.TCPFlags.SYN | tlss.TCPFlags.FIN | tlss.TCPFlags.RST
+
+    def __init__(self, max_flows=2 ** 18):
+        self.max_flows = max_flows
+        self.tls_flows = OrderedDict()
+        self.passed = 0
+        self.dropped = 0
+
+    def accept_segment(self, data, segment):
+        """ Filters a packet already located with raw_tcp_segment()
+        """
+        source, destination, _, flags, start, end = segment
+        key = tuple(sorted((source, destination)))
+        if start >= end:
+            accept = bool(flags & self.KEEP_FLAGS) and (not flags & tlss.TCPFlags.SYN or key in self.tls_flows)
+        elif self.tls_flows.pop(key, None):
+            self.tls_flows[key] = True
+            accept = True
+        else:
+            accept = tlss.looks_like_tls(bytearray(data[start:min(end, start + tlss.TLS_RECORD_HEADER_LEN)]))
+            if accept:
+                self.tls_flows[key] = True
+                if len(self.tls_flows) > self.max_flows:
+                    self.tls_flows.popitem(last=False)
+        if accept:
+            self.passed += 1
+        else:
+            self.dropped += 1
+        return accept
+
+    def accept(self, linktype, data):
+        """ Returns whether a raw packet may carry TLS, non TCP packets are dropped
+        """
+        segment = raw_tcp_segment(linktype, data)
+        if segment is None:
+            self.dropped += 1
+            return False
+        return self.accept_segment(data, segment)
+
+    def __call__(self, raw_packets):
+        """ Filters a stream of (linktype, timestamp, raw_bytes) tuples
+        """
+        for packet in raw_packets:
+            if self.accept(packet[0], packet[2]):
+                yield packet
+
+
+def shard_of(key, shards):
+    """ Maps a flow key to a shard, identically in every process
+    """
+    (addr1, port1), (addr2, port2) = key
+    return (zlib.crc32(struct.pack("!%dsH%dsH" % (len(addr1), len(addr2)), addr1, port1, addr2, port2))
+            & 0xffffffff) % shards
+
+
+class ShardWorker(object):
+    """
+    Single threaded processing of the flows of one shard. TCP segments are located in the raw packets, reassembled
+    in a FlowTable, and each TLS record is passed to handler(flow, source, record), which returns an iterable of
+    results. on_evict(flow, reason), if set, also returns an iterable of results, e.g. to emit per flow summaries.
+    Packets are never dissected by scapy, handlers dissect the records they are interested in.
+    """
+
+    def __init__(self, handler, on_evict=None, **flow_table_args):
+        self.handler = handler
+        self.results = []
+        if on_evict is not None:
+            flow_table_args["on_evict"] = lambda flow, reason: self.results.extend(on_evict(flow, reason) or ())
+        self.flows = tlss.FlowTable(**flow_table_args)
+        self.packets = 0
+
+    def process(self, batch):
+        self.packets += len(batch)
+        for linktype, timestamp, data in batch:
+            segment = raw_tcp_segment(linktype, data)
+            if segment is None:
+                continue
+            (src, sport), (dst, dport), seq, flags, start, end = segment
+            source = address_text(src), sport
+            flow, records = self.flows.feed(source, (address_text(dst), dport), seq, data[start:end], flags,
+                                            timestamp)
+            for record in records:
+                self.results.extend(self.handler(flow, source, record) or ())
+            self.flows.expire(timestamp)
+        return self.pop_results()
+
+    def flush(self):
+        self.flows.flush()
+        return self.pop_results()
+
+    def pop_results(self):
+        results, self.results = self.results, []
+        return results
+
+
+def _shard_worker_main(index, worker, inbox, outbox):
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            results = worker.process(batch)
+            if results:
+                outbox.put((ShardedPipeline.MSG_RESULTS, index, results))
+        outbox.put((ShardedPipeline.MSG_RESULTS, index, worker.flush()))
+        outbox.put((ShardedPipeline.MSG_DONE, index, worker.packets))
+    except Exception:
+        outbox.put((ShardedPipeline.MSG_ERROR, index, traceback.format_exc()))
+
+
+class ShardedPipeline(object):
+    """
+    Spreads the analysis of a capture over worker processes. Each packet's 4-tuple is hashed to one of the workers,
+    so a flow is always handled by the same ShardWorker and stays single threaded and ordered, while the capture as
+    a whole is processed by all cores. Results of all workers are merged into one output stream, in order per flow.
+
+    handler, on_evict and the FlowTable arguments (ctx_factory, idle_timeout, ...) are handed to each ShardWorker.
+    With workers=0, everything runs in the calling process. Unless prefilter is False, packets that can't carry TLS
+    are dropped by a TLSPreFilter before they are dispatched, see filtered.
+    """
+    MSG_RESULTS = "results"
+    MSG_DONE = "done"
+    MSG_ERROR = "error"
+
+    def __init__(self, handler, workers=None, batch_size=256, queue_size=16, on_evict=None, prefilter=True,
+                 **flow_table_args):
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.handler = handler
+        self.on_evict = on_evict
+        self.flow_table_args = flow_table_args
+        self.prefilter = TLSPreFilter() if prefilter else None
+        self.packets = 0
+        self.skipped = 0
+        self.filtered = 0
+
+    def _new_worker(self):
+        return ShardWorker(self.handler, self.on_evict, **self.flow_table_args)
+
+    def _flow_packets(self, packets):
+        for packet in packets:
+            self.packets += 1
+            segment = raw_tcp_segment(packet[0], packet[2])
+            if segment is None:
+                self.skipped += 1
+                continue
+            if self.prefilter is not None and not self.prefilter.accept_segment(packet[2], segment):
+                self.filtered += 1
+                continue
+            yield tuple(sorted(segment[:2])), packet
+
+    def _run_inline(self, packets):
+        worker = self._new_worker()
+        batch = []
+        for _, packet in self._flow_packets(packets):
+            batch.append(packet)
+            if len(batch) >= self.batch_size:
+                for result in worker.process(batch):
+                    yield result
+                batch = []
+        for result in worker.process(batch) + worker.flush():
+            yield result
+
+    def _read(self, outbox, timeout=None):
+        # Returns the results of one message, None if there is nothing to read
+        try:
+            msg, index, payload = outbox.get(timeout is not None, timeout)
+        except Queue.Empty:
+            return None
+        if msg == self.MSG_ERROR:
+            raise RuntimeError("Shard worker %d failed:\n%s" % (index, payload))
+        if msg == self.MSG_DONE:
+            self._done += 1
+            return []
+        return payload
+
+    def _put(self, inbox, outbox, batch):
+        # Keep draining results while a worker's inbox is full, so neither side can stall the other
+        while True:
+            try:
+                inbox.put(batch, timeout=0.05)
+                break
+            except Queue.Full:
+                results = self._read(outbox)
+                while results is not None:
+                    for result in results:
+                        yield result
+                    results = self._read(outbox)
+
+    def run(self, packets):
+        """ Processes (linktype, timestamp, raw_bytes) tuples, see iter_pcap(). Yields handler results
+        """
+        if self.workers <= 0:
+            for result in self._run_inline(packets):
+                yield result
+            return
+        outbox = multiprocessing.Queue()
+        inboxes = [multiprocessing.Queue(self.queue_size) for _ in range(self.workers)]
+        procs = [multiprocessing.Process(target=_shard_worker_main, args=(index, self._new_worker(), inbox, outbox))
+                 for index, inbox in enumerate(inboxes)]
+        self._done = 0
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        try:
+            batches = [[] for _ in range(self.workers)]
+            for key, packet in self._flow_packets(packets):
+                index = shard_of(key, self.workers)
+                batches[index].append(packet)
+                if len(batches[index]) >= self.batch_size:
+                    for result in self._put(inboxes[index], outbox, batches[index]):
+                        yield result
+                    batches[index] = []
+            for index, inbox in enumerate(inboxes):
+                if batches[index]:
+                    for result in self._put(inbox, outbox, batches[index]):
+                        yield result
+                for result in self._put(inbox, outbox, None):
+                    yield result
+            while self._done < self.workers:
+                results = self._read(outbox, 1)
+                if results is None:
+                    crashed = [proc.exitcode for proc in procs if proc.exitcode]
+                    if crashed:
+                        raise RuntimeError("Shard worker exited with code %d" % crashed[0])
+                    continue
+                for result in results:
+                    yield result
+        finally:
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join()
+
+    def run_pcap(self, pcap):
+        return self.run(iter_pcap(pcap))
@@ -0,0 +1,684 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import errno
+import heapq
+import itertools
+import socket
+import struct
+import threading
+import time
+import Queue
+
+from collections import deque, OrderedDict
+
+import tinyec.registry as ec_reg
+
+import ssl_tls as tls
+import ssl_tls_keystore as tlsk
+import ssl_tls_stream as tlss
+
+TLS_CONTENT_TYPE_ALERT = 0x15
+TLS_CONTENT_TYPE_HANDSHAKE = 0x16
+TLS_HANDSHAKE_SERVER_HELLO = 0x02
+TLS_HANDSHAKE_HELLO_RETRY_REQUEST = 0x06
+TLS_HANDSHAKE_SERVER_HELLO_DONE = 0x0e
+TLS_VERSION_1_3 = 0x0304
+# Signalling values, not suites a server can select
+SCSV_CIPHER_SUITES = (0x00ff, 0x5600)
+
+
+class ScanJob(object):
+    """ One probe of a target: probe(*args) runs in a worker thread, its return value ends up in result, or the
+    exception it raised in error
+    """
+    __slots__ = ["target", "probe", "args", "priority", "callback", "result", "error", "started", "finished"]
+
+    def __init__(self, target, probe, args=(), priority=0, callback=None):
+        self.target = target
+        self.probe = probe
+        self.args = args
+        self.priority = priority
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def host(self):
+        return self.target[0]
+
+    def run(self, clock=time.time):
+        self.started = clock()
+        try:
+            self.result = self.probe(*self.args)
+        except Exception as e:
+            self.error = e
+        self.finished = clock()
+
+    def __repr__(self):
+        return "<ScanJob %s:%d %s priority=%d>" % (self.target + (getattr(self.probe, "__name__", self.probe),
+                                                                  self.priority))
+
+
+class _HostState(object):
+    __slots__ = ["active", "next_start", "deferred"]
+
+    def __init__(self):
+        self.active = 0
+        self.next_start = 0
+        self.deferred = []
+
+
+class ScanScheduler(object):
+    """
+    Runs probe jobs against many targets at once. Jobs are started by priority (lowest first, then submission
+    order) on a pool of worker threads, subject to per host limits: at most per_host jobs run against the same
+    host at a time, and, if host_rate is set, at most host_rate jobs per second are started against it. Jobs
+    held back by the limits of their host don't block jobs for other hosts.
+
+    submit() may be called at any time, from any thread, including from running probes. run() yields the finished
+    jobs, until none is left. Callbacks of successful jobs are invoked in the thread iterating run(), which makes
+    them the place to aggregate per target results without locking.
+    """
+
+    def __init__(self, workers=32, per_host=4, host_rate=None, clock=time.time):
+        self.workers = workers
+        self.per_host = per_host
+        self.host_rate = host_rate
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._queue = []
+        self._hosts = {}
+        self._blocked = set()
+        self._finished = []
+        self._running = 0
+        self._seq = itertools.count()
+        self._ready = Queue.Queue()
+
+    def submit(self, target, probe, args=(), priority=0, callback=None):
+        job = ScanJob(target, probe, args, priority, callback)
+        with self._cond:
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def __len__(self):
+        """ Jobs not finished yet
+        """
+        with self._cond:
+            return (len(self._queue) + self._running +
+                    sum(len(self._hosts[host].deferred) for host in self._blocked))
+
+    def _capacity(self, host, now):
+        if host.active >= self.per_host:
+            return 0
+        if self.host_rate:
+            return 1 if host.next_start <= now else 0
+        return self.per_host - host.active
+
+    def _start(self, job, host, now):
+        host.active += 1
+        if self.host_rate:
+            host.next_start = max(host.next_start, now) + 1.0 / self.host_rate
+        self._running += 1
+        self._ready.put(job)
+
+    def _dispatch(self, now):
+        # Hosts that got capacity back requeue their best held back jobs
+        for name in list(self._blocked):
+            host = self._hosts[name]
+            for _ in range(min(self._capacity(host, now), len(host.deferred))):
+                heapq.heappush(self._queue, heapq.heappop(host.deferred))
+            if not host.deferred:
+                self._blocked.discard(name)
+        while self._running < self.workers and self._queue:
+            item = heapq.heappop(self._queue)
+            job = item[2]
+            host = self._hosts.get(job.host)
+            if host is None:
+                host = self._hosts[job.host] = _HostState()
+            if self._capacity(host, now):
+                self._start(job, host, now)
+            else:
+                heapq.heappush(host.deferred, item)
+                self._blocked.add(job.host)
+
+    def _wait_timeout(self, now):
+        # Time until a rate limited host may start its next job, None if only a finished job can unblock one
+        if not self.host_rate:
+            return None
+        starts = [self._hosts[name].next_start for name in self._blocked
+                  if self._hosts[name].active < self.per_host]
+        return max(0, min(starts) - now) if starts else None
+
+    def _finish(self, job):
+        host = self._hosts[job.host]
+        host.active -= 1
+        self._running -= 1
+        if not host.active and not host.deferred and host.next_start <= self.clock():
+            del self._hosts[job.host]
+            self._blocked.discard(job.host)
+
+    def _worker(self):
+        while True:
+            job = self._ready.get()
+            if job is None:
+                break
+            job.run(self.clock)
+            with self._cond:
+                self._finished.append(job)
+                self._cond.notify()
+
+    def run(self):
+        """ Runs all submitted jobs, and the jobs they submit, yielding each job when it is finished
+        """
+        threads = [threading.Thread(target=self._worker, name="scan-worker-%d" % i) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                with self._cond:
+                    finished, self._finished = self._finished, []
+                    for job in finished:
+                        self._finish(job)
+                    now = self.clock()
+                    self._dispatch(now)
+                    if not finished:
+                        if not (self._running or self._queue or self._blocked):
+                            break
+                        self._cond.wait(self._wait_timeout(now))
+                        continue
+                for job in finished:
+                    if job.error is None and job.callback is not None:
+                        job.callback(job.result)
+                    yield job
+        finally:
+            for _ in threads:
+                self._ready.put(None)
+            for thread in threads:
+                thread.join()
+
+
+def flight_complete(records):
+    """ Whether raw records, as read from a server, hold its complete first flight: an alert, a SSLv2 record, a
+    ServerHelloDone, a HelloRetryRequest, or a TLS 1.3 ServerHello, as the rest of that flight is encrypted.
+    Handshake messages may span records.
+    """
+    for record in records:
+        content_type = ord(record[0])
+        if content_type == TLS_CONTENT_TYPE_ALERT or content_type & 0x80:
+            return True
+    for msg_type, body in tlss.handshake_messages(records):
+        if msg_type in (TLS_HANDSHAKE_SERVER_HELLO_DONE, TLS_HANDSHAKE_HELLO_RETRY_REQUEST):
+            return True
+        if msg_type == TLS_HANDSHAKE_SERVER_HELLO and len(body) >= 2 and \
+                (ord(body[0]) << 8 | ord(body[1])) >= TLS_VERSION_1_3:
+            return True
+    return False
+
+
+def starttls_preamble(command):
+    """ Preamble sending command, e.g. "STARTTLS\\r\\n", and waiting for the first line of the response
+    """
+    yield command.replace("\\r", "\r").replace("\\n", "\n")
+    response = ""
+    while "\n" not in response:
+        response += (yield None)
+
+
+def smtp_starttls_preamble(hostname="localhost"):
+    """ SMTP preamble: waits for the banner and the EHLO response, then negotiates STARTTLS
+    """
+    for command in (None, "EHLO %s\r\n" % hostname, "STARTTLS\r\n"):
+        if command is not None:
+            yield command
+        response = ""
+        # The last line of a multiline reply has a space after the status code
+        while not any(line[3:4] == " " for line in response.split("\r\n")):
+            response += (yield None)
+        if not response.startswith("2"):
+            raise ValueError("SMTP server refused: %r" % response)
+
+
+class ProbeConnection(object):
+    """ One non blocking probe: connect, run the preamble, send the probe, read length framed records
+    """
+    __slots__ = ["target", "family", "address", "probe", "preamble", "callback", "complete", "sock", "state", "out",
+                 "buffer", "records", "error", "deadline"]
+    CONNECTING = "connecting"
+    PREAMBLE = "preamble"
+    SENDING = "sending"
+    READING = "reading"
+    DONE = "done"
+
+    def __init__(self, target, probe, preamble=None, callback=None, complete=flight_complete):
+        self.target = target
+        self.family = None
+        self.address = None
+        self.probe = probe
+        self.preamble = preamble
+        self.callback = callback
+        self.complete = complete
+        self.sock = None
+        self.state = None
+        self.out = ""
+        self.buffer = bytearray()
+        self.records = []
+        self.error = None
+        self.deadline = None
+
+    @property
+    def host(self):
+        return self.target[0]
+
+    @property
+    def response(self):
+        """ The raw records read, concatenated, ready for SSL()
+        """
+        return "".join(self.records)
+
+    def __repr__(self):
+        return "<ProbeConnection %s:%d %s records=%d error=%r>" % (self.target + (self.state, len(self.records),
+                                                                                 self.error))
+
+
+class ProbeReactor(object):
+    """
+    Runs many probe connections at once from a single thread, with non blocking sockets multiplexed by poll().
+    No thread is held by an in flight probe, so thousands of them can run in one process.
+
+    A probe is a pre serialized string, e.g. str(TLSRecord(...)), sent once connected and once the optional
+    preamble completed. The response is read and split into records by their length, until complete(records)
+    holds (see flight_complete()), the peer closes the connection or timeout seconds passed since the connection
+    started. A timeout with records read is not an error, as servers often keep quiet after their first flight.
+
+    A preamble, e.g. for STARTTLS, is a generator: yielding a string sends it, yielding None waits for data, which
+    the yield evaluates to. At most max_connections probes are in flight, and at most per_host against the same
+    host. submit() is thread safe, it resolves the target host, so that the reactor never blocks on DNS. run()
+    yields each finished ProbeConnection, after its callback, if any, was called with it. A probe whose host could
+    not be resolved, or whose socket could not be created, e.g. out of file descriptors, finishes with the error.
+    """
+
+    def __init__(self, max_connections=1024, per_host=None, timeout=5.0, clock=time.time):
+        self.max_connections = max_connections
+        self.per_host = per_host or max_connections
+        self.timeout = timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._failed = []
+        self._active = {}
+        self._per_host = {}
+
+    def submit(self, target, probe, preamble=None, callback=None, complete=flight_complete):
+        conn = ProbeConnection(target, str(probe), preamble, callback, complete)
+        try:
+            conn.family, _, _, _, conn.address = socket.getaddrinfo(target[0], target[1], 0, socket.SOCK_STREAM)[0]
+        except socket.error as se:
+            conn.error = se
+            conn.state = ProbeConnection.DONE
+            with self._lock:
+                self._failed.append(conn)
+            return conn
+        with self._lock:
+            queue = self._pending.get(conn.host)
+            if queue is None:
+                queue = self._pending[conn.host] = deque()
+            queue.append(conn)
+        return conn
+
+    def __len__(self):
+        with self._lock:
+            return len(self._active) + len(self._failed) + sum(len(queue) for queue in self._pending.values())
+
+    def _start_pending(self, poller, now):
+        with self._lock:
+            for host in list(self._pending):
+                if len(self._active) >= self.max_connections:
+                    break
+                queue = self._pending[host]
+                while queue and self._per_host.get(host, 0) < self.per_host and \
+                        len(self._active) < self.max_connections:
+                    self._connect(queue.popleft(), poller, now)
+                if queue:
+                    # Round robin, hosts that could not start all their probes go last
+                    self._pending[host] = self._pending.pop(host)
+                else:
+                    del self._pending[host]
+
+    def _connect(self, conn, poller, now):
+        conn.deadline = now + self.timeout
+        conn.state = ProbeConnection.CONNECTING
+        try:
+            conn.sock = socket.socket(conn.family, socket.SOCK_STREAM)
+        except socket.error as se:
+            conn.error = se
+            conn.state = ProbeConnection.DONE
+            self._failed.append(conn)
+            return
+        conn.sock.setblocking(0)
+        self._active[conn.sock.fileno()] = conn
+        self._per_host[conn.host] = self._per_host.get(conn.host, 0) + 1
+        err = conn.sock.connect_ex(conn.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            conn.error = socket.error(err, errno.errorcode.get(err, "connect failed"))
+            conn.state = ProbeConnection.DONE
+        else:
+            poller.register(conn.sock.fileno(), tlss.Poller.WRITE)
+
+    def _finish(self, conn, poller, error=None):
+        fd = conn.sock.fileno()
+        poller.unregister(fd)
+        del self._active[fd]
+        self._per_host[conn.host] -= 1
+        if not self._per_host[conn.host]:
+            del self._per_host[conn.host]
+        conn.sock.close()
+        if error is not None and not (isinstance(error, socket.timeout) and conn.records):
+            conn.error = error
+        conn.state = ProbeConnection.DONE
+
+    def _advance_preamble(self, conn, poller, data=None):
+        # Drives the preamble generator until it sends, waits for data, or is done
+        try:
+            step = next(conn.preamble) if data is None and conn.state != ProbeConnection.PREAMBLE \
+                else conn.preamble.send(data)
+        except StopIteration:
+            self._send(conn, poller, conn.probe)
+            return
+        conn.state = ProbeConnection.PREAMBLE
+        if step is None:
+            poller.register(conn.sock.fileno(), tlss.Poller.READ)
+        else:
+            conn.out = step
+            poller.register(conn.sock.fileno(), tlss.Poller.WRITE)
+
+    def _send(self, conn, poller, data):
+        conn.state = ProbeConnection.SENDING
+        conn.out = data
+        poller.register(conn.sock.fileno(), tlss.Poller.WRITE)
+
+    def _on_writable(self, conn, poller):
+        if conn.state == ProbeConnection.CONNECTING:
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, "connect failed"))
+            if conn.preamble is not None:
+                self._advance_preamble(conn, poller)
+            else:
+                self._send(conn, poller, conn.probe)
+            return
+        sent = conn.sock.send(conn.out)
+        conn.out = conn.out[sent:]
+        if conn.out:
+            return
+        if conn.state == ProbeConnection.PREAMBLE:
+            self._advance_preamble(conn, poller, None)
+        else:
+            conn.state = ProbeConnection.READING
+            poller.register(conn.sock.fileno(), tlss.Poller.READ)
+
+    def _on_readable(self, conn, poller):
+        data = conn.sock.recv(65536)
+        if not data:
+            if conn.state == ProbeConnection.PREAMBLE or not conn.records:
+                raise socket.error(errno.ECONNRESET, "Connection closed by peer")
+            self._finish(conn, poller)
+            return
+        if conn.state == ProbeConnection.PREAMBLE:
+            self._advance_preamble(conn, poller, data)
+            return
+        conn.buffer.extend(data)
+        while True:
+            length = tlss.tls_record_length(conn.buffer)
+            if length is None or length > len(conn.buffer):
+                break
+            conn.records.append(str(conn.buffer[:length]))
+            del conn.buffer[:length]
+        if conn.complete(conn.records):
+            self._finish(conn, poller)
+
+    def run(self):
+        """ Runs all submitted probes, and the probes submitted meanwhile, yielding each when it is finished
+        """
+        poller = tlss.Poller()
+        try:
+            while True:
+                now = self.clock()
+                self._start_pending(poller, now)
+                finished = [conn for conn in self._active.values() if conn.state == ProbeConnection.DONE]
+                for conn in finished:
+                    self._finish(conn, poller)
+                with self._lock:
+                    finished.extend(self._failed)
+                    del self._failed[:]
+                for conn in self._active.values():
+                    if conn.deadline <= now:
+                        self._finish(conn, poller, socket.timeout("timed out while %s" % conn.state))
+                        finished.append(conn)
+                if not finished and not self._active:
+                    with self._lock:
+                        if not self._pending:
+                            break
+                    continue
+                if not finished:
+                    timeout = max(0, min(conn.deadline for conn in self._active.values()) - now)
+                    for fd in poller.poll(timeout):
+                        conn = self._active.get(fd)
+                        if conn is None:
+                            continue
+                        try:
+                            if conn.state in (ProbeConnection.CONNECTING, ProbeConnection.SENDING) or \
+                                    (conn.state == ProbeConnection.PREAMBLE and conn.out):
+                                self._on_writable(conn, poller)
+                            else:
+                                self._on_readable(conn, poller)
+                        except (socket.error, ValueError) as e:
+                            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                continue
+                            self._finish(conn, poller, e)
+                        if conn.state == ProbeConnection.DONE:
+                            finished.append(conn)
+                for conn in finished:
+                    if conn.callback is not None:
+                        conn.callback(conn)
+                    yield conn
+        finally:
+            for conn in self._active.values():
+                conn.sock.close()
+            self._active.clear()
+            self._per_host.clear()
+
+
+class ClientHelloTemplate(object):
+    """
+    A ClientHello record serialized once, from which probes are built by patching its bytes: build() replaces the
+    version, random, cipher suites, compression methods or extensions and fixes up the length fields, which is three
+    orders of magnitude faster than building and serializing a scapy packet per probe. Probes dissect as usual.
+
+    The template defaults to TLSRecord() / TLSHandshakes(handshakes=[TLSHandshake() / TLSClientHello()]), any such
+    record holding a single ClientHello will do.
+    """
+    # Offsets within the record: record version, record length, handshake type and length, hello version, random
+    RECORD_VERSION = 1
+    RECORD_LENGTH = 3
+    HANDSHAKE = 5
+    VERSION = 9
+    RANDOM = 11
+    SESSION_ID = 43
+
+    def __init__(self, pkt=None):
+        if pkt is None:
+            pkt = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello()])
+        data = str(pkt)
+        if len(data) < self.SESSION_ID + 1 or ord(data[0]) != TLS_CONTENT_TYPE_HANDSHAKE or \
+                ord(data[self.HANDSHAKE]) != tls.TLSHandshakeType.CLIENT_HELLO or \
+                struct.unpack("!H", data[self.RECORD_LENGTH:self.HANDSHAKE])[0] != len(data) - self.HANDSHAKE:
+            raise ValueError("Template must be a record holding a single ClientHello")
+        ciphers = self.SESSION_ID + 1 + ord(data[self.SESSION_ID])
+        compressions = ciphers + 2 + struct.unpack("!H", data[ciphers:ciphers + 2])[0]
+        extensions = compressions + 1 + ord(data[compressions])
+        self.head = bytearray(data[:ciphers])
+        self.cipher_suites = data[ciphers:compressions]
+        self.compression_methods = data[compressions:extensions]
+        self.extensions = data[extensions:]
+
+    def build(self, version=None, record_version=None, random=None, cipher_suites=None, compression_methods=None,
+              extensions=None):
+        """ Returns the serialized record. extensions are TLSExtension packets or their serialized form
+        """
+        head = bytearray(self.head)
+        if record_version is not None:
+            struct.pack_into("!H", head, self.RECORD_VERSION, record_version)
+        if version is not None:
+            struct.pack_into("!H", head, self.VERSION, version)
+        if random is not None:
+            if len(random) != 32:
+                raise ValueError("Random must be 32 bytes long")
+            head[self.RANDOM:self.SESSION_ID] = random
+        ciphers = self.cipher_suites if cipher_suites is None else \
+            struct.pack("!H%dH" % len(cipher_suites), 2 * len(cipher_suites), *cipher_suites)
+        compressions = self.compression_methods if compression_methods is None else \
+            struct.pack("!B%dB" % len(compression_methods), len(compression_methods), *compression_methods)
+        if extensions is None:
+            exts = self.extensions
+        else:
+            exts = "".join(str(extension) for extension in extensions)
+            # Like scapy, no extensions length at all without extensions
+            exts = struct.pack("!H", len(exts)) + exts if exts else ""
+        length = len(head) + len(ciphers) + len(compressions) + len(exts) - self.HANDSHAKE
+        struct.pack_into("!H", head, self.RECORD_LENGTH, length)
+        # The handshake length is 24 bits, packed with the handshake type
+        struct.pack_into("!I", head, self.HANDSHAKE, tls.TLSHandshakeType.CLIENT_HELLO << 24 | length - 4)
+        return "".join((str(head), ciphers, compressions, exts))
+
+
+# ClientHellos offering many suites need the extensions servers require before selecting ECC suites
+_CIPHER_SUITES_HELLO = ClientHelloTemplate(
+    tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello(
+        extensions=[tls.TLSExtension() / tls.TLSExtSupportedGroups(),
+                    tls.TLSExtension() / tls.TLSExtECPointsFormat()])]))
+
+
+def cipher_suites_hello(version, cipher_suites):
+    """ A serialized ClientHello record offering cipher_suites
+    """
+    return _CIPHER_SUITES_HELLO.build(version=version, record_version=version, cipher_suites=cipher_suites)
+
+
+_KEY_SHARES = {}
+
+
+def key_share_entry(group):
+    """ A key share of group, generated once per group: probes never complete the handshake, they need no fresh key
+    """
+    entry = _KEY_SHARES.get(group)
+    if entry is None:
+        keystore = tlsk.ECDHKeyStore.new_keypair(ec_reg.get_curve(tls.TLS_SUPPORTED_GROUPS[group]))
+        entry = _KEY_SHARES[group] = tls.TLSKeyShareEntry(named_group=group,
+                                                          key_exchange=tlsk.point_to_ansi_str(keystore.public))
+    return entry
+
+
+def tls13_hello(version, cipher_suites, groups=(tls.TLSSupportedGroup.SECP256R1,)):
+    """ A serialized TLS 1.3 ClientHello record offering version, e.g. tls_draft_version(18), with a key share of
+    each of groups, see KeyShareCache.predict()
+    """
+    extensions = [tls.TLSExtension() / tls.TLSExtSupportedVersions(versions=[version]),
+                  tls.TLSExtension() / tls.TLSExtSupportedGroups(),
+                  tls.TLSExtension() / tls.TLSExtSignatureAlgorithms(),
+                  tls.TLSExtension() / tls.TLSExtKeyShare() / tls.TLSClientHelloKeyShare(
+                      client_shares=[key_share_entry(group) for group in groups])]
+    return _CIPHER_SUITES_HELLO.build(version=tls.TLSVersion.TLS_1_2, record_version=tls.TLSVersion.TLS_1_0,
+                                      cipher_suites=cipher_suites, extensions=extensions)
+
+
+class CipherSuiteEnumeration(object):
+    """
+    Finds the cipher suites a server accepts for one protocol version by elimination: all candidates are offered,
+    the suite the server selects is removed and the rest offered again, until the server refuses. This takes one
+    connection per accepted suite plus one, rather than one per candidate.
+
+    accepted lists the suites in the order they were selected. A last probe offers them reversed: if the server
+    still selects the same suite, it enforces its own preference, server_preference is True and accepted is its
+    preference order. Candidates default to all known suites but TLS 1.3 and signalling ones, as TLS 1.3 suites are
+    negotiated through extensions.
+
+    The probes run on a ProbeReactor, see start(). on_response, if given, is called with each dissected response,
+    and on_done with the enumeration once it is done. preamble_factory returns a new preamble per connection.
+    """
+
+    def __init__(self, target, version, candidates=None, preamble_factory=None, on_response=None, on_done=None):
+        self.target = target
+        self.version = version
+        if candidates is None:
+            candidates = sorted(cipher for cipher in tls.TLS_CIPHER_SUITES
+                                if cipher not in SCSV_CIPHER_SUITES and cipher >> 8 != 0x13)
+        self.remaining = list(candidates)
+        self.preamble_factory = preamble_factory
+        self.on_response = on_response
+        self.on_done = on_done
+        self.accepted = []
+        self.server_preference = None
+        self.connections = 0
+        self.error = None
+        self.done = False
+        self._reactor = None
+
+    def start(self, reactor):
+        self._reactor = reactor
+        self._probe(list(self.remaining), self._on_selected)
+        return self
+
+    def _probe(self, cipher_suites, callback):
+        self.connections += 1
+        preamble = self.preamble_factory() if self.preamble_factory is not None else None
+        self._reactor.submit(self.target, cipher_suites_hello(self.version, cipher_suites), preamble=preamble,
+                             callback=lambda conn: callback(conn, cipher_suites))
+
+    def _selected(self, conn, offered):
+        # The suite the server selected from offered for this version, None if it refused
+        if not conn.records:
+            if self.error is None:
+                self.error = conn.error
+            return None
+        response = tls.SSL(conn.response)
+        if self.on_response is not None:
+            self.on_response(response)
+        hello = response.getlayer(tls.TLSServerHello)
+        if hello is None or hello.version != self.version or hello.cipher_suite not in offered:
+            return None
+        return hello.cipher_suite
+
+    def _on_selected(self, conn, offered):
+        cipher = self._selected(conn, offered)
+        if cipher is not None:
+            self.accepted.append(cipher)
+            self.remaining.remove(cipher)
+            if self.remaining:
+                self._probe(list(self.remaining), self._on_selected)
+                return
+        if len(self.accepted) > 1:
+            self._probe(self.accepted[::-1], self._on_reversed)
+        else:
+            self._finish()
+
+    def _on_reversed(self, conn, offered):
+        cipher = self._selected(conn, offered)
+        if cipher is not None:
+            self.server_preference = cipher == self.accepted[0]
+        self._finish()
+
+    def _finish(self):
+        self.done = True
+        self._reactor = None
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def __repr__(self):
+        return "<CipherSuiteEnumeration %s:%d version=0x%04x accepted=%d server_preference=%r>" % (
+            self.target + (self.version, len(self.accepted), self.server_preference))
@@ -0,0 +1,360 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import os
+import struct
+import time
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Hash import HMAC, SHA256
+from Cryptodome.Util import Padding
+
+import ssl_tls as tls
+import ssl_tls_keystore as tlsk
+
+
+class TLSSession(object):
+    """
+    What is needed to resume a TLS 1.2 or lower session, by session_id or ticket, or a TLS 1.3 one, by ticket. The
+    master_secret of a TLS 1.3 session is its PSK, the resumption secret. Its ticket was issued at issued, its age is
+    obfuscated by age_add, and max_early_data_size bytes of early data may be sent along it.
+    """
+    __slots__ = ("session_id", "ticket", "master_secret", "cipher_suite", "version", "expires", "issued", "age_add",
+                 "max_early_data_size")
+
+    def __init__(self, session_id="", ticket="", master_secret=None, cipher_suite=None, version=None, expires=None,
+                 issued=None, age_add=0, max_early_data_size=0):
+        self.session_id = session_id
+        self.ticket = ticket
+        self.master_secret = master_secret
+        self.cipher_suite = cipher_suite
+        self.version = version
+        self.expires = expires
+        self.issued = issued
+        self.age_add = age_add
+        self.max_early_data_size = max_early_data_size
+
+    @classmethod
+    def from_ctx(cls, tls_ctx, expires=None, issued=None):
+        """ Returns the session negotiated in tls_ctx, None if it cannot be resumed
+        """
+        ticket = tls_ctx.ticket.ticket if tls_ctx.ticket is not None else ""
+        if tls_ctx.negotiated.version >= tls.TLSVersion.TLS_1_3:
+            if tls_ctx.resumption_secret is None or not isinstance(tls_ctx.ticket, tls.TLS13SessionTicket):
+                return None
+            early_data_info = tls_ctx.ticket.getlayer(tls.TLSExtTicketEarlyDataInfo)
+            return cls("", ticket, tls_ctx.resumption_secret, tls_ctx.negotiated.ciphersuite, tls_ctx.negotiated.version,
+                       expires, issued, tls_ctx.ticket.age_add,
+                       early_data_info.max_early_data_size if early_data_info is not None else 0)
+        session_id = tls_ctx.server_ctx.session_id or ""
+        if tls_ctx.master_secret is None or not (session_id or ticket):
+            return None
+        return cls(session_id, ticket, tls_ctx.master_secret, tls_ctx.negotiated.ciphersuite, tls_ctx.negotiated.version,
+                   expires)
+
+    def obfuscated_ticket_age(self, now):
+        """ The age of the ticket in milliseconds, as sent in a TLS 1.3 PreSharedKey extension
+        """
+        return (int((now - self.issued) * 1000) + self.age_add) % 2 ** 32
+
+    def __repr__(self):
+        return "<TLSSession %s id=%s ticket=%d bytes>" % (tls.TLS_CIPHER_SUITES.get(self.cipher_suite, self.cipher_suite),
+                                                         self.session_id.encode("hex"), len(self.ticket))
+
+
+def server_name(extensions):
+    """ Returns the first host name of the SNI extension in extensions, None without one
+    """
+    for extension in extensions:
+        if extension.haslayer(tls.TLSExtServerNameIndication):
+            server_names = extension[tls.TLSExtServerNameIndication].server_names
+            if server_names:
+                return server_names[0].data
+    return None
+
+
+class ClientSessionCache(object):
+    """
+    Client side sessions by (host, port, SNI), bounded to maxsize sessions, least recently used first evicted. A
+    session expires after lifetime seconds, or earlier when its ticket lifetime hint is shorter.
+    """
+
+    def __init__(self, maxsize=1024, lifetime=7200, clock=time.time):
+        self.lifetime = lifetime
+        self.clock = clock
+        self._sessions = tlsk.LRUCache(maxsize)
+
+    def get(self, host, port, sni=None):
+        session = self._sessions.get((host, port, sni))
+        if session is not None and session.expires <= self.clock():
+            self._sessions.pop((host, port, sni))
+            return None
+        return session
+
+    def set(self, host, port, sni, session):
+        self._sessions.set((host, port, sni), session)
+
+    def pop(self, host, port, sni=None):
+        return self._sessions.pop((host, port, sni))
+
+    def update(self, host, port, sni, tls_ctx):
+        """ Stores the session negotiated in tls_ctx, returns it, None if it cannot be resumed. A TLS 1.3 session is
+        only known once the server sent a NewSessionTicket, after the handshake. A session resumed as is, without a
+        new ticket, keeps its expiry
+        """
+        lifetime = self.lifetime
+        if tls_ctx.ticket is not None and tls_ctx.ticket.ticket and tls_ctx.ticket.lifetime:
+            lifetime = min(lifetime, tls_ctx.ticket.lifetime)
+        now = self.clock()
+        session = TLSSession.from_ctx(tls_ctx, now + lifetime, now)
+        if session is None:
+            self._sessions.pop((host, port, sni))
+            return None
+        cached = self._sessions.get((host, port, sni))
+        if tls_ctx.negotiated.resumption and cached is not None and \
+                (cached.master_secret, cached.ticket) == (session.master_secret, session.ticket):
+            session.expires, session.issued = cached.expires, cached.issued
+        self.set(host, port, sni, session)
+        return session
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class KeyShareCache(object):
+    """
+    The group each server selected for its TLS 1.3 key exchange, by (host, port), so that later ClientHellos only
+    send a key share of that group instead of paying a HelloRetryRequest round trip for a wrong guess. Bounded to
+    maxsize servers, least recently used first evicted, a group is forgotten lifetime seconds after it was learnt.
+    """
+
+    def __init__(self, maxsize=1024, lifetime=3600, clock=time.time):
+        self.lifetime = lifetime
+        self.clock = clock
+        self._groups = tlsk.LRUCache(maxsize)
+
+    def get(self, host, port):
+        entry = self._groups.get((host, port))
+        if entry is None:
+            return None
+        group, expires = entry
+        if expires <= self.clock():
+            self._groups.pop((host, port))
+            return None
+        return group
+
+    def set(self, host, port, group):
+        self._groups.set((host, port), (group, self.clock() + self.lifetime))
+
+    def pop(self, host, port):
+        entry = self._groups.pop((host, port))
+        return entry[0] if entry is not None else None
+
+    def update(self, host, port, resp):
+        """ Learns the group selected in resp, a response opening with a ServerHello or HelloRetryRequest, returns it,
+        None if it has no key share
+        """
+        group = tls.tls13_selected_group(resp)
+        if group is not None:
+            self.set(host, port, group)
+        return group
+
+    def predict(self, host, port, groups):
+        """ Returns the groups to send a key share of to host: the one it selected last if known, groups otherwise.
+        No key share is sent when groups is empty, as with psk_ke
+        """
+        group = self.get(host, port)
+        if group is None or not groups:
+            return groups
+        return (group,)
+
+    def __len__(self):
+        return len(self._groups)
+
+
+def tls_do_cached_handshake(tls_socket, cache, version, ciphers, extensions=[], ke_modes=(tls.TLSPSKKeyExchangeMode.PSK_DHE_KE,),
+                            early_data=None, key_share_cache=None):
+    """
+    tls_do_handshake() resuming the session cached for the peer and SNI of tls_socket, if any, in an abbreviated
+    handshake when the server accepts it. A SessionTicket extension is always offered, the session negotiated is
+    cached. A ticket is offered along a random session_id, which the server echoes when it accepts the ticket
+    (RFC5077 3.4).
+    For TLS 1.3, see tls13_do_cached_handshake(), ke_modes, early_data and key_share_cache only apply there.
+    """
+    if version >= tls.TLSVersion.TLS_1_3:
+        return tls13_do_cached_handshake(tls_socket, cache, version, ciphers, extensions, ke_modes, early_data,
+                                         key_share_cache)
+    host, port = tls_socket.getpeername()[:2]
+    sni = server_name(extensions)
+    session = cache.get(host, port, sni)
+    extensions = [extension for extension in extensions if not extension.haslayer(tls.TLSExtSessionTicketTLS)]
+    session_id = ""
+    if session is None or session.version != version:
+        extensions.append(tls.TLSExtension() / tls.TLSExtSessionTicketTLS(data=""))
+    else:
+        tls_socket.tls_ctx.resume_session(session.master_secret)
+        session_id = session.session_id or os.urandom(32)
+        extensions.append(tls.TLSExtension() / tls.TLSExtSessionTicketTLS(data=session.ticket))
+        if session.cipher_suite not in ciphers:
+            ciphers = [session.cipher_suite] + list(ciphers)
+    try:
+        resp = tls.tls_do_handshake(tls_socket, version, ciphers, extensions, session_id)
+    except tls.TLSProtocolError:
+        cache.pop(host, port, sni)
+        raise
+    cache.update(host, port, sni, tls_socket.tls_ctx)
+    return resp
+
+
+def tls13_do_cached_handshake(tls_socket, cache, version, ciphers, extensions=[],
+                              ke_modes=(tls.TLSPSKKeyExchangeMode.PSK_DHE_KE,), early_data=None, key_share_cache=None):
+    """
+    tls13_do_handshake() offering the PSK of the session cached for the peer and SNI of tls_socket, if any, with the
+    key exchange modes ke_modes. With psk_ke only, no key share is sent. early_data is sent in 0-RTT if the ticket
+    allows for it, tls_ctx.negotiated.early_data tells whether the server accepted it. key_share_cache, a
+    KeyShareCache, predicts the group of the key share.
+    A ticket is only offered once. The server sends new ones after the handshake, pass tls_socket.tls_ctx to
+    cache.update() once one was received.
+    """
+    host, port = tls_socket.getpeername()[:2]
+    sni = server_name(extensions)
+    session = cache.pop(host, port, sni)
+    groups = (tls.TLSSupportedGroup.SECP256R1,)
+    if session is None or session.expires <= cache.clock() or session.version != version:
+        early_data = None
+    else:
+        tls_socket.tls_ctx.resume_psk(session.master_secret, session.cipher_suite)
+        if ke_modes == (tls.TLSPSKKeyExchangeMode.PSK_KE,):
+            groups = ()
+        if session.cipher_suite not in ciphers:
+            ciphers = [session.cipher_suite] + list(ciphers)
+        if early_data is not None and len(early_data) > session.max_early_data_size:
+            early_data = None
+        extensions = list(extensions) + [
+            tls.TLSExtension() / tls.TLSExtPSKKeyExchangeModes(ke_modes=list(ke_modes)),
+            tls.tls13_pre_shared_key(session.ticket, session.obfuscated_ticket_age(cache.clock()), len(session.master_secret))]
+    return tls.tls13_do_handshake(tls_socket, version, ciphers, extensions, groups, early_data, key_share_cache)
+
+
+class ServerSessionStore(object):
+    """
+    Server side sessions by session_id, bounded to maxsize sessions, least recently used first evicted, and expiring
+    lifetime seconds after they were stored.
+    """
+
+    def __init__(self, maxsize=1024, lifetime=7200, clock=time.time):
+        self.lifetime = lifetime
+        self.clock = clock
+        self._sessions = tlsk.LRUCache(maxsize)
+
+    @staticmethod
+    def new_session_id():
+        return os.urandom(32)
+
+    def get(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is not None and session.expires <= self.clock():
+            self._sessions.pop(session_id)
+            return None
+        return session
+
+    def store(self, session_id, tls_ctx):
+        """ Stores the session negotiated in tls_ctx under session_id, returns it
+        """
+        session = TLSSession(session_id, "", tls_ctx.master_secret, tls_ctx.negotiated.ciphersuite,
+                             tls_ctx.negotiated.version, self.clock() + self.lifetime)
+        self._sessions.set(session_id, session)
+        return session
+
+    def pop(self, session_id):
+        return self._sessions.pop(session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class TicketKeys(object):
+    """
+    Seals session state into stateless tickets (RFC5077 4): key_name | IV | AES-128-CBC(state) | HMAC-SHA256 over
+    the former. A new key is used for tickets issued rotate_interval seconds after the current one was created, older
+    keys are kept to open tickets until lifetime seconds passed since they were retired.
+    """
+    KEY_NAME_LEN = 16
+    IV_LEN = 16
+    MAC_LEN = 32
+    # version, cipher suite, issue time, master secret
+    STATE = struct.Struct("!HHQ48s")
+
+    def __init__(self, lifetime=7200, rotate_interval=3600, clock=time.time):
+        self.lifetime = lifetime
+        self.rotate_interval = rotate_interval
+        self.clock = clock
+        # (key name, aes key, hmac key, created, retired)
+        self._keys = []
+        self.rotate()
+
+    def rotate(self):
+        now = self.clock()
+        if self._keys:
+            name, aes_key, hmac_key, created, _ = self._keys[0]
+            self._keys[0] = (name, aes_key, hmac_key, created, now)
+        self._keys.insert(0, (os.urandom(self.KEY_NAME_LEN), os.urandom(16), os.urandom(32), now, None))
+        self._keys = [key for key in self._keys if key[4] is None or key[4] + self.lifetime > now]
+
+    def seal(self, session):
+        """ Returns the ticket for session
+        """
+        if self._keys[0][3] + self.rotate_interval <= self.clock():
+            self.rotate()
+        name, aes_key, hmac_key, _, _ = self._keys[0]
+        iv = os.urandom(self.IV_LEN)
+        state = self.STATE.pack(session.version, session.cipher_suite, int(self.clock()), session.master_secret)
+        sealed = name + iv + AES.new(aes_key, AES.MODE_CBC, iv).encrypt(Padding.pad(state, AES.block_size))
+        return sealed + HMAC.new(hmac_key, sealed, digestmod=SHA256).digest()
+
+    def open(self, ticket):
+        """ Returns the TLSSession sealed in ticket, None if the ticket is not ours, was tampered with or expired
+        """
+        if len(ticket) < self.KEY_NAME_LEN + self.IV_LEN + AES.block_size + self.MAC_LEN:
+            return None
+        for name, aes_key, hmac_key, _, _ in self._keys:
+            if ticket.startswith(name):
+                break
+        else:
+            return None
+        sealed, mac = ticket[:-self.MAC_LEN], ticket[-self.MAC_LEN:]
+        iv = sealed[self.KEY_NAME_LEN:self.KEY_NAME_LEN + self.IV_LEN]
+        try:
+            # Constant time comparison
+            HMAC.new(hmac_key, sealed, digestmod=SHA256).verify(mac)
+            state = Padding.unpad(AES.new(aes_key, AES.MODE_CBC, iv).decrypt(sealed[self.KEY_NAME_LEN + self.IV_LEN:]),
+                                  AES.block_size)
+            version, cipher_suite, issued, master_secret = self.STATE.unpack(state)
+        except (ValueError, struct.error):
+            return None
+        if issued + self.lifetime <= self.clock():
+            return None
+        return TLSSession("", ticket, master_secret, cipher_suite, version, issued + self.lifetime)
+
+
+def offers_ticket(client_hello):
+    """ Whether client_hello has a SessionTicket extension, an empty one has no TLSExtSessionTicketTLS layer
+    """
+    return any(extension.type == tls.TLSExtensionType.SESSIONTICKET_TLS for extension in client_hello.extensions or [])
+
+
+def find_session(client_hello, session_store=None, ticket_keys=None):
+    """ Returns the session a ClientHello offers to resume and the server knows of, by ticket first, None otherwise.
+    Sessions whose cipher suite is not offered anymore are not resumed
+    """
+    session = None
+    ticket = client_hello.getlayer(tls.TLSExtSessionTicketTLS)
+    if ticket_keys is not None and ticket is not None and ticket.data:
+        session = ticket_keys.open(ticket.data)
+    if session is None and session_store is not None and client_hello.session_id:
+        session = session_store.get(client_hello.session_id)
+    if session is None or session.cipher_suite not in client_hello.cipher_suites or \
+            session.version != client_hello.version:
+        return None
+    return session
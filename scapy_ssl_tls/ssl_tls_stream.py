@@ -0,0 +1,634 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+# Author : <github.com/tintinweb/scapy-ssl_tls>
+
+import select
+import socket
+
+from collections import OrderedDict
+
+from scapy.config import conf
+from scapy.layers.inet import IP, TCP
+from scapy.layers.inet6 import IPv6
+
+SEQ_MASK = 0xffffffff
+TLS_RECORD_HEADER_LEN = 5
+SSLV2_RECORD_HEADER_LEN = 2
+# TLSCiphertext.length must not exceed 2^14 + 2048 (RFC5246 6.2.3)
+TLS_MAX_RECORD_LEN = 2 ** 14 + 2048
+TLS_CONTENT_TYPES = (0x14, 0x15, 0x16, 0x17, 0x18)
+TLS_CONTENT_TYPE_CHANGE_CIPHER_SPEC = 0x14
+TLS_CONTENT_TYPE_ALERT = 0x15
+TLS_CONTENT_TYPE_HANDSHAKE = 0x16
+TLS_HANDSHAKE_SERVER_HELLO_DONE = 0x0e
+# ERROR to CLIENT_CERTIFICATE
+SSLV2_MESSAGE_TYPES = range(0x00, 0x09)
+
+
+class TCPFlags(object):
+    FIN = 0x01
+    SYN = 0x02
+    RST = 0x04
+    PSH = 0x08
+    ACK = 0x10
+    URG = 0x20
+    ECE = 0x40
+    CWR = 0x80
+
+
+def seq_diff(seq, other):
+    """ Signed distance from other to seq, honoring 32 bit sequence number wraparound
+    """
+    diff = (seq - other) & SEQ_MASK
+    return diff - (SEQ_MASK + 1) if diff & 0x80000000 else diff
+
+
+def tls_record_length(buf, offset=0, sslv2=True):
+    """ Returns the full length of the TLS or SSLv2 record starting at buf[offset], header included.
+    buf must index to ints (bytearray, memoryview). Returns None if not enough bytes are available to read the
+    header, raises ValueError if the header is not a plausible record header.
+    """
+    available = len(buf) - offset
+    if available < 1:
+        return None
+    first = buf[offset]
+    if first in TLS_CONTENT_TYPES:
+        if (available > 1 and buf[offset + 1] != 0x03) or (available > 2 and buf[offset + 2] > 0x04):
+            raise ValueError("Implausible TLS record version")
+        if available < TLS_RECORD_HEADER_LEN:
+            return None
+        length = (buf[offset + 3] << 8) | buf[offset + 4]
+        if length > TLS_MAX_RECORD_LEN:
+            raise ValueError("TLS record length exceeds 2^14 + 2048")
+        return TLS_RECORD_HEADER_LEN + length
+    # SSLv2 2 byte header, msb is set
+    if sslv2 and first & 0x80:
+        if available < SSLV2_RECORD_HEADER_LEN:
+            return None
+        return SSLV2_RECORD_HEADER_LEN + (((first & 0x7f) << 8) | buf[offset + 1])
+    raise ValueError("Implausible record content type 0x%02x" % first)
+
+
+def looks_like_tls(buf, sslv2=True):
+    """ Cheap check whether buf, e.g. the start of a TCP payload, begins with a plausible TLS or SSLv2 record
+    header. Only the first bytes are looked at, see tls_record_length() for the accepted buf types. SSLv2 headers
+    additionally need a known message type, as their msb check alone is too weak.
+    """
+    try:
+        length = tls_record_length(buf, 0, sslv2)
+    except ValueError:
+        return False
+    if not buf or buf[0] in TLS_CONTENT_TYPES:
+        return bool(buf)
+    return len(buf) > SSLV2_RECORD_HEADER_LEN and length > SSLV2_RECORD_HEADER_LEN and buf[2] in SSLV2_MESSAGE_TYPES
+
+
+def handshake_messages(records):
+    """ Yields (type, body) for each cleartext handshake message in records, raw TLS records as read from one peer.
+    Messages may span records. Records following a ChangeCipherSpec are encrypted and not looked at.
+    """
+    handshake = []
+    for record in records:
+        content_type = ord(record[0])
+        if content_type == TLS_CONTENT_TYPE_CHANGE_CIPHER_SPEC:
+            break
+        if content_type == TLS_CONTENT_TYPE_HANDSHAKE:
+            handshake.append(record[TLS_RECORD_HEADER_LEN:])
+    handshake = "".join(handshake)
+    offset = 0
+    while offset + 4 <= len(handshake):
+        end = offset + 4 + (ord(handshake[offset + 1]) << 16 | ord(handshake[offset + 2]) << 8 |
+                            ord(handshake[offset + 3]))
+        if end > len(handshake):
+            break
+        yield ord(handshake[offset]), handshake[offset + 4:end]
+        offset = end
+
+
+def received_records(count):
+    """ Predicate for recv_records(): count records were read
+    """
+    return lambda records: len(records) >= count
+
+
+def received_handshake(*types):
+    """ Predicate for recv_records(): a cleartext handshake message of one of types was read
+    """
+    return lambda records: any(msg_type in types for msg_type, _ in handshake_messages(records))
+
+
+def received_alert(records):
+    """ Predicate for recv_records(): an alert record, encrypted or not, was read
+    """
+    return any(ord(record[0]) == TLS_CONTENT_TYPE_ALERT for record in records)
+
+
+def received_finished(records):
+    """ Predicate for recv_records(): a handshake record following a ChangeCipherSpec, that is the Finished, was read
+    """
+    content_types = [ord(record[0]) for record in records]
+    if TLS_CONTENT_TYPE_CHANGE_CIPHER_SPEC not in content_types:
+        return False
+    return TLS_CONTENT_TYPE_HANDSHAKE in content_types[content_types.index(TLS_CONTENT_TYPE_CHANGE_CIPHER_SPEC):]
+
+
+def received_any(*predicates):
+    """ Predicate for recv_records(): one of predicates holds
+    """
+    return lambda records: any(predicate(records) for predicate in predicates)
+
+
+# The first server flight of a TLS 1.2 or lower handshake, full or abbreviated, or its failure
+received_server_flight = received_any(received_handshake(TLS_HANDSHAKE_SERVER_HELLO_DONE), received_finished,
+                                      received_alert)
+
+
+def recv_records(sock, until=None, size=8192, timeout=0.5):
+    """
+    Reads from sock, splitting the data read into records as it arrives, until until(records) holds for the
+    complete raw records read so far, the peer closes the connection, or no data arrives for timeout seconds.
+    Returns all data read. Without until, or once data does not frame as records, reading stops on close or timeout
+    only, as the plain recv() loops did. See the received_* predicates.
+    """
+    prev_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    buf = bytearray()
+    records = []
+    offset = 0
+    try:
+        while True:
+            try:
+                data = sock.recv(size)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            buf.extend(data)
+            if until is None:
+                continue
+            read = len(records)
+            while True:
+                try:
+                    length = tls_record_length(buf, offset)
+                except ValueError:
+                    until = None
+                    break
+                if length is None or offset + length > len(buf):
+                    break
+                records.append(str(buf[offset:offset + length]))
+                offset += length
+            if until is not None and len(records) > read and until(records):
+                break
+    finally:
+        sock.settimeout(prev_timeout)
+    return str(buf)
+
+
+class Poller(object):
+    # poll() where available, it is not limited to FD_SETSIZE descriptors, select() otherwise
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        self._poll = select.poll() if hasattr(select, "poll") else None
+        self._fds = {}
+
+    def register(self, fd, events):
+        if self._poll is not None:
+            mask = (select.POLLIN if events & self.READ else 0) | (select.POLLOUT if events & self.WRITE else 0)
+            if fd in self._fds:
+                self._poll.modify(fd, mask)
+            else:
+                self._poll.register(fd, mask)
+        self._fds[fd] = events
+
+    def unregister(self, fd):
+        if self._fds.pop(fd, None) is not None and self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        """ Returns the ready file descriptors. Errors and hangups are reported as readable
+        """
+        return [fd for fd, _ in self.poll_events(timeout)]
+
+    def poll_events(self, timeout):
+        """ Returns (fd, events) of the ready file descriptors, events being READ and WRITE flags
+        """
+        if self._poll is not None:
+            return [(fd, (self.READ if mask & ~select.POLLOUT else 0) | (self.WRITE if mask & select.POLLOUT else 0))
+                    for fd, mask in self._poll.poll(None if timeout is None else timeout * 1000)]
+        readers = [fd for fd, events in self._fds.items() if events & self.READ]
+        writers = [fd for fd, events in self._fds.items() if events & self.WRITE]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        ready = dict.fromkeys(readable, self.READ)
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | self.WRITE
+        return ready.items()
+
+
+class TCPStream(object):
+    """
+    Reassembles one direction of a TCP connection and splits the byte stream into TLS records.
+
+    Segments are ordered by sequence number. In order payload is appended to a bytearray, out of order
+    segments are held back until the gap is filled. Memory is bounded: the bytearray never holds more than one
+    incomplete record, and at most max_out_of_order bytes are held back. When that limit is hit, the missing
+    bytes are considered lost, the partial record is dropped and the stream resynchronizes on the next plausible
+    record header.
+    """
+
+    def __init__(self, max_out_of_order=256 * 1024):
+        self.max_out_of_order = max_out_of_order
+        self.next_seq = None
+        self.buffer = bytearray()
+        self.out_of_order = {}
+        self.out_of_order_bytes = 0
+        # Stream starts at a record boundary only if we saw the SYN
+        self.synchronized = False
+        self.closed = False
+        self.reset = False
+        self.fin_seq = None
+        self.bytes_received = 0
+        self.bytes_lost = 0
+        self.retransmitted_bytes = 0
+
+    def feed(self, seq, payload, flags=0):
+        """ Adds a segment to the stream and returns the list of TLS records it completed, as raw strings
+        """
+        if flags & TCPFlags.SYN:
+            self.next_seq = (seq + 1) & SEQ_MASK
+            del self.buffer[:]
+            self.out_of_order.clear()
+            self.out_of_order_bytes = 0
+            self.synchronized = True
+            seq = self.next_seq
+        if flags & (TCPFlags.FIN | TCPFlags.RST):
+            self.closed = True
+            self.reset = bool(flags & TCPFlags.RST)
+            if flags & TCPFlags.FIN:
+                self.fin_seq = (seq + len(payload)) & SEQ_MASK
+        if not payload:
+            return []
+        if self.next_seq is None:
+            # Picked up in the middle of a connection, possibly at a record boundary
+            self.next_seq = seq
+            self.synchronized = looks_like_tls(bytearray(payload[:TLS_RECORD_HEADER_LEN]))
+        offset = seq_diff(seq, self.next_seq)
+        # Out of order budget exhausted, declare the missing bytes lost
+        while offset > 0 and self.out_of_order_bytes + len(payload) > self.max_out_of_order:
+            self._skip_gap(seq)
+            offset = seq_diff(seq, self.next_seq)
+        if offset + len(payload) <= 0:
+            self.retransmitted_bytes += len(payload)
+            return []
+        if offset > 0:
+            self._hold(seq, payload)
+            return []
+        if offset < 0:
+            # Partial retransmission, keep the new part only
+            self.retransmitted_bytes += -offset
+            payload = payload[-offset:]
+        self._append(payload)
+        self._drain()
+        return self._pop_records()
+
+    @property
+    def finished(self):
+        """ Closed, and the data sent before the FIN was all received. Segments reordered around the FIN may still
+        complete records until then. A reset stream is finished right away
+        """
+        if not self.closed:
+            return False
+        return self.reset or self.next_seq is None or seq_diff(self.fin_seq, self.next_seq) <= 0
+
+    def _hold(self, seq, payload):
+        existing = self.out_of_order.get(seq)
+        if existing is None:
+            self.out_of_order[seq] = payload
+            self.out_of_order_bytes += len(payload)
+        elif len(existing) < len(payload):
+            self.out_of_order[seq] = payload
+            self.out_of_order_bytes += len(payload) - len(existing)
+
+    def _skip_gap(self, seq):
+        # Continue at the closest of the held back segments and seq. The partial record can't be completed anymore
+        first = min([seq] + list(self.out_of_order), key=lambda s: seq_diff(s, self.next_seq))
+        self.bytes_lost += seq_diff(first, self.next_seq) + len(self.buffer)
+        self.next_seq = first
+        del self.buffer[:]
+        self.synchronized = False
+        self._drain()
+
+    def _append(self, payload):
+        self.buffer.extend(payload)
+        self.bytes_received += len(payload)
+        self.next_seq = (self.next_seq + len(payload)) & SEQ_MASK
+
+    def _drain(self):
+        while self.out_of_order:
+            progress = False
+            for seq in list(self.out_of_order):
+                offset = seq_diff(seq, self.next_seq)
+                if offset > 0:
+                    continue
+                payload = self.out_of_order.pop(seq)
+                self.out_of_order_bytes -= len(payload)
+                if offset + len(payload) > 0:
+                    self._append(payload[-offset:] if offset else payload)
+                    progress = True
+            if not progress:
+                break
+
+    def _resync(self):
+        # Look for the first offset that parses as a TLS record header. SSLv2 headers are too weak to sync on
+        for offset in xrange(len(self.buffer)):
+            try:
+                tls_record_length(self.buffer, offset, sslv2=False)
+            except ValueError:
+                continue
+            self.bytes_lost += offset
+            del self.buffer[:offset]
+            self.synchronized = True
+            return True
+        self.bytes_lost += len(self.buffer)
+        del self.buffer[:]
+        return False
+
+    def _pop_records(self):
+        records = []
+        pos = 0
+        while True:
+            if not self.synchronized and not self._resync():
+                break
+            try:
+                length = tls_record_length(self.buffer, pos)
+            except ValueError:
+                del self.buffer[:pos]
+                pos = 0
+                self.synchronized = False
+                continue
+            if length is None or pos + length > len(self.buffer):
+                break
+            records.append(str(self.buffer[pos:pos + length]))
+            pos += length
+        del self.buffer[:pos]
+        return records
+
+    def __len__(self):
+        return len(self.buffer) + self.out_of_order_bytes
+
+    def __repr__(self):
+        return "<TCPStream next_seq=%s buffered=%d out_of_order=%d lost=%d>" % (self.next_seq, len(self.buffer),
+                                                                               self.out_of_order_bytes,
+                                                                               self.bytes_lost)
+
+
+def stream_id(pkt):
+    """ Returns the directional (src, sport, dst, dport) tuple of a TCP/IP packet
+    """
+    ip = pkt[IP] if IP in pkt else pkt[IPv6]
+    return ip.src, pkt[TCP].sport, ip.dst, pkt[TCP].dport
+
+
+def tcp_payload(pkt):
+    """ Returns the TCP payload of a packet as a string, without link layer padding
+    """
+    tcp = pkt[TCP]
+    payload = str(tcp.payload)
+    padding = tcp.getlayer(conf.padding_layer)
+    if padding is not None and padding.load:
+        payload = payload[:-len(padding.load)]
+    return payload
+
+
+class TCPReassembler(object):
+    """
+    Tracks the TCP streams of scapy packets and yields the TLS records they carry as (stream_id, record) tuples.
+    The TCP layer is never re-dissected, records are raw strings ready to be handed to SSL().
+    """
+
+    def __init__(self, max_out_of_order=256 * 1024):
+        self.max_out_of_order = max_out_of_order
+        self.streams = {}
+
+    def get_stream(self, id_):
+        stream = self.streams.get(id_)
+        if stream is None:
+            stream = TCPStream(self.max_out_of_order)
+            self.streams[id_] = stream
+        return stream
+
+    def process(self, pkt):
+        if TCP not in pkt:
+            return []
+        tcp = pkt[TCP]
+        id_ = stream_id(pkt)
+        payload = tcp_payload(pkt)
+        flags = int(tcp.flags)
+        if not payload and not flags & TCPFlags.SYN and id_ not in self.streams:
+            return []
+        stream = self.get_stream(id_)
+        records = stream.feed(tcp.seq, payload, flags)
+        if stream.finished:
+            del self.streams[id_]
+        return [(id_, record) for record in records]
+
+    def reassemble(self, pkts):
+        for pkt in pkts:
+            for id_, record in self.process(pkt):
+                yield id_, record
+
+
+def flow_key(src, sport, dst, dport):
+    """ Direction independent key of a TCP connection
+    """
+    return tuple(sorted(((src, sport), (dst, dport))))
+
+
+class TLSFlow(object):
+    """
+    State of one TCP connection carrying TLS: the reassembly state of both directions, which endpoint is the client,
+    and an optional session context. info is free for consumers to keep their own per flow state.
+    """
+    # Rough fixed cost of a tracked flow, used for memory accounting
+    OVERHEAD = 2048
+    # Rough cost of a session context, and of each record it keeps
+    CTX_OVERHEAD = 64 * 1024
+    RECORD_OVERHEAD = 8 * 1024
+
+    def __init__(self, key, client, server, timestamp=0, ctx=None, max_out_of_order=256 * 1024):
+        self.key = key
+        self.client = client
+        self.server = server
+        self.streams = {client: TCPStream(max_out_of_order), server: TCPStream(max_out_of_order)}
+        self.ctx = ctx
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.info = {}
+        # Bytes accounted for by the FlowTable
+        self.accounted = 0
+
+    def set_client(self, client):
+        """ Fixes up the direction mapping, e.g. once a ClientHello shows who the client really is
+        """
+        if client == self.server:
+            self.client, self.server = self.server, self.client
+
+    def is_client(self, source):
+        return source == self.client
+
+    def feed(self, source, seq, payload, flags=0, timestamp=None):
+        if timestamp is not None:
+            self.last_seen = timestamp
+        return self.streams[source].feed(seq, payload, flags)
+
+    @property
+    def closed(self):
+        return any(stream.reset for stream in self.streams.values()) or all(stream.finished for stream in
+                                                                            self.streams.values())
+
+    def ctx_size(self):
+        """ Estimated size of the session context, from the records kept in its history and handshake transcript.
+        Contexts other than TLSSessionCtx only count their fixed cost
+        """
+        if self.ctx is None:
+            return 0
+        records = len(getattr(self.ctx, "history", ())) + len(getattr(self.ctx, "transcript", None) or ())
+        return self.CTX_OVERHEAD + records * self.RECORD_OVERHEAD
+
+    def __len__(self):
+        return self.OVERHEAD + sum(len(stream) for stream in self.streams.values()) + self.ctx_size()
+
+    def __repr__(self):
+        return "<TLSFlow %s:%d => %s:%d streams=%r>" % (self.client + self.server + (self.streams.values(),))
+
+
+class FlowTable(object):
+    """
+    Tracks TLSFlows keyed by their normalized 4-tuple, ordered by activity.
+
+    Flows idle for more than idle_timeout seconds are expired. Once max_flows or max_memory (in bytes, see
+    TLSFlow.__len__) is exceeded, least recently active flows are evicted. Closed flows are dropped right away.
+    ctx_factory, if given, is called with the flow to build its session context.
+
+    Memory counts the reassembly buffers exactly, but session contexts only by an estimate, refreshed on each segment
+    of their flow, see TLSFlow.ctx_size(). Records inserted into a context grow its history, long lived decrypting
+    flows should use contexts with a bounded history_policy.
+    """
+    EVICT_IDLE = "idle"
+    EVICT_LRU = "lru"
+    EVICT_CLOSED = "closed"
+    EVICT_FLUSH = "flush"
+
+    def __init__(self, idle_timeout=300, max_flows=2 ** 18, max_memory=2 ** 30, ctx_factory=None,
+                 max_out_of_order=256 * 1024, on_evict=None):
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.max_memory = max_memory
+        self.ctx_factory = ctx_factory
+        self.max_out_of_order = max_out_of_order
+        self.on_evict = on_evict
+        self.memory = 0
+        self.evicted = dict.fromkeys((self.EVICT_IDLE, self.EVICT_LRU, self.EVICT_CLOSED, self.EVICT_FLUSH), 0)
+        self._flows = OrderedDict()
+
+    def get(self, key):
+        return self._flows.get(key)
+
+    def _new_flow(self, key, source, destination, flags, timestamp):
+        # The SYN/ACK is sent by the server. Otherwise, assume the first talker is the client
+        if flags & TCPFlags.SYN and flags & TCPFlags.ACK:
+            client, server = destination, source
+        else:
+            client, server = source, destination
+        flow = TLSFlow(key, client, server, timestamp, max_out_of_order=self.max_out_of_order)
+        if self.ctx_factory is not None:
+            flow.ctx = self.ctx_factory(flow)
+        self._account(flow)
+        return flow
+
+    def _account(self, flow):
+        size = len(flow)
+        self.memory += size - flow.accounted
+        flow.accounted = size
+
+    def evict(self, key, reason=EVICT_LRU):
+        flow = self._flows.pop(key)
+        self.memory -= flow.accounted
+        self.evicted[reason] += 1
+        if self.on_evict is not None:
+            self.on_evict(flow, reason)
+        return flow
+
+    def expire(self, now):
+        """ Evicts flows idle since more than idle_timeout seconds. Returns the number of evicted flows
+        """
+        expired = 0
+        # Flows are kept in activity order, stop at the first active one
+        while self._flows:
+            key = next(iter(self._flows))
+            if now - self._flows[key].last_seen <= self.idle_timeout:
+                break
+            self.evict(key, self.EVICT_IDLE)
+            expired += 1
+        return expired
+
+    def flush(self):
+        """ Evicts all flows, e.g. at the end of a capture
+        """
+        while self._flows:
+            self.evict(next(iter(self._flows)), self.EVICT_FLUSH)
+
+    def _enforce_limits(self):
+        while self._flows and (len(self._flows) > self.max_flows or self.memory > self.max_memory):
+            self.evict(next(iter(self._flows)), self.EVICT_LRU)
+
+    def feed(self, source, destination, seq, payload, flags=0, timestamp=0):
+        """ Feeds a TCP segment, source and destination being (address, port) tuples.
+        Returns the TLSFlow and the list of TLS records completed by this segment
+        """
+        key = flow_key(source[0], source[1], destination[0], destination[1])
+        flow = self._flows.pop(key, None)
+        if flow is None:
+            if not payload and not flags & TCPFlags.SYN:
+                return None, []
+            flow = self._new_flow(key, source, destination, flags, timestamp)
+        # Re-insert to mark the flow as most recently active
+        self._flows[key] = flow
+        records = flow.feed(source, seq, payload, flags, timestamp)
+        # Also catches up with the records consumers inserted into the context since the last segment
+        self._account(flow)
+        if flow.closed:
+            self.evict(key, self.EVICT_CLOSED)
+        else:
+            self._enforce_limits()
+        return flow, records
+
+    def process(self, pkt):
+        """ Feeds a scapy TCP/IP packet. Returns the TLSFlow and the list of TLS records completed by the packet
+        """
+        if TCP not in pkt:
+            return None, []
+        src, sport, dst, dport = stream_id(pkt)
+        tcp = pkt[TCP]
+        return self.feed((src, sport), (dst, dport), tcp.seq, tcp_payload(pkt), int(tcp.flags), pkt.time)
+
+    def reassemble(self, pkts):
+        """ Yields (flow, source, record) for each TLS record in pkts, expiring idle flows along the way
+        """
+        for pkt in pkts:
+            flow, records = self.process(pkt)
+            if records:
+                source = stream_id(pkt)[:2]
+                for record in records:
+                    yield flow, source, record
+            self.expire(pkt.time)
+
+    def __contains__(self, key):
+        return key in self._flows
+
+    def __len__(self):
+        return len(self._flows)
+
+    def __iter__(self):
+        return iter(self._flows.values())
@@ -3,10 +3,15 @@
 import binascii
 import os
 import re
+import socket
+import threading
 import unittest
 import scapy_ssl_tls.ssl_tls as tls
 import scapy_ssl_tls.ssl_tls_crypto as tlsc
 import scapy_ssl_tls.ssl_tls_keystore as tlsk
+import scapy_ssl_tls.ssl_tls_session as tlssess
+import scapy_ssl_tls.ssl_tls_stream as tlss
+import tinyec.registry as ec_reg
 
 from Cryptodome.Cipher import AES, PKCS1_v1_5
 from Cryptodome.Hash import MD5, SHA
@@ -19,6 +24,10 @@ def env_local_file(file):
     return os.path.join(os.path.dirname(__file__), 'files', file)
 
 
+def integration_key_file(file):
+    return os.path.join(os.path.dirname(__file__), 'integration', 'keys', file)
+
+
 class TestSSLv2Record(unittest.TestCase):
     def setUp(self):
         self.client_hello = tls.SSLv2Record(length=1234)/tls.SSLv2ClientHello(challenge="12345")/"TEST"
@@ -259,6 +268,14 @@ class TestTLSDissector(unittest.TestCase):
         record = tls.TLS(str(handshake), ctx=tls_ctx)
         self.assertTrue(record.haslayer(tls.TLSServerKeyExchange))
 
+    def test_tls12_and_tls13_session_tickets_are_told_apart(self):
+        for ticket in (tls.TLSSessionTicket(lifetime=60, ticket="ticket"),
+                       tls.TLS13SessionTicket(lifetime=60, age_add=0x1234, ticket="ticket")):
+            handshake = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / ticket])
+            record = tls.TLS(str(handshake))
+            self.assertTrue(record.haslayer(ticket.__class__))
+            self.assertEqual(record[ticket.__class__].ticket, "ticket")
+
     def test_encrypted_handshake_which_fails_decryption_throws_error(self):
         tls_ctx = self._static_tls_handshake()
         client_kex = tls.TLS.from_records(
@@ -294,6 +311,20 @@ class TestTLSDecryptablePacket(unittest.TestCase):
         with self.assertRaises(KeyError):
             records.fields["ctx"]
 
+    def test_when_only_early_data_keys_are_installed_then_cleartext_server_records_are_not_decrypted(self):
+        cipher_suite = tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.resume_psk("\x02" * 32, cipher_suite)
+        tls_ctx.insert(tls.tls13_client_hello(tls_ctx, tls.tls_draft_version(18), [cipher_suite],
+                                              [tls.tls13_pre_shared_key("ticket", 0, 32)], early_data=True))
+        # The ClientHello negotiated TLS 1.3 already, but the server has no keys before its ServerHello
+        self.assertTrue(tls_ctx.client_ctx.must_encrypt)
+        self.assertIsNone(tls_ctx.server_ctx.crypto_ctx)
+        alert = tls.TLSRecord() / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                               description=tls.TLSAlertDescription.HANDSHAKE_FAILURE)
+        records = tls.TLS(str(alert), ctx=tls_ctx)
+        self.assertEqual(tls.TLSAlertDescription.HANDSHAKE_FAILURE, records[tls.TLSAlert].description)
+
     def test_streaming_mac_and_padding_are_added_if_session_context_is_provided(self):
         data = "%s%s" % ("A" * 2, "B" * MD5.digest_size)
         tls_ctx = tlsc.TLSSessionCtx()
@@ -881,6 +912,47 @@ UM6j0ZuSMFOCr/lGPAoOQU0fskidGEHi1/kW+suSr28TqsyYZpwBDQ==
         self.assertTrue(pubkey_extract_from_tls_certificate.can_encrypt())
         self.assertTrue(pubkey_extract_from_tls_certificate.can_sign())
 
+    def test_when_certificate_is_dissected_then_x509_parsing_is_deferred_until_field_access(self):
+        pkt = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSCertificateList() / tls.TLS10Certificate(
+            certificates=[tls.TLSCertificate(data=x509.X509_Cert(self.der_cert))])])
+        raw = str(pkt)
+        pkt = tls.SSL(raw)
+        cert = pkt[tls.TLSCertificate].data
+        self.assertIsInstance(cert, x509.X509_Cert)
+        self.assertFalse(cert.materialized)
+        # Serializing, searching TLS layers and extracting the public key work on the DER slice
+        self.assertEqual(str(pkt), raw)
+        self.assertEqual(str(cert), self.der_cert)
+        self.assertFalse(pkt.haslayer(tls.TLSServerHelloDone))
+        self.assertTrue(pkt.haslayer(x509.X509_Cert))
+        self.assertIs(pkt[x509.X509_Cert], cert)
+        tlsk.rsa_public_from_der_certificate(cert, tlsk.CertificateCache())
+        self.assertFalse(cert.materialized)
+        # Field access parses the certificate
+        self.assertEqual(cert.tbsCertificate, x509.X509_Cert(self.der_cert).tbsCertificate)
+        self.assertTrue(cert.materialized)
+        self.assertEqual(str(pkt), raw)
+
+    def test_when_record_is_built_from_der_certificate_then_it_is_not_parsed(self):
+        cert = tls.LazyX509Cert(self.der_cert)
+        pkt = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSCertificateList() / tls.TLS10Certificate(
+            certificates=[tls.TLSCertificate(data=cert)])])
+        self.assertIn(self.der_cert, str(pkt))
+        self.assertFalse(pkt[tls.TLSCertificate].data.materialized)
+        self.assertFalse(cert.materialized)
+        self.assertEqual(pkt[tls.TLSCertificate].data.tbsCertificate, x509.X509_Cert(self.der_cert).tbsCertificate)
+
+    def test_when_lazy_certificate_is_copied_then_copy_stays_lazy(self):
+        cert = tls.LazyX509Cert(self.der_cert)
+        cert.time = 1234.5
+        clone = cert.copy()
+        self.assertIsNot(cert, clone)
+        self.assertFalse(clone.materialized)
+        self.assertEqual(1234.5, clone.time)
+        self.assertEqual(self.der_cert, str(clone))
+        cert.materialize()
+        self.assertEqual(cert.tbsCertificate, cert.copy().tbsCertificate)
+
     def test_when_using_tls13_then_certificates_are_dissected_differently(self):
         pkt = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSCertificateList() / tls.TLS13Certificate(
             request_context="1234",
@@ -986,6 +1058,453 @@ class TestTLSExtensions(unittest.TestCase):
         self.assertEqual(key_share.selected_group, hhr_share.selected_group)
 
 
+class CountingSessionCtx(tlsc.TLSSessionCtx):
+
+    def __init__(self, *args, **kwargs):
+        tlsc.TLSSessionCtx.__init__(self, *args, **kwargs)
+        self.inserted = 0
+
+    def insert(self, p, origin=None):
+        self.inserted += 1
+        return tlsc.TLSSessionCtx.insert(self, p, origin)
+
+
+class TestTLSRecordParser(unittest.TestCase):
+
+    def setUp(self):
+        # The server to client stream of a capture: ServerHello, Certificate, ServerHelloDone, CCS, Finished, ...
+        self.stream = "".join(str(p[tls.SSL]) for p in rdpcap(env_local_file('RSA_WITH_AES_128_CBC_SHA.pcap'))
+                              if p.haslayer(tls.SSL) and p[tls.TCP].sport == 443)
+        self.expected = [str(record) for record in tls.SSL(self.stream).records]
+
+    def test_when_data_is_fed_in_small_chunks_then_records_are_returned_once_complete(self):
+        parser = tls.TLSRecordParser()
+        records = []
+        for offset in range(0, len(self.stream), 7):
+            records.extend(parser.feed(self.stream[offset:offset + 7]))
+        self.assertEqual(self.expected, [str(record) for record in records])
+        self.assertEqual(0, parser.pending)
+
+    def test_when_record_is_partial_then_it_is_kept_for_next_feed(self):
+        parser = tls.TLSRecordParser()
+        first = len(self.expected[0])
+        self.assertEqual(1, len(parser.feed(self.stream[:first + 3])))
+        self.assertEqual(3, parser.pending)
+        self.assertEqual(self.expected[1], str(parser.feed(self.stream[first + 3:])[0]))
+
+    def test_when_context_is_given_then_each_record_is_inserted_once(self):
+        tls_ctx = CountingSessionCtx()
+        parser = tls.TLSRecordParser(tls_ctx, origin="server")
+        # Cleartext records only, the context holds no keys
+        cleartext = "".join(self.expected[:3])
+        records = []
+        for offset in range(0, len(cleartext), 100):
+            records.extend(parser.feed(cleartext[offset:offset + 100]))
+        self.assertEqual(3, tls_ctx.inserted)
+        self.assertEqual(3, len(records))
+        self.assertTrue(tls_ctx.server_ctx.random)
+
+    def test_when_record_is_empty_or_sslv2_then_it_is_parsed(self):
+        self.assertEqual(0, tls.TLSRecordParser().feed("\x17\x03\x01\x00\x00")[0].length)
+        client_hello = tls.SSLv2Record(length=0x1b) / tls.SSLv2ClientHello(cipher_suites=[0x700c0], challenge="A" * 15)
+        records = tls.TLSRecordParser().feed(str(client_hello) * 2)
+        self.assertEqual(2, len(records))
+        self.assertEqual("A" * 15, records[1][tls.SSLv2ClientHello].challenge)
+
+    def test_when_socket_reads_stop_within_a_record_then_the_next_read_completes_it(self):
+        peer, sock = socket.socketpair()
+        try:
+            tls_socket = tls.TLSSocket(sock, client=True)
+            first = len(self.expected[0])
+            peer.sendall(self.stream[:first + 3])
+            self.assertEqual([self.expected[0]], [str(record) for record in tls_socket.recvall(timeout=0.1).records])
+            peer.sendall(self.stream[first + 3:first + len(self.expected[1])])
+            self.assertEqual([self.expected[1]], [str(record) for record in tls_socket.recvall(timeout=0.1).records])
+        finally:
+            peer.close()
+            sock.close()
+
+    def test_when_socket_reads_bytes_not_framed_as_records_then_they_are_returned_as_raw(self):
+        peer, sock = socket.socketpair()
+        try:
+            tls_socket = tls.TLSSocket(sock, client=True)
+            peer.sendall(self.expected[0] + "HTTP/1.1 400 Bad Request\r\n\r\n")
+            records = tls_socket.recvall(timeout=0.1).records
+            self.assertEqual(self.expected[0], str(records[0]))
+            self.assertEqual("HTTP/1.1 400 Bad Request\r\n\r\n", records[1][Raw].load)
+            self.assertEqual(0, tls_socket.parser.pending)
+            peer.sendall(self.expected[1])
+            self.assertEqual([self.expected[1]], [str(record) for record in tls_socket.recvall(timeout=0.1).records])
+        finally:
+            peer.close()
+            sock.close()
+
+    def test_when_flushed_then_complete_records_are_parsed_and_the_rest_is_raw(self):
+        parser = tls.TLSRecordParser()
+        self.assertRaises(ValueError, parser.feed, self.expected[0] + "\x16\x09garbage")
+        records = parser.flush()
+        self.assertEqual([self.expected[0], "\x16\x09garbage"], [str(record) for record in records])
+        self.assertEqual(0, parser.pending)
+
+
+class TestTLSFlight(unittest.TestCase):
+
+    def test_when_flight_is_sent_then_its_records_are_written_at_once_in_order(self):
+        peer, sock = socket.socketpair()
+        try:
+            tls_socket = tls.TLSSocket(sock, client=True, tls_ctx=CountingSessionCtx())
+            client_hello = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello()])
+            ccs = tls.TLSRecord() / tls.TLSChangeCipherSpec()
+            flight = tls_socket.flight().add(client_hello).add(ccs)
+            # Records are inserted into the context as they are added, before anything is written
+            self.assertEqual(2, tls_socket.tls_ctx.inserted)
+            self.assertEqual(2, len(flight))
+            tls_socket.send_flight(flight)
+            self.assertEqual(str(client_hello) + str(ccs), peer.recv(8192))
+            self.assertEqual(2, tls_socket.tls_ctx.inserted)
+        finally:
+            peer.close()
+            sock.close()
+
+
+def recv_application_data(tls_socket):
+    # The client Finished and the first application data may come in a single read
+    records = []
+    while not any(record.haslayer(tls.TLSPlaintext) for record in records):
+        resp = tls_socket.recvall(timeout=5, until=tlss.received_records(1))
+        if not resp.records:
+            raise socket.timeout("No application data received")
+        records.extend(resp.records)
+    return "".join(record[tls.TLSPlaintext].data for record in records if record.haslayer(tls.TLSPlaintext))
+
+
+def tls13_server(sock, cipher_suite, errors, received=None, psk=None, key_share=True, accept_early_data=True,
+                 group=tls.TLSSupportedGroup.SECP256R1, pings=1):
+    # Draft 18 server answering a ClientHello with a full server flight, or an abbreviated one resuming psk. A
+    # ClientHello without a key share of group gets a HelloRetryRequest first, and a full handshake. It then issues a
+    # ticket and echoes pings records of application data
+    received = {} if received is None else received
+    try:
+        tls_socket = tls.TLSSocket(sock, client=False)
+        tls_ctx = tls_socket.tls_ctx
+        if psk is not None:
+            tls_ctx.resume_psk(psk, cipher_suite)
+        curve = ec_reg.get_curve(tls.TLS_SUPPORTED_GROUPS[group])
+        tls_ctx.server_ctx.kex_keystore = tlsk.ECDHKeyStore.new_keypair(curve)
+        tls_ctx.server_ctx.load_rsa_keys_from_file(integration_key_file("key.pem"))
+        with open(integration_key_file("cert.der"), "rb") as f:
+            cert = f.read()
+        resp = tls_socket.recvall(timeout=5, until=tlss.received_handshake(tls.TLSHandshakeType.CLIENT_HELLO))
+        client_hello = resp[tls.TLSHandshake]
+        received["groups"] = [entry.named_group for entry in client_hello[tls.TLSClientHelloKeyShare].client_shares]
+        if key_share and group not in received["groups"]:
+            tls_socket.sendall(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+                tls.TLSHandshake() / tls.TLSHelloRetryRequest(version=tls.tls_draft_version(18), extensions=[
+                    tls.TLSExtension() / tls.TLSExtKeyShare() / tls.TLSHelloRetryRequestKeyShare(selected_group=group)])]))
+            # The ClientHello comes again in the clear, without PSK nor early data
+            tls_ctx.abandon_psk()
+            psk = None
+            resp = tls_socket.recvall(timeout=5, until=tlss.received_handshake(tls.TLSHandshakeType.CLIENT_HELLO))
+            client_hello = resp[tls.TLSHandshake]
+            received["retried_groups"] = [entry.named_group for entry in
+                                          client_hello[tls.TLSClientHelloKeyShare].client_shares]
+            received["retried_content_types"] = [record.content_type for record in resp.records]
+        extensions = []
+        if key_share:
+            server_share = tls.TLSKeyShareEntry(named_group=group,
+                                                key_exchange=tlsk.point_to_ansi_str(tls_ctx.server_ctx.kex_keystore.public))
+            extensions.append(tls.TLSExtension() / tls.TLSExtKeyShare() / tls.TLSServerHelloKeyShare(server_share=server_share))
+        encrypted_extensions = []
+        if psk is not None:
+            binder = client_hello[tls.TLSPSKBinderEntry].binder_entry
+            received["binder"] = binder == tls_ctx.get_psk_binder(str(client_hello)[:-(3 + len(binder))])
+            extensions.append(tls.TLSExtension() / tls.TLSExtPreSharedKey() / tls.TLSServerHelloPreSharedKey())
+            if any(extension.type == tls.TLSExtensionType.EARLY_DATA for extension in client_hello.extensions):
+                if not resp.haslayer(tls.TLSPlaintext):
+                    resp = tls_socket.recvall(timeout=5, until=tlss.received_records(1))
+                received["early_data"] = resp[tls.TLSPlaintext].data
+                if accept_early_data:
+                    encrypted_extensions.append(tls.TLSExtension(type=tls.TLSExtensionType.EARLY_DATA))
+        flight = tls_socket.flight()
+        flight.add(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSServerHello(
+            version=tls.tls_draft_version(18), cipher_suite=cipher_suite, extensions=extensions)]))
+        flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                 tls.TLSEncryptedExtensions(extensions=encrypted_extensions)]))
+        if psk is None:
+            flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSCertificateList() / tls.TLS13Certificate(
+                certificates=[tls.TLSCertificateEntry(cert_data=tls.LazyX509Cert(cert))])]))
+            flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSCertificateVerify(
+                sig=tls_ctx.compute_server_cert_verify())]))
+        flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSFinished(data=tls_ctx.get_verify_data())]))
+        tls_socket.send_flight(flight)
+        data = recv_application_data(tls_socket)
+        received["psk"] = tls_ctx.resumption_secret
+        flight = tls_socket.flight()
+        flight.add(tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLS13SessionTicket(
+            lifetime=60, age_add=0x1234, ticket="ticket", extensions=[
+                tls.TLSExtension() / tls.TLSExtTicketEarlyDataInfo(max_early_data_size=1024)])]))
+        flight.add(tls.TLSPlaintext(data="pong " + data))
+        tls_socket.send_flight(flight)
+        for _ in range(pings - 1):
+            tls_socket.sendall(tls.TLSPlaintext(data="pong " + recv_application_data(tls_socket)))
+        received["key_generations"] = (tls_ctx.client_ctx.key_generation, tls_ctx.server_ctx.key_generation)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        sock.close()
+
+
+class TestTLS13Handshake(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.tls_socket = tls.TLSSocket(self.client, client=True)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def _serve(self, target, *args):
+        thread = threading.Thread(target=target, args=(self.server,) + args)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def _handshake(self, cipher_suite):
+        errors = []
+        self._serve(tls13_server, cipher_suite, errors)
+        resp1, resp2 = tls.tls_do_handshake(self.tls_socket, tls.tls_draft_version(18), [cipher_suite])
+        self.assertTrue(resp1.haslayer(tls.TLSServerHello))
+        self.assertEqual([], resp2.records)
+        resp = self.tls_socket.do_round_trip(tls.TLSPlaintext(data="ping"), until=tlss.received_records(2))
+        self.assertEqual("pong ping", resp[tls.TLSPlaintext].data)
+        self.assertEqual(cipher_suite, self.tls_socket.tls_ctx.negotiated.ciphersuite)
+        self.assertEqual(1, len(self.tls_socket.tls_ctx.server_ctx.finished_hashes))
+        self.assertEqual(1, len(self.tls_socket.tls_ctx.client_ctx.finished_hashes))
+        self.assertEqual([], errors)
+
+    def test_when_handshake_completes_then_application_data_is_exchanged(self):
+        self._handshake(tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256)
+
+    def test_when_sha384_suite_is_negotiated_then_handshake_completes(self):
+        self._handshake(tls.TLSCipherSuite.TLS_AES_256_GCM_SHA384)
+
+    def test_client_hello_offers_version_and_key_share(self):
+        client_hello = tls.tls13_client_hello(self.tls_socket.tls_ctx, tls.tls_draft_version(18),
+                                              [tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256])
+        self.assertEqual([tls.tls_draft_version(18)], client_hello[tls.TLSExtSupportedVersions].versions)
+        self.assertEqual([tls.TLSSupportedGroup.SECP256R1],
+                         [entry.named_group for entry in client_hello[tls.TLSClientHelloKeyShare].client_shares])
+        self.assertEqual(1, len(self.tls_socket.tls_ctx.client_ctx.shares))
+
+    def test_when_server_requests_another_key_share_then_client_hello_is_sent_again(self):
+        errors, received = [], {}
+        self._serve(tls13_server, tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256, errors, received, None, True, True,
+                    tls.TLSSupportedGroup.SECP384R1)
+        resp1, _ = tls.tls_do_handshake(self.tls_socket, tls.tls_draft_version(18),
+                                        [tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256])
+        self.assertEqual([tls.TLSSupportedGroup.SECP384R1], received["retried_groups"])
+        self.assertEqual(tls.TLSSupportedGroup.SECP384R1, tls.tls13_selected_group(resp1))
+        resp = self.tls_socket.do_round_trip(tls.TLSPlaintext(data="ping"), until=tlss.received_records(2))
+        self.assertEqual("pong ping", resp[tls.TLSPlaintext].data)
+        self.assertEqual([], errors)
+
+    def test_when_server_requests_a_key_share_already_sent_then_protocol_error_is_raised(self):
+        def hello_retry_server(sock):
+            tls_socket = tls.TLSSocket(sock, client=False)
+            tls_socket.recvall(timeout=5, until=tlss.received_handshake(tls.TLSHandshakeType.CLIENT_HELLO))
+            tls_socket.sendall(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+                tls.TLSHandshake() / tls.TLSHelloRetryRequest(version=tls.tls_draft_version(18), extensions=[
+                    tls.TLSExtension() / tls.TLSExtKeyShare() /
+                    tls.TLSHelloRetryRequestKeyShare(selected_group=tls.TLSSupportedGroup.SECP256R1)])]))
+
+        self._serve(hello_retry_server)
+        with self.assertRaises(tls.TLSProtocolError):
+            tls.tls_do_handshake(self.tls_socket, tls.tls_draft_version(18), [tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256])
+
+    def test_when_group_is_cached_then_its_key_share_only_is_sent(self):
+        key_share_cache = tlssess.KeyShareCache()
+        for expected_groups in ([tls.TLSSupportedGroup.SECP256R1], [tls.TLSSupportedGroup.SECP384R1]):
+            client, server = socket.socketpair()
+            self.addCleanup(client.close)
+            self.addCleanup(server.close)
+            errors, received = [], {}
+            thread = threading.Thread(target=tls13_server, args=(server, tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256,
+                                                                  errors, received),
+                                      kwargs={"group": tls.TLSSupportedGroup.SECP384R1})
+            thread.start()
+            tls_socket = tls.TLSSocket(client, client=True)
+            tls_socket.getpeername = lambda: ("10.0.0.1", 443)
+            tls.tls13_do_handshake(tls_socket, tls.tls_draft_version(18), [tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256],
+                                   key_share_cache=key_share_cache)
+            tls_socket.do_round_trip(tls.TLSPlaintext(data="ping"), until=tlss.received_records(2))
+            thread.join()
+            self.assertEqual([], errors)
+            self.assertEqual(expected_groups, received["groups"])
+            self.assertEqual(tls.TLSSupportedGroup.SECP384R1, key_share_cache.get("10.0.0.1", 443))
+        # No HelloRetryRequest once the group is known
+        self.assertNotIn("retried_groups", received)
+
+
+class TestTLS13Resumption(unittest.TestCase):
+
+    cipher_suite = tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256
+
+    def _connect(self, **server_args):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        received, errors = {}, []
+        thread = threading.Thread(target=tls13_server, args=(server, self.cipher_suite, errors, received),
+                                  kwargs=server_args)
+        thread.start()
+        self.addCleanup(self.assertEqual, [], errors)
+        self.addCleanup(thread.join)
+        return tls.TLSSocket(client, client=True), received
+
+    def _ping(self, tls_socket):
+        resp = tls_socket.do_round_trip(tls.TLSPlaintext(data="ping"), until=tlss.received_records(2))
+        self.assertEqual("pong ping", resp[tls.TLSPlaintext].data)
+
+    def setUp(self):
+        tls_socket, received = self._connect()
+        tls.tls_do_handshake(tls_socket, tls.tls_draft_version(18), [self.cipher_suite])
+        self._ping(tls_socket)
+        self.psk = tls_socket.tls_ctx.resumption_secret
+        self.ticket = tls_socket.tls_ctx.ticket
+        self.assertEqual(received["psk"], self.psk)
+
+    def _resume(self, tls_socket, ke_mode, groups=(tls.TLSSupportedGroup.SECP256R1,), early_data=None):
+        tls_socket.tls_ctx.resume_psk(self.psk, self.cipher_suite)
+        extensions = [tls.TLSExtension() / tls.TLSExtPSKKeyExchangeModes(ke_modes=[ke_mode]),
+                      tls.tls13_pre_shared_key(self.ticket.ticket, self.ticket.age_add, len(self.psk))]
+        return tls.tls13_do_handshake(tls_socket, tls.tls_draft_version(18), [self.cipher_suite], extensions, groups,
+                                      early_data)
+
+    def test_when_ticket_is_received_then_its_early_data_limit_is_parsed(self):
+        self.assertIsInstance(self.ticket, tls.TLS13SessionTicket)
+        self.assertEqual("ticket", self.ticket.ticket)
+        self.assertEqual(1024, self.ticket[tls.TLSExtTicketEarlyDataInfo].max_early_data_size)
+
+    def test_when_psk_is_accepted_then_early_data_is_sent_in_0_rtt(self):
+        tls_socket, received = self._connect(psk=self.psk)
+        resp1, _ = self._resume(tls_socket, tls.TLSPSKKeyExchangeMode.PSK_DHE_KE, early_data="early ping")
+        self.assertTrue(received["binder"])
+        self.assertEqual("early ping", received["early_data"])
+        self.assertTrue(tls_socket.tls_ctx.negotiated.resumption)
+        self.assertTrue(tls_socket.tls_ctx.negotiated.early_data)
+        self.assertFalse(resp1.haslayer(tls.TLSCertificateList))
+        self._ping(tls_socket)
+
+    def test_when_psk_ke_is_used_then_no_key_share_is_needed(self):
+        tls_socket, received = self._connect(psk=self.psk, key_share=False, accept_early_data=False)
+        self._resume(tls_socket, tls.TLSPSKKeyExchangeMode.PSK_KE, groups=(), early_data="early ping")
+        self.assertTrue(tls_socket.tls_ctx.negotiated.resumption)
+        # The server discarded the early data, the client Finished is protected by the handshake keys regardless
+        self.assertFalse(tls_socket.tls_ctx.negotiated.early_data)
+        self._ping(tls_socket)
+
+    def test_when_server_retries_early_data_hello_then_client_hello_is_sent_again_in_the_clear(self):
+        tls_socket, received = self._connect(psk=self.psk, group=tls.TLSSupportedGroup.SECP384R1)
+        self._resume(tls_socket, tls.TLSPSKKeyExchangeMode.PSK_DHE_KE, early_data="early ping")
+        self.assertEqual([tls.TLSSupportedGroup.SECP384R1], received["retried_groups"])
+        self.assertEqual([tls.TLSContentType.HANDSHAKE], received["retried_content_types"])
+        self.assertNotIn("binder", received)
+        self.assertFalse(tls_socket.tls_ctx.negotiated.resumption)
+        self.assertFalse(tls_socket.tls_ctx.negotiated.early_data)
+        self._ping(tls_socket)
+
+    def test_when_no_psk_is_offered_then_early_data_is_refused(self):
+        with self.assertRaises(ValueError):
+            tls.tls13_do_handshake(tls.TLSSocket(socket.socket(), client=True), tls.tls_draft_version(18),
+                                   [self.cipher_suite], early_data="early ping")
+
+    def test_pre_shared_key_extension_is_sent_last(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.resume_psk(self.psk, self.cipher_suite)
+        client_hello = tls.tls13_client_hello(tls_ctx, tls.tls_draft_version(18), [self.cipher_suite],
+                                              [tls.tls13_pre_shared_key("ticket", 0, len(self.psk))], early_data=True)
+        extensions = client_hello[tls.TLSClientHello].extensions
+        self.assertTrue(extensions[-1].haslayer(tls.TLSClientHelloPreSharedKey))
+        self.assertIn(tls.TLSExtensionType.EARLY_DATA, [extension.type for extension in extensions])
+        binder = client_hello[tls.TLSPSKBinderEntry].binder_entry
+        self.assertNotEqual("\x00" * len(self.psk), binder)
+        self.assertEqual(binder, tls_ctx.get_psk_binder(str(client_hello[tls.TLSHandshake])[:-(3 + len(binder))]))
+
+
+class TestTLS13KeyUpdate(unittest.TestCase):
+
+    cipher_suite = tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256
+
+    def _connect(self, pings):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(server.close)
+        self.received, errors = {}, []
+        thread = threading.Thread(target=tls13_server, args=(server, self.cipher_suite, errors, self.received),
+                                  kwargs={"pings": pings})
+        thread.start()
+        self.addCleanup(self.assertEqual, [], errors)
+        self.addCleanup(thread.join)
+        self.thread = thread
+        tls_socket = tls.TLSSocket(client, client=True)
+        tls.tls_do_handshake(tls_socket, tls.tls_draft_version(18), [self.cipher_suite])
+        return tls_socket
+
+    def _ping(self, tls_socket, pkt=None, records=1):
+        flight = tls_socket.flight()
+        if pkt is not None:
+            flight.add(pkt)
+        flight.add(tls.TLSPlaintext(data="ping"))
+        resp = tls_socket.do_round_trip(flight, until=tlss.received_records(records))
+        self.assertEqual("pong ping", resp.records[-1][tls.TLSPlaintext].data)
+        return resp
+
+    def test_when_update_is_requested_then_both_sides_use_next_generation_keys(self):
+        tls_socket = self._connect(pings=2)
+        tls_ctx = tls_socket.tls_ctx
+        self._ping(tls_socket, records=2)
+        client_secret, server_secret = tls_ctx.master_secrets.client.secret, tls_ctx.master_secrets.server.secret
+        resp = self._ping(tls_socket, tls.tls13_key_update(request_update=True), records=2)
+        # The server answers with its own KeyUpdate, before its data
+        self.assertTrue(resp.records[0].haslayer(tls.TLSKeyUpdate))
+        self.assertEqual(tls.TLSKeyUpdateRequest.UPDATE_NOT_REQUESTED, resp[tls.TLSKeyUpdate].request_update)
+        self.assertEqual(tls_ctx.prf.derive_update_secret(client_secret), tls_ctx.master_secrets.client.secret)
+        self.assertEqual(tls_ctx.prf.derive_update_secret(server_secret), tls_ctx.master_secrets.server.secret)
+        self.assertEqual(1, tls_ctx.client_ctx.key_generation)
+        self.assertEqual(1, tls_ctx.server_ctx.key_generation)
+        self.assertEqual(1, tls_ctx.server_ctx.sequence)
+        self.assertFalse(tls_ctx.client_ctx.key_update_requested)
+        self.thread.join()
+        self.assertEqual((1, 1), self.received["key_generations"])
+
+    def test_when_policy_limit_is_reached_then_keys_are_updated_before_next_record(self):
+        tls_socket = self._connect(pings=4)
+        tls_socket.key_update_policy = tls.TLSKeyUpdatePolicy(max_records=2)
+        self._ping(tls_socket, records=2)
+        self._ping(tls_socket)
+        self.assertEqual(0, tls_socket.tls_ctx.client_ctx.key_generation)
+        self._ping(tls_socket)
+        self.assertEqual(1, tls_socket.tls_ctx.client_ctx.key_generation)
+        self.assertEqual(1, tls_socket.tls_ctx.client_ctx.sequence)
+        self._ping(tls_socket)
+        self.assertEqual(0, tls_socket.tls_ctx.server_ctx.key_generation)
+        self.thread.join()
+        self.assertEqual((1, 0), self.received["key_generations"])
+
+    def test_when_byte_limit_is_reached_then_policy_is_due(self):
+        ctx = tlsc.TLSContext("Client TLS context")
+        policy = tls.TLSKeyUpdatePolicy(max_bytes=100)
+        self.assertFalse(policy.due(ctx))
+        ctx.protected_bytes = 100
+        self.assertTrue(policy.due(ctx))
+        self.assertFalse(tls.TLSKeyUpdatePolicy().due(ctx))
+
+    def test_key_update_is_dissected(self):
+        pkt = tls.TLSRecord() / tls.tls13_key_update(request_update=True)
+        record = tls.TLS(str(pkt))
+        self.assertEqual(tls.TLSKeyUpdateRequest.UPDATE_REQUESTED, record[tls.TLSKeyUpdate].request_update)
+
+
 class TestTLSTopLevelFunctions(unittest.TestCase):
 
     def test_tls_payload_fragmentation_raises_error_with_negative_size(self):
@@ -0,0 +1,204 @@
+#! -*- coding: utf-8 -*-
+
+import os
+import socket
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_async as tlsa
+import scapy_ssl_tls.ssl_tls_engine as tlse
+
+
+def integration_key_file(file):
+    return os.path.join(os.path.dirname(__file__), 'integration', 'keys', file)
+
+
+def engine_server(sock, engine):
+    # Serves a TLSEngine over a non blocking socket, echoing application data
+    sock.setblocking(False)
+    while True:
+        data = yield tlsa.recv(sock)
+        if not data:
+            break
+        replies = [engine.send(tls.TLSPlaintext(data=record[tls.TLSPlaintext].data))
+                   for record in engine.feed_incoming(data) if record.haslayer(tls.TLSPlaintext)]
+        yield tlsa.sendall(sock, engine.data_to_send() + "".join(replies))
+    sock.close()
+
+
+def server_engine():
+    engine = tlse.TLSEngine(client=False)
+    engine.tls_ctx.server_ctx.load_rsa_keys_from_file(integration_key_file("key.pem"))
+    with open(integration_key_file("cert.der"), "rb") as f:
+        engine.accept_handshake([tls.TLSCertificate(data=f.read())], tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+    return engine
+
+
+def client_session(tls_socket, data):
+    yield tls_socket.do_handshake(tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+    resp = yield tls_socket.do_round_trip(tls.TLSPlaintext(data=data))
+    tls_socket.close()
+    raise tlsa.Return(resp[tls.TLSPlaintext].data)
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def test_when_coroutines_are_nested_then_values_and_exceptions_propagate(self):
+        def inner(value):
+            if value is None:
+                raise ValueError("no value")
+            raise tlsa.Return(value * 2)
+            yield
+
+        def outer():
+            doubled = yield inner(21)
+            try:
+                yield inner(None)
+            except ValueError:
+                raise tlsa.Return(doubled)
+
+        self.assertEqual(42, tlsa.EventLoop().run_until_complete(outer()))
+
+    def test_when_peer_keeps_quiet_then_wait_times_out(self):
+        client, server = socket.socketpair()
+        client.setblocking(False)
+        with self.assertRaises(socket.timeout):
+            tlsa.EventLoop().run_until_complete(tlsa.recv(client, timeout=0.05))
+        client.close()
+        server.close()
+
+
+class TestAsyncTLSSocket(unittest.TestCase):
+
+    def _session(self, loop, data):
+        client, server = socket.socketpair()
+        loop.spawn(engine_server(server, server_engine()))
+        return loop.spawn(client_session(tlsa.AsyncTLSSocket(client, client=True, timeout=5), data))
+
+    def test_when_many_sessions_run_concurrently_then_all_complete_in_one_thread(self):
+        loop = tlsa.EventLoop()
+        tasks = [self._session(loop, "ping %d" % i) for i in range(10)]
+        loop.run()
+        self.assertEqual(["ping %d" % i for i in range(10)], [task.result() for task in tasks])
+
+    def test_when_hooks_are_set_then_they_are_used_to_encrypt(self):
+        calls = []
+        client, server = socket.socketpair()
+        tls_socket = tlsa.AsyncTLSSocket(client, client=True)
+        tls_socket.pre_encrypt_hook = lambda pkt: calls.append("pre_encrypt") or pkt
+        loop = tlsa.EventLoop()
+        loop.spawn(engine_server(server, server_engine()))
+        self.assertEqual("hooked", loop.run_until_complete(client_session(tls_socket, "hooked")))
+        self.assertEqual(["pre_encrypt"] * 2, calls)
+
+    def test_when_server_sends_fatal_alert_then_protocol_error_is_raised(self):
+        def alerting_server(sock):
+            sock.setblocking(False)
+            yield tlsa.recv(sock)
+            yield tlsa.sendall(sock, str(tls.TLSRecord() / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                                                        description=0x28)))
+            sock.close()
+
+        client, server = socket.socketpair()
+        loop = tlsa.EventLoop()
+        loop.spawn(alerting_server(server))
+        task = loop.spawn(client_session(tlsa.AsyncTLSSocket(client, client=True, timeout=5), "ping"))
+        loop.run()
+        with self.assertRaises(tls.TLSProtocolError):
+            task.result()
+
+
+class TestTLSSocketPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = tlsa.TLSSocketPool()
+        self.received = []
+        self.closed = []
+
+    def _on_records(self, tls_socket, records):
+        self.received.append((tls_socket, records))
+
+    def _on_close(self, tls_socket):
+        self.closed.append(tls_socket)
+
+    def test_when_records_are_sent_then_they_are_queued_and_delivered_to_peer(self):
+        client, server = socket.socketpair()
+        client = tls.TLSSocket(client, client=True)
+        server = tls.TLSSocket(server, client=False)
+
+        def on_client_hello(tls_socket, records):
+            self.received.append((tls_socket, records))
+            self.pool.send(tls_socket, tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+                tls.TLSHandshake() / tls.TLSServerHello(cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)]))
+
+        self.pool.register(client, self._on_records)
+        self.pool.register(server, on_client_hello, self._on_close)
+        self.pool.send(client, tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                               tls.TLSClientHello()]))
+        while len(self.received) < 2:
+            self.assertGreater(self.pool.poll(1), 0)
+        self.assertEqual(server, self.received[0][0])
+        self.assertTrue(self.received[0][1].haslayer(tls.TLSClientHello))
+        self.assertEqual(client, self.received[1][0])
+        self.assertTrue(self.received[1][1].haslayer(tls.TLSServerHello))
+        # Both directions made it into the session contexts
+        self.assertIsNotNone(client.tls_ctx.negotiated.ciphersuite)
+
+        self.pool.unregister(client)
+        client.close()
+        self.pool.run(idle_timeout=1)
+        self.assertEqual([server], self.closed)
+        self.assertEqual(0, len(self.pool))
+
+    def test_when_record_arrives_in_pieces_then_callback_waits_for_it(self):
+        peer, sock = socket.socketpair()
+        self.pool.register(tls.TLSSocket(sock, client=False), self._on_records)
+        record = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello()]))
+        peer.sendall(record[:10])
+        self.pool.poll(1)
+        self.assertEqual([], self.received)
+        peer.sendall(record[10:] + record)
+        self.pool.poll(1)
+        self.assertEqual(2, len(self.received[0][1].records))
+        peer.close()
+
+    def test_when_listener_accepts_then_connections_are_registered(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        self.pool.register_listener(tls.TLSSocket(listener, client=False),
+                                    lambda tls_socket, peer: self.pool.register(tls_socket, self._on_records,
+                                                                                self._on_close))
+        clients = [socket.create_connection(listener.getsockname()) for _ in range(3)]
+        while len(self.pool) < 4:
+            self.pool.poll(1)
+        for client in clients:
+            client.close()
+        self.pool.run(idle_timeout=1)
+        self.assertEqual(3, len(self.closed))
+        self.assertEqual(1, len(self.pool))
+        listener.close()
+
+    def test_when_socket_fails_then_only_it_is_closed(self):
+        not_tls_peer, not_tls = socket.socketpair()
+        raising_peer, raising = socket.socketpair()
+        peer, sock = socket.socketpair()
+        not_tls, raising, sock = [tls.TLSSocket(s, client=False) for s in (not_tls, raising, sock)]
+
+        def on_records(tls_socket, records):
+            raise RuntimeError("callback failed")
+
+        self.pool.register(not_tls, self._on_records, self._on_close)
+        self.pool.register(raising, on_records, self._on_close)
+        self.pool.register(sock, self._on_records, self._on_close)
+        record = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello()]))
+        not_tls_peer.sendall("GET / HTTP/1.1\r\n\r\n")
+        raising_peer.sendall(record)
+        peer.sendall(record)
+        while len(self.received) < 1 or len(self.closed) < 2:
+            self.assertGreater(self.pool.poll(1), 0)
+        self.assertEqual(set([not_tls, raising]), set(self.closed))
+        self.assertEqual(1, len(self.pool))
+        self.assertEqual(sock, self.received[0][0])
+        for s in (not_tls_peer, raising_peer, peer, sock):
+            s.close()
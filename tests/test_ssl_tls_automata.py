@@ -0,0 +1,99 @@
+#! -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_automata as tlsauto
+import scapy_ssl_tls.ssl_tls_session as tlssess
+import scapy_ssl_tls.ssl_tls_stream as tlss
+
+
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def connect(address, timeout=5):
+    # The automata binds once it runs
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+class TestTLSServerAutomataResumption(unittest.TestCase):
+
+    def setUp(self):
+        with open(env_local_file("openssl_1_0_1_f_server.pem")) as f:
+            self.pem = f.read()
+        self.address = ("127.0.0.1", free_port())
+        self.cache = tlssess.ClientSessionCache()
+
+    def _serve(self, **kwargs):
+        server = tlsauto.TLSServerAutomata(bind=self.address, pemcert=self.pem, response="pong", **kwargs)
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+        return server, thread
+
+    def _connect(self, **kwargs):
+        server, thread = self._serve(**kwargs)
+        tls_socket = tls.TLSSocket(connect(self.address), client=True)
+        try:
+            resp1, _ = tlssess.tls_do_cached_handshake(tls_socket, self.cache, tls.TLSVersion.TLS_1_2,
+                                                       [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+            resp = tls_socket.do_round_trip(tls.TLSPlaintext(data="ping"),
+                                            until=tlss.received_any(tlss.received_records(1), tlss.received_alert))
+            self.assertEqual("pong", resp[tls.TLSPlaintext].data)
+        finally:
+            thread.join(5)
+            tls_socket.close()
+            server.srv_sock.close()
+        self.assertFalse(thread.is_alive())
+        return tls_socket.tls_ctx, resp1
+
+    def test_when_session_id_is_offered_again_then_handshake_is_abbreviated(self):
+        store = tlssess.ServerSessionStore()
+        tls_ctx, resp = self._connect(session_store=store)
+        self.assertTrue(resp.haslayer(tls.TLSCertificateList))
+        session_id = tls_ctx.server_ctx.session_id
+        self.assertTrue(session_id)
+        tls_ctx, resp = self._connect(session_store=store)
+        self.assertFalse(resp.haslayer(tls.TLSCertificateList))
+        self.assertTrue(tls_ctx.negotiated.resumption)
+        self.assertEqual(session_id, tls_ctx.server_ctx.session_id)
+
+    def test_when_ticket_is_offered_again_then_handshake_is_abbreviated_and_ticket_renewed(self):
+        ticket_keys = tlssess.TicketKeys()
+        _, resp = self._connect(ticket_keys=ticket_keys)
+        self.assertTrue(resp.haslayer(tls.TLSCertificateList))
+        first_ticket = self.cache.get(*self.address).ticket
+        self.assertTrue(first_ticket)
+        tls_ctx, resp = self._connect(ticket_keys=ticket_keys)
+        self.assertFalse(resp.haslayer(tls.TLSCertificateList))
+        self.assertTrue(tls_ctx.negotiated.resumption)
+        # A NewSessionTicket is issued in the abbreviated flight, before the ChangeCipherSpec
+        self.assertTrue(resp.haslayer(tls.TLSSessionTicket))
+        new_ticket = resp[tls.TLSSessionTicket].ticket
+        self.assertNotEqual(first_ticket, new_ticket)
+        self.assertEqual(new_ticket, self.cache.get(*self.address).ticket)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import os
 import binascii
+import copy
 import unittest
 import struct
 import warnings
@@ -296,6 +297,89 @@ xVgf/Neb/avXgIgi6drj8dp1fWA=
         self.assertIsNone(tls_ctx.master_secret)
 
 
+def resumed_session_records(app_data_records=4):
+    """ Records of an abbreviated TLS 1.2 handshake, resuming a session, followed by application data
+    """
+    records = ([tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+                    tls.TLSHandshake() / tls.TLSClientHello(session_id="a" * 32)]),
+                tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+                    tls.TLSHandshake() / tls.TLSServerHello(session_id="a" * 32,
+                                                            cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)]),
+                tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSFinished(data="s" * 12)]),
+                tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSFinished(data="c" * 12)])] +
+               [tls.TLSRecord() / tls.TLSPlaintext(data="%d" % i) for i in range(app_data_records)])
+    return [tls.TLSRecord(str(record)) for record in records]
+
+
+class TestTLSSessionCtxHistory(unittest.TestCase):
+
+    def resumed_ctx(self, history_policy, records):
+        tls_ctx = tlsc.TLSSessionCtx(history_policy=history_policy)
+        tls_ctx.resume_session("\x01" * 48)
+        for record in records:
+            tls_ctx.insert(record)
+        return tls_ctx
+
+    def test_when_policy_is_all_then_all_records_and_transcript_are_kept(self):
+        records = resumed_session_records()
+        tls_ctx = self.resumed_ctx(tlsc.TLSSessionCtx.HISTORY_ALL, records)
+        self.assertEqual(records, tls_ctx.history)
+        self.assertEqual(records[:4], tls_ctx.transcript)
+        self.assertEqual(12, len(tls_ctx.get_verify_data()))
+
+    def test_when_policy_is_handshake_then_application_data_is_not_kept(self):
+        records = resumed_session_records()
+        tls_ctx = self.resumed_ctx(tlsc.TLSSessionCtx.HISTORY_HANDSHAKE, records)
+        self.assertEqual(records[:4], tls_ctx.history)
+        self.assertIsNone(tls_ctx.transcript)
+
+    def test_when_policy_is_a_size_then_last_records_are_kept(self):
+        records = resumed_session_records()
+        tls_ctx = self.resumed_ctx(3, records)
+        self.assertEqual(records[-3:], list(tls_ctx.history))
+        self.assertIsNone(tls_ctx.transcript)
+
+    def test_when_policy_is_none_then_transcript_is_kept_until_handshake_completes(self):
+        records = resumed_session_records()
+        full_ctx = self.resumed_ctx(tlsc.TLSSessionCtx.HISTORY_ALL, records[:3])
+        tls_ctx = self.resumed_ctx(tlsc.TLSSessionCtx.HISTORY_NONE, records[:3])
+        self.assertEqual([], tls_ctx.history)
+        self.assertEqual(full_ctx.get_verify_data(), tls_ctx.get_verify_data())
+        self.assertEqual(full_ctx.get_handshake_hash(SHA256), tls_ctx.get_handshake_hash(SHA256))
+        tls_ctx.insert(records[3])
+        self.assertIsNone(tls_ctx.transcript)
+        with self.assertRaises(ValueError):
+            tls_ctx.get_verify_data()
+        tls_ctx.insert(records[4])
+        self.assertEqual([], tls_ctx.history)
+
+    def test_when_policy_is_unknown_then_value_error_is_raised(self):
+        for history_policy in ("handshakes", -1, None):
+            with self.assertRaises(ValueError):
+                tlsc.TLSSessionCtx(history_policy=history_policy)
+
+    def test_sym_keystore_history_is_bounded(self):
+        ctx = tlsc.TLSContext("Client TLS context")
+        keystore = tlsk.EmptySymKeyStore()
+        ctx.sym_keystore = keystore
+        ctx.sym_keystore = keystore
+        self.assertEqual(1, len(ctx.sym_keystore_history))
+        for _ in range(tlsc.TLSContext.SYM_KEYSTORE_HISTORY_SIZE * 2):
+            ctx.sym_keystore = tlsk.EmptySymKeyStore()
+        self.assertEqual(tlsc.TLSContext.SYM_KEYSTORE_HISTORY_SIZE, len(ctx.sym_keystore_history))
+        self.assertIs(ctx.sym_keystore, ctx.sym_keystore_history[-1])
+
+    def test_contexts_have_no_instance_dict_and_can_be_copied(self):
+        tls_ctx = self.resumed_ctx(tlsc.TLSSessionCtx.HISTORY_ALL, resumed_session_records(0)[:2])
+        for obj in (tls_ctx, tls_ctx.client_ctx, tls_ctx.negotiated):
+            self.assertFalse(hasattr(obj, "__dict__"))
+        copied = copy.copy(tls_ctx)
+        self.assertIs(tls_ctx.negotiated, copied.negotiated)
+        self.assertEqual(tls_ctx.master_secret, copied.master_secret)
+        copied.insert(resumed_session_records(0)[2])
+        self.assertEqual(tls_ctx.get_verify_data(), copied.get_verify_data())
+
+
 class TestTLSSecurityParameters(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,72 @@
+#! -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_engine as tlse
+
+
+def integration_key_file(file):
+    return os.path.join(os.path.dirname(__file__), 'integration', 'keys', file)
+
+
+def server_engine(cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA):
+    engine = tlse.TLSEngine(client=False)
+    engine.tls_ctx.server_ctx.load_rsa_keys_from_file(integration_key_file("key.pem"))
+    with open(integration_key_file("cert.der"), "rb") as f:
+        engine.accept_handshake([tls.TLSCertificate(data=f.read())], cipher_suite)
+    return engine
+
+
+def transfer(source, destination, chunk_size=None):
+    data = source.data_to_send()
+    chunk_size = chunk_size or max(len(data), 1)
+    records = []
+    for offset in range(0, len(data), chunk_size):
+        records.extend(destination.feed_incoming(data[offset:offset + chunk_size]))
+    return records
+
+
+class TestTLSEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.client = tlse.TLSEngine()
+        self.server = server_engine()
+
+    def _handshake(self, chunk_size=None):
+        hello = self.client.start_handshake(tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+        self.server.feed_incoming(hello)
+        transfer(self.server, self.client, chunk_size)
+        transfer(self.client, self.server, chunk_size)
+        return transfer(self.server, self.client, chunk_size)
+
+    def test_when_engines_are_looped_back_then_handshake_completes_without_sockets(self):
+        records = self._handshake()
+        self.assertTrue(self.client.handshake_complete)
+        self.assertTrue(self.server.handshake_complete)
+        self.assertTrue(any(record.haslayer(tls.TLSFinished) for record in records))
+        self.assertEqual("", self.client.data_to_send())
+        self.assertEqual("", self.server.data_to_send())
+
+    def test_when_data_arrives_in_small_chunks_then_records_are_decrypted_once_complete(self):
+        self._handshake(chunk_size=5)
+        self.assertTrue(self.client.handshake_complete)
+        data = self.client.send(tls.TLSPlaintext(data="ping"))
+        self.assertEqual([], self.server.feed_incoming(data[:-1]))
+        records = self.server.feed_incoming(data[-1:])
+        self.assertEqual("ping", records[0][tls.TLSPlaintext].data)
+        records = self.client.feed_incoming(self.server.send(tls.TLSPlaintext(data="pong")))
+        self.assertEqual("pong", records[0][tls.TLSPlaintext].data)
+
+    def test_when_peer_sends_fatal_alert_then_protocol_error_is_raised(self):
+        self.client.start_handshake(tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+        alert = tls.TLSRecord() / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                               description=tls.TLSAlertDescription.HANDSHAKE_FAILURE)
+        with self.assertRaises(tls.TLSProtocolError):
+            self.client.feed_incoming(str(alert))
+        self.assertEqual(tlse.TLSEngine.FAILED, self.client.state)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import binascii
+import os
 import unittest
 
 from Cryptodome.PublicKey import RSA
+from scapy.layers import x509
 import scapy_ssl_tls.ssl_tls_keystore as tlsk
 
 
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
 class TestAsymKeyStore(unittest.TestCase):
 
     def setUp(self):
@@ -59,3 +65,69 @@ class TestTLSKeystoreTopLevelFunctions(unittest.TestCase):
         with self.assertRaises(ValueError):
             tlsk.ansi_str_to_point("\x04123")
         self.assertEqual(tlsk.ansi_str_to_point("\x04123456"), (x, y))
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_when_cache_is_full_then_least_recently_used_entry_is_evicted(self):
+        cache = tlsk.LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # Touch "a" so "b" becomes the eviction candidate
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_when_key_is_missing_then_default_is_returned_and_miss_is_counted(self):
+        cache = tlsk.LRUCache(maxsize=1)
+        self.assertEqual("default", cache.get("missing", "default"))
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(0, cache.hits)
+
+    def test_when_size_is_not_positive_then_exception_is_raised(self):
+        with self.assertRaises(ValueError):
+            tlsk.LRUCache(maxsize=0)
+
+
+class TestCertificateCache(unittest.TestCase):
+
+    def setUp(self):
+        with open(env_local_file("openssl_1_0_1_f_server.pem")) as f:
+            pem = f.read()
+        self.pem_cert = pem[pem.index("-----BEGIN CERTIFICATE-----"):pem.index("-----END CERTIFICATE-----") + 25]
+        self.der_cert = tlsk.pem_to_der(self.pem_cert)
+
+    def test_when_same_certificate_is_seen_twice_then_it_is_parsed_once(self):
+        cache = tlsk.CertificateCache()
+        info = cache.get_info(self.der_cert)
+        self.assertIs(info, cache.get_info(self.der_cert))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_when_certificate_is_parsed_then_key_and_metadata_are_available(self):
+        info = tlsk.CertificateCache().get_info(self.der_cert)
+        self.assertEqual(tlsk.rsa_public_from_pem_certificate(self.pem_cert), info.public)
+        self.assertEqual(2048, info.size)
+        self.assertEqual(binascii.unhexlify("51ab293c9fe391eeeb1a2739de15cd8029e3033142962c6c386f2da78d03a945"),
+                         info.fingerprint)
+
+    def test_when_keystore_is_built_from_certificate_then_cache_is_shared(self):
+        cache = tlsk.CertificateCache()
+        keystore1 = tlsk.RSAKeystore.from_der_certificate(self.der_cert, cache)
+        keystore2 = tlsk.RSAKeystore.from_der_certificate(self.der_cert, cache)
+        self.assertIs(keystore1.public, keystore2.public)
+        self.assertEqual(self.der_cert, keystore2.certificate)
+        self.assertEqual(1, len(cache))
+
+    def test_when_walking_der_then_subject_public_key_info_is_extracted(self):
+        spki = tlsk.der_subject_public_key_info(self.der_cert)
+        self.assertEqual(str(x509.X509_Cert(self.der_cert).tbsCertificate.subjectPublicKeyInfo), spki)
+        self.assertEqual(tlsk.rsa_public_from_pem_certificate(self.pem_cert), RSA.importKey(spki))
+
+    def test_when_certificate_is_truncated_then_der_walker_raises(self):
+        with self.assertRaises(ValueError):
+            tlsk.der_subject_public_key_info(self.der_cert[:300])
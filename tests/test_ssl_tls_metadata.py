@@ -0,0 +1,140 @@
+#! -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import struct
+import unittest
+
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_metadata as tlsm
+import scapy_ssl_tls.ssl_tls_pipeline as tlsp
+import scapy_ssl_tls.ssl_tls_stream as tlss
+
+
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
+def handshake_records(handshakes, *splits):
+    """ Returns the handshake records carrying handshakes, cut at the splits offsets
+    """
+    data = "".join(str(handshake) for handshake in handshakes)
+    bounds = (0,) + splits + (len(data),)
+    return [struct.pack("!BHH", tls.TLSContentType.HANDSHAKE, tls.TLSVersion.TLS_1_2, end - start) + data[start:end]
+            for start, end in zip(bounds, bounds[1:])]
+
+
+class TestHandshakeExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ("10.0.0.1", 40000)
+        self.server = ("10.0.0.2", 443)
+        self.flow = tlss.TLSFlow(tlss.flow_key(*(self.server + self.client)), self.server, self.client, timestamp=1)
+        self.extractor = tlsm.HandshakeExtractor()
+
+    def test_when_client_hello_is_seen_then_offer_is_extracted(self):
+        extensions = [tls.TLSExtension() / tls.TLSExtServerNameIndication(server_names=[tls.TLSServerName(
+                      data="www.example.com")]),
+                      tls.TLSExtension() / tls.TLSExtALPN(),
+                      tls.TLSExtension() / tls.TLSExtSupportedVersions(versions=[tls.TLSVersion.TLS_1_3,
+                                                                                 tls.TLSVersion.TLS_1_2])]
+        client_hello = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello(
+            cipher_suites=[tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_GCM_SHA256], extensions=extensions)])
+        self.assertEqual((), self.extractor.handle_record(self.flow, self.client, str(client_hello)))
+        # The ClientHello fixes up the direction of a flow picked up midstream
+        self.assertEqual(self.client, self.flow.client)
+        metadata, = self.extractor.handle_evict(self.flow, tlss.FlowTable.EVICT_IDLE)
+        self.assertEqual("www.example.com", metadata.sni)
+        self.assertEqual(["h2", "http/1.1"], metadata.alpn_offered)
+        self.assertEqual(["TLS_1_3", "TLS_1_2"], metadata.versions_offered)
+        self.assertEqual(["ECDHE_RSA_WITH_AES_128_GCM_SHA256"], metadata.ciphers_offered)
+        self.assertEqual(("10.0.0.1", 40000, "10.0.0.2", 443),
+                         (metadata.client_ip, metadata.client_port, metadata.server_ip, metadata.server_port))
+        self.assertIsNone(metadata.version)
+
+    def test_when_client_hello_is_fragmented_then_it_is_reassembled(self):
+        extensions = [tls.TLSExtension() / tls.TLSExtServerNameIndication(server_names=[tls.TLSServerName(
+                      data="www.example.com")])]
+        client_hello = tls.TLSHandshake() / tls.TLSClientHello(
+            cipher_suites=[tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_GCM_SHA256], extensions=extensions)
+        # The first fragment does not even hold the whole handshake header
+        for record in handshake_records([client_hello], 2, 60):
+            self.extractor.handle_record(self.flow, self.client, record)
+        metadata, = self.extractor.handle_evict(self.flow, tlss.FlowTable.EVICT_IDLE)
+        self.assertEqual("www.example.com", metadata.sni)
+        self.assertEqual(["ECDHE_RSA_WITH_AES_128_GCM_SHA256"], metadata.ciphers_offered)
+        self.assertEqual({}, self.flow.info["fragments"])
+
+    def test_when_certificate_is_fragmented_then_it_is_reassembled(self):
+        with open(os.path.join(os.path.dirname(__file__), "integration", "keys", "cert.der"), "rb") as f:
+            der = f.read()
+        server_hello = tls.TLSHandshake() / tls.TLSServerHello(cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+        certificate = tls.TLSHandshake() / tls.TLSCertificateList() / tls.TLS10Certificate(
+            certificates=[tls.TLSCertificate(data=der)])
+        # The ServerHello shares its record with the start of the Certificate
+        records = handshake_records([server_hello, certificate], len(str(server_hello)) + 100)
+        self.extractor.handle_record(self.flow, self.server, records[0])
+        self.assertIsNone(self.flow.info["handshake"].cert_sha256)
+        self.assertEqual("RSA_WITH_AES_128_CBC_SHA", self.flow.info["handshake"].cipher)
+        self.extractor.handle_record(self.flow, self.server, records[1])
+        metadata, = self.extractor.handle_evict(self.flow, tlss.FlowTable.EVICT_IDLE)
+        self.assertEqual(hashlib.sha256(der).hexdigest(), metadata.cert_sha256)
+
+    def test_when_records_are_encrypted_then_they_are_not_dissected(self):
+        alert = str(tls.TLSRecord() / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                                   description=tls.TLSAlertDescription.HANDSHAKE_FAILURE))
+        self.extractor.handle_record(self.flow, self.server, alert)
+        self.extractor.handle_record(self.flow, self.client, str(tls.TLSRecord() / tls.TLSChangeCipherSpec()))
+        # Garbage would not dissect, it is only counted as an encrypted alert
+        self.extractor.handle_record(self.flow, self.client, "\x15\x03\x01\x00\x02\xff\xff")
+        metadata, = self.extractor.handle_evict(self.flow, tlss.FlowTable.EVICT_CLOSED)
+        self.assertEqual(["fatal:handshake_failure", "encrypted"], metadata.alerts)
+
+    def test_when_flow_has_no_record_then_nothing_is_exported(self):
+        self.assertEqual((), self.extractor.handle_evict(self.flow, tlss.FlowTable.EVICT_IDLE))
+
+    def test_when_extracting_from_pcap_then_handshake_is_summarized(self):
+        extractor = tlsm.HandshakeExtractor()
+        pipeline = tlsp.ShardedPipeline(extractor.handle_record, workers=0, on_evict=extractor.handle_evict)
+        metadata, = pipeline.run_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap"))
+        self.assertEqual(("192.168.220.1", 12046), (metadata.client_ip, metadata.client_port))
+        self.assertEqual("TLS_1_0", metadata.version)
+        self.assertEqual("RSA_WITH_AES_128_CBC_SHA", metadata.cipher)
+        self.assertIn(metadata.cipher, metadata.ciphers_offered)
+        self.assertEqual("b03bca14b20df9c073bd7b774c65b5211fcea24ec750c69d10d7e96847abd56d", metadata.cert_sha256)
+        self.assertLess(metadata.first_seen, metadata.last_seen)
+
+
+class TestMetadataWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.metadata = [tlsm.HandshakeMetadata(client_ip="10.0.0.%d" % i, sni="a,b", alerts=["fatal:x", "y"])
+                         for i in range(5)]
+
+    def test_when_writing_ndjson_then_lines_are_written_in_batches(self):
+        out = StringIO()
+        writer = tlsm.NDJSONWriter(out, batch_size=2)
+        writer.writeall(self.metadata[:3])
+        self.assertEqual(2, len(out.getvalue().splitlines()))
+        writer.close()
+        lines = [json.loads(line, object_pairs_hook=OrderedDict) for line in out.getvalue().splitlines()]
+        self.assertEqual(3, len(lines))
+        self.assertEqual(list(tlsm.HandshakeMetadata.FIELDS), lines[0].keys())
+        self.assertEqual(["fatal:x", "y"], lines[2]["alerts"])
+
+    def test_when_writing_csv_then_header_and_escaped_rows_are_written(self):
+        out = StringIO()
+        with tlsm.CSVWriter(out) as writer:
+            writer.writeall(self.metadata)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(",".join(tlsm.HandshakeMetadata.FIELDS), lines[0])
+        self.assertEqual(5, writer.written)
+        self.assertEqual(',,10.0.0.4,,,,,,"a,b",,,,,,fatal:x;y', lines[5])
+
+
+if __name__ == "__main__":
+    unittest.main()
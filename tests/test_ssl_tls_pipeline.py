@@ -0,0 +1,200 @@
+#! -*- coding: utf-8 -*-
+
+import os
+import socket
+import struct
+import unittest
+
+import scapy_ssl_tls.ssl_tls_pipeline as tlsp
+import scapy_ssl_tls.ssl_tls_stream as tlss
+
+from scapy.all import Dot1Q, Ether, IP, IPv6, TCP, UDP
+
+
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
+def tls_record(data):
+    return struct.pack("!BHH", 0x17, 0x0301, len(data)) + data
+
+
+def record_handler(flow, source, record):
+    return [(source, record)]
+
+
+def failing_handler(flow, source, record):
+    raise ValueError("boom")
+
+
+def synthetic_capture(num_flows=20, records_per_flow=5):
+    # Interleaves the segments of many flows, each record split in two segments
+    packets = []
+    for record_nb in range(records_per_flow):
+        for flow_nb in range(num_flows):
+            client = "10.0.%d.%d" % (flow_nb // 256, flow_nb % 256)
+            record = tls_record("%d-%d" % (flow_nb, record_nb) * 10)
+            seq = 1 + record_nb * len(record)
+            for offset in (0, 7):
+                payload = record[offset:offset + 7] if offset == 0 else record[offset:]
+                pkt = Ether() / IP(src=client, dst="10.1.0.1") / TCP(sport=40000, dport=443, flags="A",
+                                                                     seq=seq + offset) / payload
+                packets.append((tlsp.DLT_EN10MB, float(record_nb), str(pkt)))
+    return packets
+
+
+class TestRawFlowKey(unittest.TestCase):
+
+    def test_when_packet_is_tcp_over_ipv4_then_key_is_normalized(self):
+        pkt = str(Ether() / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=443))
+        reply = str(Ether() / IP(src="10.0.0.2", dst="10.0.0.1") / TCP(sport=443, dport=1234))
+        key = tlsp.raw_flow_key(tlsp.DLT_EN10MB, pkt)
+        self.assertEqual(((socket.inet_aton("10.0.0.1"), 1234), (socket.inet_aton("10.0.0.2"), 443)), key)
+        self.assertEqual(key, tlsp.raw_flow_key(tlsp.DLT_EN10MB, reply))
+
+    def test_when_packet_is_vlan_tagged_or_ipv6_then_key_is_extracted(self):
+        vlan = str(Ether() / Dot1Q(vlan=3) / IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=1234, dport=443))
+        self.assertIsNotNone(tlsp.raw_flow_key(tlsp.DLT_EN10MB, vlan))
+        ipv6 = str(IPv6(src="::1", dst="::2") / TCP(sport=1234, dport=443))
+        self.assertEqual(((socket.inet_pton(socket.AF_INET6, "::1"), 1234),
+                          (socket.inet_pton(socket.AF_INET6, "::2"), 443)), tlsp.raw_flow_key(101, ipv6))
+
+    def test_when_packet_is_not_tcp_then_no_key_is_returned(self):
+        self.assertIsNone(tlsp.raw_flow_key(tlsp.DLT_EN10MB, str(Ether() / IP() / UDP())))
+        self.assertIsNone(tlsp.raw_flow_key(tlsp.DLT_EN10MB, str(Ether() / IP() / TCP())[:30]))
+
+    def test_shard_is_stable_and_in_range(self):
+        key = tlsp.raw_flow_key(tlsp.DLT_EN10MB, str(Ether() / IP() / TCP()))
+        self.assertEqual(tlsp.shard_of(key, 7), tlsp.shard_of(key, 7))
+        self.assertTrue(0 <= tlsp.shard_of(key, 7) < 7)
+
+
+class TestTLSPreFilter(unittest.TestCase):
+
+    def _packet(self, payload="", flags="A", sport=40000, dport=8443, reply=False):
+        src, dst = ("10.0.0.2", "10.0.0.1") if reply else ("10.0.0.1", "10.0.0.2")
+        pkt = Ether() / IP(src=src, dst=dst) / TCP(sport=sport, dport=dport, flags=flags) / payload
+        # Ethernet pads short frames, the padding must not be mistaken for payload
+        return tlsp.DLT_EN10MB, str(pkt) + "\x00" * 6
+
+    def test_when_segment_is_located_then_payload_excludes_padding(self):
+        linktype, data = self._packet("\x16\x03\x01")
+        source, destination, seq, flags, start, end = tlsp.raw_tcp_segment(linktype, data)
+        self.assertEqual((socket.inet_aton("10.0.0.1"), 40000), source)
+        self.assertEqual("\x16\x03\x01", data[start:end])
+        self.assertEqual(tlss.TCPFlags.ACK, flags)
+
+    def test_when_flow_starts_with_tls_then_it_passes_on_any_port(self):
+        prefilter = tlsp.TLSPreFilter()
+        self.assertFalse(prefilter.accept(*self._packet(flags="S")))
+        self.assertFalse(prefilter.accept(*self._packet()))
+        self.assertTrue(prefilter.accept(*self._packet(tls_record("hello"), flags="PA")))
+        # Continuation segments of a TLS flow don't start with a record header
+        self.assertTrue(prefilter.accept(*self._packet("continued", flags="PA", sport=8443, dport=40000, reply=True)))
+        # A new connection reusing the ports of a TLS flow
+        self.assertTrue(prefilter.accept(*self._packet(flags="S")))
+        self.assertEqual((3, 2), (prefilter.passed, prefilter.dropped))
+
+    def test_when_flow_is_not_tls_then_payload_is_dropped(self):
+        prefilter = tlsp.TLSPreFilter()
+        self.assertFalse(prefilter.accept(*self._packet("GET / HTTP/1.1\r\n", flags="PA", dport=443)))
+        self.assertTrue(prefilter.accept(*self._packet(flags="FA", dport=443)))
+        self.assertFalse(prefilter.accept(tlsp.DLT_EN10MB, str(Ether() / IP() / UDP() / tls_record("x"))))
+
+    def test_when_tls_flows_exceed_limit_then_oldest_are_forgotten(self):
+        prefilter = tlsp.TLSPreFilter(max_flows=2)
+        for sport in (1, 2, 3):
+            prefilter.accept(*self._packet(tls_record("x"), sport=sport))
+        self.assertEqual(2, len(prefilter.tls_flows))
+        self.assertFalse(prefilter.accept(*self._packet("continued", sport=1)))
+        self.assertTrue(prefilter.accept(*self._packet("continued", sport=3)))
+
+    def test_when_flow_starts_with_plaintext_then_records_after_it_are_reassembled(self):
+        client, server = ("10.0.0.1", 40000), ("10.0.0.2", 25)
+        seq = {client: 1000, server: 5000}
+        packets = []
+
+        def send(source, payload="", flags="A"):
+            destination = server if source == client else client
+            pkt = Ether() / IP(src=source[0], dst=destination[0]) / TCP(sport=source[1], dport=destination[1],
+                                                                         seq=seq[source], flags=flags) / payload
+            seq[source] += len(payload) + (1 if "S" in flags else 0)
+            packets.append((tlsp.DLT_EN10MB, float(len(packets)), str(pkt)))
+
+        send(client, flags="S")
+        send(server, flags="SA")
+        send(server, "220 mail.example.com ESMTP\r\n", "PA")
+        send(client, "STARTTLS\r\n", "PA")
+        send(server, "220 Go ahead\r\n", "PA")
+        send(client, tls_record("client hello"), "PA")
+        send(server, tls_record("server hello"), "PA")
+        records = [(source, record) for _, source, record in
+                   tlss.FlowTable().reassemble(tlsp.decode_packets(tlsp.TLSPreFilter()(packets)))]
+        self.assertEqual([(client, tls_record("client hello")), (server, tls_record("server hello"))], records)
+
+    def test_when_filtering_pcap_then_no_tls_record_is_lost(self):
+        prefilter = tlsp.TLSPreFilter()
+        raw_packets = list(tlsp.iter_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap")))
+        records = list(tlss.FlowTable().reassemble(tlsp.decode_packets(prefilter(raw_packets))))
+        self.assertEqual(16, len(records))
+        self.assertEqual(len(raw_packets), prefilter.passed + prefilter.dropped)
+        self.assertGreater(prefilter.dropped, 0)
+
+
+class TestStreamingInput(unittest.TestCase):
+
+    def test_when_decoding_then_packets_are_dissected_lazily_with_timestamps(self):
+        raw_packets = tlsp.iter_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap"))
+        packets = tlsp.decode_packets(raw_packets)
+        pkt = next(packets)
+        self.assertTrue(pkt.haslayer(TCP))
+        self.assertEqual(12046, pkt[TCP].sport)
+        self.assertGreater(pkt.time, 1e9)
+        self.assertEqual(18, len(list(packets)))
+
+    def test_when_metering_then_progress_is_reported_in_bytes_per_second(self):
+        ticks = iter(range(100))
+        reports = []
+        meter = tlsp.ProgressMeter(lambda m: reports.append((m.bytes, m.rate)), total=400, interval=2,
+                                   clock=lambda: next(ticks))
+        packets = [(tlsp.DLT_EN10MB, 0.0, "x" * 100)] * 4
+        self.assertEqual(packets, list(meter(packets)))
+        # The clock ticks once per packet, reports are due at 2 and 4, plus the final report at 5
+        self.assertEqual([(200, 100), (400, 100), (400, 80)], reports)
+        self.assertIn("(100%)", str(meter))
+
+
+class TestShardedPipeline(unittest.TestCase):
+
+    def test_when_reading_pcap_then_packets_are_streamed_with_timestamps(self):
+        packets = list(tlsp.iter_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap")))
+        self.assertEqual(19, len(packets))
+        linktype, timestamp, data = packets[0]
+        self.assertEqual(tlsp.DLT_EN10MB, linktype)
+        self.assertGreater(timestamp, 1e9)
+
+    def test_when_sharding_then_results_match_single_process_run_and_stay_ordered_per_flow(self):
+        capture = synthetic_capture()
+        inline = list(tlsp.ShardedPipeline(record_handler, workers=0, batch_size=8).run(capture))
+        sharded = list(tlsp.ShardedPipeline(record_handler, workers=3, batch_size=8, queue_size=2).run(capture))
+        self.assertEqual(20 * 5, len(inline))
+        self.assertEqual(sorted(inline), sorted(sharded))
+        for results in (inline, sharded):
+            per_flow = {}
+            for source, record in results:
+                per_flow.setdefault(source, []).append(record)
+            for records in per_flow.values():
+                self.assertEqual([int(record[5:].split("-")[1][0]) for record in records], range(5))
+
+    def test_when_flows_are_evicted_then_evict_results_are_merged(self):
+        pipeline = tlsp.ShardedPipeline(record_handler, workers=2, on_evict=lambda flow, reason: [reason])
+        results = list(pipeline.run_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap")))
+        self.assertEqual(16 + 1, len(results))
+        self.assertEqual(tlss.FlowTable.EVICT_CLOSED, results[-1])
+        self.assertEqual(19, pipeline.packets)
+        self.assertGreater(pipeline.filtered, 0)
+
+    def test_when_worker_fails_then_error_is_raised(self):
+        pipeline = tlsp.ShardedPipeline(failing_handler, workers=2)
+        with self.assertRaises(RuntimeError):
+            list(pipeline.run(synthetic_capture(num_flows=2, records_per_flow=1)))
@@ -0,0 +1,386 @@
+#! -*- coding: utf-8 -*-
+
+import errno
+import resource
+import socket
+import threading
+import time
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_scan as tlsscan
+
+
+class LocalTLSServer(object):
+    """ Answers each ClientHello with a ServerHello picking the first offered cipher, tracking concurrent connections
+    """
+
+    def __init__(self, host="127.0.0.1", delay=0.05, starttls=False, accepted=None, server_preference=False):
+        self.delay = delay
+        self.starttls = starttls
+        self.accepted = accepted
+        self.server_preference = server_preference
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(128)
+        self.target = self.sock.getsockname()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.connections = 0
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        with self.lock:
+            self.active += 1
+            self.connections += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            if self.starttls:
+                command = conn.recv(8192)
+                conn.sendall("220 go ahead\r\n" if command == "STARTTLS\r\n" else "500 unknown\r\n")
+            client_hello = tls.SSL(conn.recv(8192))
+            time.sleep(self.delay)
+            hello = client_hello[tls.TLSClientHello]
+            conn.sendall(str(self._respond(hello.version, hello.cipher_suites)))
+        finally:
+            with self.lock:
+                self.active -= 1
+            conn.close()
+
+    def _respond(self, version, offered):
+        if self.accepted is None:
+            selectable = offered
+        elif self.server_preference:
+            selectable = [cipher for cipher in self.accepted if cipher in offered]
+        else:
+            selectable = [cipher for cipher in offered if cipher in self.accepted]
+        if not selectable:
+            return tls.TLSRecord(version=version) / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                                                 description=tls.TLSAlertDescription.HANDSHAKE_FAILURE)
+        return tls.TLSRecord(version=version) / \
+            tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSServerHello(version=version,
+                                                                                  cipher_suite=selectable[0])])
+
+    def close(self):
+        self.sock.close()
+
+
+def probe_cipher(target, cipher):
+    sock = socket.create_connection(target, timeout=5)
+    try:
+        sock.sendall(str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                       tls.TLSClientHello(cipher_suites=[cipher])])))
+        return tls.SSL(sock.recv(8192))[tls.TLSServerHello].cipher_suite
+    finally:
+        sock.close()
+
+
+class TestScanScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # Distinct loopback addresses are distinct hosts
+        self.servers = [LocalTLSServer("127.0.0.%d" % i) for i in (1, 2)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def test_when_scanning_many_targets_then_results_are_aggregated_per_target(self):
+        scheduler = tlsscan.ScanScheduler(workers=8, per_host=3)
+        results = dict((server.target, set()) for server in self.servers)
+        active = dict((server.target, [0, 0]) for server in self.servers)
+        lock = threading.Lock()
+
+        def tracked_probe(target, cipher):
+            with lock:
+                active[target][0] += 1
+                active[target][1] = max(active[target])
+            try:
+                return probe_cipher(target, cipher)
+            finally:
+                with lock:
+                    active[target][0] -= 1
+        ciphers = range(0x2f, 0x2f + 10)
+        for server in self.servers:
+            for cipher in ciphers:
+                scheduler.submit(server.target, tracked_probe, (server.target, cipher),
+                                 callback=results[server.target].add)
+        jobs = list(scheduler.run())
+        self.assertEqual(20, len(jobs))
+        self.assertEqual([None] * 20, [job.error for job in jobs])
+        for server in self.servers:
+            self.assertEqual(set(ciphers), results[server.target])
+            self.assertEqual(10, server.connections)
+            # Per host limit applies, while both hosts were scanned at the same time
+            self.assertLessEqual(active[server.target][1], 3)
+            self.assertGreater(server.max_active, 1)
+        self.assertEqual(0, len(scheduler))
+
+    def test_when_workers_are_busy_then_jobs_start_by_priority(self):
+        scheduler = tlsscan.ScanScheduler(workers=1)
+        order = []
+        for priority in (3, 1, 2, 1):
+            scheduler.submit(("10.0.0.%d" % priority, 443), order.append, (priority,), priority=priority)
+        list(scheduler.run())
+        self.assertEqual([1, 1, 2, 3], order)
+
+    def test_when_host_is_rate_limited_then_other_hosts_proceed(self):
+        scheduler = tlsscan.ScanScheduler(workers=4, host_rate=20)
+        started = {}
+        for host in ("10.0.0.1", "10.0.0.2"):
+            for _ in range(4):
+                scheduler.submit((host, 443), lambda: None)
+        for job in scheduler.run():
+            started.setdefault(job.host, []).append(job.started)
+        for starts in started.values():
+            starts.sort()
+            self.assertGreaterEqual(starts[-1] - starts[0], 3 * 0.05 * 0.9)
+        # Hosts were rate limited independently, not one after the other
+        self.assertLess(abs(min(started["10.0.0.1"]) - min(started["10.0.0.2"])), 0.05)
+
+    def test_when_probe_fails_or_submits_then_errors_are_reported_and_followups_run(self):
+        scheduler = tlsscan.ScanScheduler(workers=2)
+        target = self.servers[0].target
+
+        def probe():
+            scheduler.submit(target, probe_cipher, (target, 0x35))
+            raise socket.error("refused")
+        scheduler.submit(target, probe)
+        jobs = list(scheduler.run())
+        self.assertIsInstance(jobs[0].error, socket.error)
+        self.assertEqual(0x35, jobs[1].result)
+
+
+def client_hello(cipher):
+    return tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                           tls.TLSClientHello(cipher_suites=[cipher])])
+
+
+class TestClientHelloTemplate(unittest.TestCase):
+
+    def test_when_fields_are_patched_then_probe_matches_scapy_serialization(self):
+        template = tlsscan.ClientHelloTemplate()
+        extensions = [tls.TLSExtension() / tls.TLSExtSupportedGroups(),
+                      tls.TLSExtension() / tls.TLSExtServerNameIndication(server_names=[tls.TLSServerName(data="a")])]
+        hello = tls.TLSClientHello(version=tls.TLSVersion.TLS_1_0, gmt_unix_time=1, random_bytes="r" * 28,
+                                   cipher_suites=range(1, 300), compression_methods=[0, 1], extensions=extensions)
+        expected = tls.TLSRecord(version=tls.TLSVersion.TLS_1_2) / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                                              hello])
+        probe = template.build(version=tls.TLSVersion.TLS_1_0, record_version=tls.TLSVersion.TLS_1_2,
+                               random="\x00\x00\x00\x01" + "r" * 28, cipher_suites=range(1, 300),
+                               compression_methods=[0, 1], extensions=[str(extension) for extension in extensions])
+        self.assertEqual(str(expected), probe)
+        self.assertEqual(range(1, 300), tls.SSL(probe)[tls.TLSClientHello].cipher_suites)
+
+    def test_when_fields_are_not_patched_then_template_fields_are_kept(self):
+        pkt = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSClientHello(
+            session_id="s" * 32, extensions=[tls.TLSExtension() / tls.TLSExtECPointsFormat()])])
+        template = tlsscan.ClientHelloTemplate(pkt)
+        self.assertEqual(str(pkt), template.build())
+        hello = tls.SSL(template.build(cipher_suites=[0x35], extensions=[]))[tls.TLSClientHello]
+        self.assertEqual("s" * 32, hello.session_id)
+        self.assertEqual([0x35], hello.cipher_suites)
+        self.assertEqual([], hello.extensions)
+
+    def test_when_template_is_not_a_client_hello_record_then_it_is_rejected(self):
+        with self.assertRaises(ValueError):
+            tlsscan.ClientHelloTemplate(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                                       tls.TLSServerHello()]))
+        with self.assertRaises(ValueError):
+            tlsscan.ClientHelloTemplate().build(random="short")
+
+
+class TestFlightComplete(unittest.TestCase):
+
+    def test_when_flight_ends_with_server_hello_done_then_it_is_complete(self):
+        hello = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSServerHello()]))
+        done = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() / tls.TLSServerHelloDone()]))
+        self.assertFalse(tlsscan.flight_complete([hello]))
+        self.assertTrue(tlsscan.flight_complete([hello, done]))
+
+    def test_when_server_hello_is_tls13_or_an_alert_is_read_then_flight_is_complete(self):
+        hello = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                tls.TLSServerHello(version=tls.TLSVersion.TLS_1_3)])
+        self.assertTrue(tlsscan.flight_complete([str(hello)]))
+        self.assertTrue(tlsscan.flight_complete([str(tls.TLSRecord() / tls.TLSAlert())]))
+        self.assertFalse(tlsscan.flight_complete([]))
+
+    def test_when_hello_retry_request_is_read_then_flight_is_complete(self):
+        hello_retry_request = tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSHelloRetryRequest(version=tls.tls_draft_version(18))])
+        self.assertTrue(tlsscan.flight_complete([str(hello_retry_request)]))
+
+
+class TestTLS13Hello(unittest.TestCase):
+
+    def test_hello_offers_version_and_a_key_share_of_each_group(self):
+        groups = [tls.TLSSupportedGroup.SECP384R1, tls.TLSSupportedGroup.SECP256R1]
+        hello = tls.SSL(tlsscan.tls13_hello(tls.tls_draft_version(18), [0x1301], groups))[tls.TLSClientHello]
+        self.assertEqual(tls.TLSVersion.TLS_1_2, hello.version)
+        self.assertEqual([0x1301], hello.cipher_suites)
+        self.assertEqual([tls.tls_draft_version(18)], hello[tls.TLSExtSupportedVersions].versions)
+        self.assertEqual(groups, [entry.named_group for entry in hello[tls.TLSClientHelloKeyShare].client_shares])
+
+    def test_key_shares_are_generated_once_per_group(self):
+        self.assertIs(tlsscan.key_share_entry(tls.TLSSupportedGroup.SECP256R1),
+                      tlsscan.key_share_entry(tls.TLSSupportedGroup.SECP256R1))
+
+
+class TestProbeReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.server = LocalTLSServer(delay=0.2)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_when_probing_many_ciphers_then_they_run_concurrently_from_one_thread(self):
+        reactor = tlsscan.ProbeReactor(per_host=50, timeout=5)
+        ciphers = range(0x01, 0x01 + 50)
+        selected = []
+
+        def on_response(conn):
+            selected.append(tls.SSL(conn.response)[tls.TLSServerHello].cipher_suite)
+        for cipher in ciphers:
+            reactor.submit(self.server.target, client_hello(cipher), callback=on_response)
+        self.assertEqual(50, len(reactor))
+        start = time.time()
+        conns = list(reactor.run())
+        # Sequential probes would take 50 times the server delay
+        self.assertLess(time.time() - start, 50 * 0.2 / 4)
+        self.assertEqual([None] * 50, [conn.error for conn in conns])
+        self.assertEqual(sorted(ciphers), sorted(selected))
+        self.assertGreater(self.server.max_active, 1)
+        self.assertEqual(0, len(reactor))
+
+    def test_when_host_limit_is_set_then_it_is_not_exceeded(self):
+        reactor = tlsscan.ProbeReactor(per_host=2, timeout=5)
+        for cipher in range(0x01, 0x01 + 6):
+            reactor.submit(self.server.target, client_hello(cipher))
+        self.assertEqual(6, len(list(reactor.run())))
+        self.assertLessEqual(self.server.max_active, 2)
+
+    def test_when_preamble_is_given_then_it_runs_before_the_probe(self):
+        server = LocalTLSServer(delay=0, starttls=True)
+        try:
+            reactor = tlsscan.ProbeReactor(timeout=5)
+            conn = reactor.submit(server.target, client_hello(0x35),
+                                  preamble=tlsscan.starttls_preamble("STARTTLS\\r\\n"))
+            list(reactor.run())
+            self.assertIsNone(conn.error)
+            self.assertEqual(0x35, tls.SSL(conn.response)[tls.TLSServerHello].cipher_suite)
+        finally:
+            server.close()
+
+    def test_when_server_is_silent_or_unreachable_then_errors_are_reported(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.bind(("127.0.0.1", 0))
+        silent.listen(1)
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(("127.0.0.1", 0))
+        try:
+            reactor = tlsscan.ProbeReactor(timeout=0.2)
+            timed_out = reactor.submit(silent.getsockname(), client_hello(0x35))
+            refused = reactor.submit(closed.getsockname(), client_hello(0x35))
+            self.assertEqual(2, len(list(reactor.run())))
+            self.assertIsInstance(timed_out.error, socket.timeout)
+            self.assertIsInstance(refused.error, socket.error)
+            self.assertEqual([], refused.records)
+        finally:
+            silent.close()
+            closed.close()
+
+    def test_when_host_is_a_name_then_it_is_resolved_before_the_probe_runs(self):
+        reactor = tlsscan.ProbeReactor(timeout=5)
+        resolved = reactor.submit(("localhost", self.server.target[1]), client_hello(0x35))
+        unresolved = reactor.submit(("127.0.0.1", "no-such-service"), client_hello(0x35))
+        self.assertEqual(("127.0.0.1", self.server.target[1]), resolved.address)
+        self.assertEqual(2, len(reactor))
+        self.assertEqual([unresolved, resolved], list(reactor.run()))
+        self.assertIsNone(resolved.error)
+        self.assertIsInstance(unresolved.error, socket.gaierror)
+
+    def test_when_socket_cannot_be_created_then_error_is_reported(self):
+        reactor = tlsscan.ProbeReactor(timeout=5)
+        conn = reactor.submit(self.server.target, client_hello(0x35))
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (0, limits[1]))
+        try:
+            conns = list(reactor.run())
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        self.assertEqual([conn], conns)
+        self.assertEqual(errno.EMFILE, conn.error.errno)
+        self.assertEqual(0, len(reactor))
+
+
+class TestCipherSuiteEnumeration(unittest.TestCase):
+    ACCEPTED = [0x35, 0xc02f, 0x2f, 0x0a]
+
+    def _enumerate(self, server, version=tls.TLSVersion.TLS_1_2, **kwargs):
+        reactor = tlsscan.ProbeReactor(timeout=5)
+        enumeration = tlsscan.CipherSuiteEnumeration(server.target, version, **kwargs).start(reactor)
+        list(reactor.run())
+        self.assertTrue(enumeration.done)
+        return enumeration
+
+    def test_when_server_enforces_its_preference_then_its_order_is_found_with_few_connections(self):
+        server = LocalTLSServer(delay=0, accepted=self.ACCEPTED, server_preference=True)
+        try:
+            responses = []
+            enumeration = self._enumerate(server, on_response=responses.append)
+            self.assertEqual(self.ACCEPTED, enumeration.accepted)
+            self.assertTrue(enumeration.server_preference)
+            # One connection per accepted suite, one refused, one to check the preference
+            self.assertEqual(len(self.ACCEPTED) + 2, enumeration.connections)
+            self.assertEqual(enumeration.connections, server.connections)
+            self.assertEqual(enumeration.connections, len(responses))
+            self.assertIsNone(enumeration.error)
+        finally:
+            server.close()
+
+    def test_when_server_follows_client_order_then_no_preference_is_reported(self):
+        server = LocalTLSServer(delay=0, accepted=self.ACCEPTED)
+        try:
+            enumeration = self._enumerate(server)
+            self.assertEqual(sorted(self.ACCEPTED), enumeration.accepted)
+            self.assertFalse(enumeration.server_preference)
+        finally:
+            server.close()
+
+    def test_when_no_candidate_is_accepted_then_one_connection_is_made(self):
+        server = LocalTLSServer(delay=0, accepted=self.ACCEPTED)
+        try:
+            done = []
+            enumeration = self._enumerate(server, candidates=[0x01, 0x02], on_done=done.append)
+            self.assertEqual([], enumeration.accepted)
+            self.assertIsNone(enumeration.server_preference)
+            self.assertEqual(1, enumeration.connections)
+            self.assertEqual([enumeration], done)
+        finally:
+            server.close()
+
+    def test_when_candidates_default_then_signalling_and_tls13_suites_are_excluded(self):
+        enumeration = tlsscan.CipherSuiteEnumeration(("127.0.0.1", 443), tls.TLSVersion.TLS_1_2)
+        self.assertGreater(len(enumeration.remaining), 300)
+        self.assertNotIn(tls.TLSCipherSuite.FALLBACK_SCSV, enumeration.remaining)
+        self.assertNotIn(tls.TLSCipherSuite.EMPTY_RENEGOTIATION_INFO_SCSV, enumeration.remaining)
+        self.assertNotIn(0x1301, enumeration.remaining)
+
+
+if __name__ == "__main__":
+    unittest.main()
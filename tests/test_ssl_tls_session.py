@@ -0,0 +1,229 @@
+#! -*- coding: utf-8 -*-
+
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_crypto as tlsc
+import scapy_ssl_tls.ssl_tls_session as tlssess
+
+
+def hello_ctx(client_session_id, server_session_id, master_secret="\x01" * 48, ticket=None):
+    tls_ctx = tlsc.TLSSessionCtx()
+    tls_ctx.resume_session(master_secret)
+    extensions = [tls.TLSExtension() / tls.TLSExtSessionTicketTLS(data=ticket)] if ticket is not None else []
+    tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+        tls.TLSHandshake() / tls.TLSClientHello(session_id=client_session_id, extensions=extensions)]))
+    tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+        tls.TLSHandshake() / tls.TLSServerHello(session_id=server_session_id,
+                                                cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)]))
+    return tls_ctx
+
+
+class TestResumption(unittest.TestCase):
+
+    def test_when_server_echoes_session_id_then_session_is_resumed(self):
+        tls_ctx = hello_ctx("a" * 32, "a" * 32)
+        self.assertTrue(tls_ctx.negotiated.resumption)
+        self.assertEqual("\x01" * 48, tls_ctx.master_secret)
+        self.assertIsNotNone(tls_ctx.sec_params)
+
+    def test_when_server_assigns_new_session_id_then_handshake_falls_back_to_full(self):
+        tls_ctx = hello_ctx("a" * 32, "b" * 32)
+        self.assertFalse(tls_ctx.negotiated.resumption)
+        self.assertIsNone(tls_ctx.master_secret)
+        self.assertIsNone(tlssess.TLSSession.from_ctx(tls_ctx))
+
+
+class TestClientSessionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = tlssess.ClientSessionCache(maxsize=2, lifetime=100, clock=lambda: self.now)
+
+    def test_when_session_is_negotiated_then_it_is_cached_by_peer_and_sni(self):
+        session = self.cache.update("10.0.0.1", 443, "example.com", hello_ctx("a" * 32, "a" * 32))
+        self.assertEqual("a" * 32, session.session_id)
+        self.assertEqual(tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, session.cipher_suite)
+        self.assertIs(session, self.cache.get("10.0.0.1", 443, "example.com"))
+        self.assertIsNone(self.cache.get("10.0.0.1", 443))
+
+    def test_when_lifetime_passed_then_session_expires(self):
+        self.cache.update("10.0.0.1", 443, None, hello_ctx("a" * 32, "a" * 32))
+        self.now += 99
+        self.assertIsNotNone(self.cache.get("10.0.0.1", 443))
+        self.now += 1
+        self.assertIsNone(self.cache.get("10.0.0.1", 443))
+        self.assertEqual(0, len(self.cache))
+
+    def test_when_ticket_lifetime_is_shorter_then_it_bounds_session_lifetime(self):
+        tls_ctx = hello_ctx("a" * 32, "a" * 32)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSSessionTicket(lifetime=10, ticket="ticket")]))
+        session = self.cache.update("10.0.0.1", 443, None, tls_ctx)
+        self.assertEqual("ticket", session.ticket)
+        self.assertEqual(1010, session.expires)
+
+    def test_when_offered_ticket_is_reused_then_session_keeps_its_expiry(self):
+        tls_ctx = hello_ctx("a" * 32, "a" * 32)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSSessionTicket(lifetime=10, ticket="ticket")]))
+        self.cache.update("10.0.0.1", 443, None, tls_ctx)
+        self.now += 5
+        tls_ctx = hello_ctx("b" * 32, "b" * 32, ticket="ticket")
+        self.assertEqual(0, tls_ctx.ticket.lifetime)
+        session = self.cache.update("10.0.0.1", 443, None, tls_ctx)
+        self.assertEqual("ticket", session.ticket)
+        self.assertEqual(1010, session.expires)
+        self.now += 5
+        self.assertIsNone(self.cache.get("10.0.0.1", 443))
+
+    def test_when_new_ticket_is_issued_on_resumption_then_session_expiry_is_renewed(self):
+        self.cache.update("10.0.0.1", 443, None, hello_ctx("a" * 32, "a" * 32, ticket="ticket"))
+        self.now += 50
+        tls_ctx = hello_ctx("b" * 32, "b" * 32, ticket="ticket")
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSSessionTicket(lifetime=10, ticket="new ticket")]))
+        session = self.cache.update("10.0.0.1", 443, None, tls_ctx)
+        self.assertEqual("new ticket", session.ticket)
+        self.assertEqual(1060, session.expires)
+
+    def test_when_tls13_ticket_is_received_then_resumption_secret_is_cached_as_psk(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.negotiated.version = tls.tls_draft_version(18)
+        tls_ctx.negotiated.ciphersuite = tls.TLSCipherSuite.TLS_AES_128_GCM_SHA256
+        tls_ctx.resumption_secret = "\x02" * 32
+        self.assertIsNone(self.cache.update("10.0.0.1", 443, None, tls_ctx))
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLS13SessionTicket(
+                lifetime=10, age_add=1000, ticket="ticket",
+                extensions=[tls.TLSExtension() / tls.TLSExtTicketEarlyDataInfo(max_early_data_size=512)])]))
+        session = self.cache.update("10.0.0.1", 443, None, tls_ctx)
+        self.assertEqual("\x02" * 32, session.master_secret)
+        self.assertEqual("ticket", session.ticket)
+        self.assertEqual(512, session.max_early_data_size)
+        self.assertEqual(1010, session.expires)
+        self.now += 2.5
+        self.assertEqual(3500, session.obfuscated_ticket_age(self.now))
+
+    def test_when_cache_is_full_then_least_recently_used_session_is_evicted(self):
+        for port in (1, 2):
+            self.cache.update("10.0.0.1", port, None, hello_ctx("a" * 32, "a" * 32))
+        self.cache.get("10.0.0.1", 1)
+        self.cache.update("10.0.0.1", 3, None, hello_ctx("a" * 32, "a" * 32))
+        self.assertIsNotNone(self.cache.get("10.0.0.1", 1))
+        self.assertIsNone(self.cache.get("10.0.0.1", 2))
+
+    def test_when_session_cannot_be_resumed_then_cached_one_is_dropped(self):
+        self.cache.update("10.0.0.1", 443, None, hello_ctx("a" * 32, "a" * 32))
+        self.assertIsNone(self.cache.update("10.0.0.1", 443, None, hello_ctx("a" * 32, "b" * 32)))
+        self.assertIsNone(self.cache.get("10.0.0.1", 443))
+
+    def test_server_name_is_read_from_sni_extension(self):
+        extensions = [tls.TLSExtension() / tls.TLSExtALPN(),
+                      tls.TLSExtension() / tls.TLSExtServerNameIndication(
+                          server_names=[tls.TLSServerName(data="example.com")])]
+        self.assertEqual("example.com", tlssess.server_name(extensions))
+        self.assertIsNone(tlssess.server_name([]))
+
+
+def hello_retry_request(group):
+    return tls.TLS(str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+        tls.TLSHandshake() / tls.TLSHelloRetryRequest(version=tls.tls_draft_version(18), extensions=[
+            tls.TLSExtension() / tls.TLSExtKeyShare() / tls.TLSHelloRetryRequestKeyShare(selected_group=group)])])))
+
+
+class TestKeyShareCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = tlssess.KeyShareCache(maxsize=2, lifetime=100, clock=lambda: self.now)
+
+    def test_when_server_hello_has_a_key_share_then_its_group_is_learnt(self):
+        server_hello = tls.TLS(str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[
+            tls.TLSHandshake() / tls.TLSServerHello(version=tls.tls_draft_version(18), extensions=[
+                tls.TLSExtension() / tls.TLSExtKeyShare() / tls.TLSServerHelloKeyShare(
+                    server_share=tls.TLSKeyShareEntry(named_group=tls.TLSSupportedGroup.SECP521R1))])])))
+        self.assertEqual(tls.TLSSupportedGroup.SECP521R1, self.cache.update("10.0.0.1", 443, server_hello))
+        self.assertEqual(tls.TLSSupportedGroup.SECP521R1, self.cache.get("10.0.0.1", 443))
+        self.assertIsNone(self.cache.update("10.0.0.1", 443, tls.TLS()))
+        self.assertEqual(tls.TLSSupportedGroup.SECP521R1, self.cache.get("10.0.0.1", 443))
+
+    def test_when_group_is_known_then_its_key_share_only_is_predicted(self):
+        groups = (tls.TLSSupportedGroup.SECP256R1, tls.TLSSupportedGroup.SECP384R1)
+        self.assertEqual(groups, self.cache.predict("10.0.0.1", 443, groups))
+        self.cache.update("10.0.0.1", 443, hello_retry_request(tls.TLSSupportedGroup.SECP521R1))
+        self.assertEqual((tls.TLSSupportedGroup.SECP521R1,), self.cache.predict("10.0.0.1", 443, groups))
+        self.assertEqual((), self.cache.predict("10.0.0.1", 443, ()))
+        self.assertEqual(groups, self.cache.predict("10.0.0.1", 8443, groups))
+
+    def test_when_lifetime_passed_then_group_is_forgotten(self):
+        self.cache.set("10.0.0.1", 443, tls.TLSSupportedGroup.SECP384R1)
+        self.now += 99
+        self.assertEqual(tls.TLSSupportedGroup.SECP384R1, self.cache.get("10.0.0.1", 443))
+        self.now += 1
+        self.assertIsNone(self.cache.get("10.0.0.1", 443))
+        self.assertEqual(0, len(self.cache))
+
+
+def client_hello(session_id="", ticket=None, cipher_suites=(tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,)):
+    extensions = [] if ticket is None else [tls.TLSExtension() / tls.TLSExtSessionTicketTLS(data=ticket)]
+    return tls.TLSClientHello(str(tls.TLSClientHello(session_id=session_id, cipher_suites=list(cipher_suites),
+                                                     extensions=extensions)))
+
+
+class TestServerSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.store = tlssess.ServerSessionStore(maxsize=2, lifetime=100, clock=lambda: self.now)
+
+    def test_when_session_is_stored_then_it_is_found_until_it_expires(self):
+        session_id = self.store.new_session_id()
+        self.store.store(session_id, hello_ctx("a" * 32, "a" * 32))
+        session = tlssess.find_session(client_hello(session_id), self.store)
+        self.assertEqual("\x01" * 48, session.master_secret)
+        self.now += 100
+        self.assertIsNone(tlssess.find_session(client_hello(session_id), self.store))
+
+    def test_when_cipher_suite_is_not_offered_anymore_then_session_is_not_resumed(self):
+        self.store.store("a" * 32, hello_ctx("a" * 32, "a" * 32))
+        self.assertIsNone(tlssess.find_session(client_hello("a" * 32, cipher_suites=[0x0035]), self.store))
+        self.assertIsNone(tlssess.find_session(client_hello("b" * 32), self.store))
+
+
+class TestTicketKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.keys = tlssess.TicketKeys(lifetime=100, rotate_interval=50, clock=lambda: self.now)
+        self.session = tlssess.TLSSession(master_secret="\x02" * 48, version=tls.TLSVersion.TLS_1_2,
+                                          cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+
+    def test_when_ticket_is_opened_then_session_state_is_restored(self):
+        ticket = self.keys.seal(self.session)
+        self.assertNotIn("\x02" * 48, ticket)
+        session = tlssess.find_session(client_hello(ticket=ticket), ticket_keys=self.keys)
+        self.assertEqual(self.session.master_secret, session.master_secret)
+        self.assertEqual(self.session.cipher_suite, session.cipher_suite)
+        self.assertEqual(1100, session.expires)
+
+    def test_when_ticket_is_tampered_with_or_foreign_then_it_is_rejected(self):
+        ticket = self.keys.seal(self.session)
+        tampered = ticket[:40] + chr(ord(ticket[40]) ^ 1) + ticket[41:]
+        self.assertIsNone(self.keys.open(tampered))
+        self.assertIsNone(tlssess.TicketKeys().open(ticket))
+        self.assertIsNone(self.keys.open("short"))
+
+    def test_when_keys_rotate_then_older_tickets_open_until_they_expire(self):
+        old_ticket = self.keys.seal(self.session)
+        self.now += 50
+        new_ticket = self.keys.seal(self.session)
+        self.assertNotEqual(old_ticket[:16], new_ticket[:16])
+        self.assertIsNotNone(self.keys.open(old_ticket))
+        self.now += 50
+        self.assertIsNone(self.keys.open(old_ticket))
+        self.assertIsNotNone(self.keys.open(new_ticket))
+
+    def test_empty_ticket_extension_is_recognized(self):
+        self.assertTrue(tlssess.offers_ticket(client_hello(ticket="")))
+        self.assertFalse(tlssess.offers_ticket(client_hello()))
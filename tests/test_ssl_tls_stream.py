@@ -0,0 +1,343 @@
+#! -*- coding: utf-8 -*-
+
+import os
+import socket
+import struct
+import time
+import unittest
+
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_crypto as tlsc
+import scapy_ssl_tls.ssl_tls_stream as tlss
+
+from scapy.all import IP, TCP, rdpcap
+
+
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
+def tls_record(content_type=0x17, data="A" * 10):
+    return struct.pack("!BHH", content_type, 0x0301, len(data)) + data
+
+
+class TestTLSRecordLength(unittest.TestCase):
+
+    def test_when_tls_header_is_complete_then_record_length_is_returned(self):
+        self.assertEqual(15, tlss.tls_record_length(bytearray(tls_record())))
+
+    def test_when_header_is_partial_then_none_is_returned(self):
+        self.assertIsNone(tlss.tls_record_length(bytearray("\x16\x03")))
+
+    def test_when_header_is_implausible_then_value_error_is_raised(self):
+        with self.assertRaises(ValueError):
+            tlss.tls_record_length(bytearray("GET / HTTP/1.1"))
+        with self.assertRaises(ValueError):
+            tlss.tls_record_length(bytearray("\x16\x03\x01\xff\xff"))
+
+    def test_when_sslv2_header_is_seen_then_record_length_is_returned(self):
+        self.assertEqual(0x31 + 2, tlss.tls_record_length(bytearray("\x80\x31\x01\x00\x02")))
+        with self.assertRaises(ValueError):
+            tlss.tls_record_length(bytearray("\x80\x31\x01\x00\x02"), sslv2=False)
+
+
+class TestLooksLikeTLS(unittest.TestCase):
+
+    def test_when_payload_starts_with_record_header_then_it_looks_like_tls(self):
+        self.assertTrue(tlss.looks_like_tls(bytearray(tls_record(content_type=0x16))))
+        self.assertTrue(tlss.looks_like_tls(bytearray("\x17\x03")))
+        # SSLv2 CLIENT_HELLO
+        self.assertTrue(tlss.looks_like_tls(bytearray("\x80\x31\x01\x00\x02")))
+
+    def test_when_payload_is_not_tls_then_it_is_rejected(self):
+        self.assertFalse(tlss.looks_like_tls(bytearray("")))
+        self.assertFalse(tlss.looks_like_tls(bytearray("GET / HTTP/1.1\r\n")))
+        self.assertFalse(tlss.looks_like_tls(bytearray("SSH-2.0-OpenSSH_7.4")))
+        self.assertFalse(tlss.looks_like_tls(bytearray("\x16\x03\x01\xff\xff")))
+        self.assertFalse(tlss.looks_like_tls(bytearray("\x80\x31\x42\x00\x02")))
+        self.assertFalse(tlss.looks_like_tls(bytearray("\x80\x31\x01\x00\x02"), sslv2=False))
+
+
+class TestRecvRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.server_hello = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                              tls.TLSServerHello()]))
+        self.hello_done = str(tls.TLSRecord() / tls.TLSHandshakes(handshakes=[tls.TLSHandshake() /
+                                                                            tls.TLSServerHelloDone()]))
+        self.peer, self.sock = socket.socketpair()
+
+    def tearDown(self):
+        self.peer.close()
+        self.sock.close()
+
+    def test_when_predicate_holds_then_reading_returns_without_waiting_for_timeout(self):
+        flight = self.server_hello + self.hello_done
+        # Split within a record header
+        self.peer.sendall(flight[:len(self.server_hello) + 2])
+        self.peer.sendall(flight[len(self.server_hello) + 2:])
+        start = time.time()
+        data = tlss.recv_records(self.sock, tlss.received_server_flight, timeout=5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(flight, data)
+        self.assertIsNone(self.sock.gettimeout())
+
+    def test_when_predicate_does_not_hold_then_reading_stops_on_timeout_or_close(self):
+        self.peer.sendall(self.server_hello)
+        self.assertEqual(self.server_hello, tlss.recv_records(self.sock, tlss.received_server_flight, timeout=0.1))
+        self.peer.sendall(self.server_hello)
+        self.peer.close()
+        self.assertEqual(self.server_hello, tlss.recv_records(self.sock, tlss.received_records(2), timeout=5))
+
+    def test_when_data_is_not_records_then_reading_stops_on_timeout(self):
+        self.peer.sendall("220 ready\r\n")
+        self.assertEqual("220 ready\r\n", tlss.recv_records(self.sock, tlss.received_records(1), timeout=0.1))
+
+    def test_when_flight_is_abbreviated_or_fails_then_server_flight_is_received(self):
+        ccs = str(tls.TLSRecord() / tls.TLSChangeCipherSpec())
+        finished = tls_record(0x16, "encrypted finished")
+        alert = str(tls.TLSRecord() / tls.TLSAlert())
+        self.assertFalse(tlss.received_server_flight([self.server_hello, ccs]))
+        self.assertTrue(tlss.received_server_flight([self.server_hello, ccs, finished]))
+        self.assertTrue(tlss.received_server_flight([alert]))
+        self.assertTrue(tlss.received_server_flight([self.server_hello, self.hello_done]))
+
+    def test_when_messages_span_records_then_they_are_reassembled(self):
+        handshake = self.server_hello[5:] + self.hello_done[5:]
+        records = [tls_record(0x16, handshake[:3]), tls_record(0x16, handshake[3:])]
+        self.assertEqual([tls.TLSHandshakeType.SERVER_HELLO, tls.TLSHandshakeType.SERVER_HELLO_DONE],
+                         [msg_type for msg_type, _ in tlss.handshake_messages(records)])
+        self.assertEqual([], list(tlss.handshake_messages(records[:1])))
+
+
+class TestPoller(unittest.TestCase):
+
+    def test_when_socket_is_ready_then_its_events_are_reported(self):
+        peer, sock = socket.socketpair()
+        try:
+            poller = tlss.Poller()
+            poller.register(sock.fileno(), tlss.Poller.READ | tlss.Poller.WRITE)
+            self.assertEqual([(sock.fileno(), tlss.Poller.WRITE)], list(poller.poll_events(1)))
+            peer.sendall("data")
+            self.assertEqual([(sock.fileno(), tlss.Poller.READ | tlss.Poller.WRITE)], list(poller.poll_events(1)))
+            poller.register(sock.fileno(), tlss.Poller.READ)
+            self.assertEqual([sock.fileno()], list(poller.poll(1)))
+        finally:
+            peer.close()
+            sock.close()
+
+
+class TestTCPStream(unittest.TestCase):
+
+    def setUp(self):
+        self.isn = 1000
+        self.records = [tls_record(data=chr(i) * (i + 20)) for i in range(4)]
+        self.data = "".join(self.records)
+
+    def _stream(self):
+        stream = tlss.TCPStream()
+        stream.feed(self.isn, "", tlss.TCPFlags.SYN)
+        return stream
+
+    def test_when_segments_are_in_order_then_records_are_emitted(self):
+        stream = self._stream()
+        records = []
+        for i in range(0, len(self.data), 7):
+            records.extend(stream.feed(self.isn + 1 + i, self.data[i:i + 7]))
+        self.assertEqual(self.records, records)
+        self.assertEqual(0, len(stream))
+
+    def test_when_segments_are_out_of_order_then_they_are_reordered(self):
+        stream = self._stream()
+        self.assertEqual([], stream.feed(self.isn + 1 + 30, self.data[30:]))
+        self.assertEqual(len(self.data) - 30, stream.out_of_order_bytes)
+        self.assertEqual(self.records, stream.feed(self.isn + 1, self.data[:30]))
+        self.assertEqual(0, len(stream))
+
+    def test_when_segments_are_retransmitted_then_data_is_not_duplicated(self):
+        stream = self._stream()
+        records = stream.feed(self.isn + 1, self.data[:30])
+        records += stream.feed(self.isn + 1, self.data[:30])
+        records += stream.feed(self.isn + 1 + 20, self.data[20:])
+        self.assertEqual(self.records, records)
+        self.assertEqual(30 + 10, stream.retransmitted_bytes)
+
+    def test_when_sequence_numbers_wrap_then_stream_is_reassembled(self):
+        stream = tlss.TCPStream()
+        isn = tlss.SEQ_MASK - 10
+        stream.feed(isn, "", tlss.TCPFlags.SYN)
+        records = stream.feed((isn + 1 + 20) & tlss.SEQ_MASK, self.data[20:])
+        records += stream.feed(isn + 1, self.data[:20])
+        self.assertEqual(self.records, records)
+
+    def test_when_out_of_order_budget_is_exhausted_then_gap_is_skipped_and_stream_resyncs(self):
+        stream = tlss.TCPStream(max_out_of_order=40)
+        stream.feed(self.isn, "", tlss.TCPFlags.SYN)
+        # The first record is lost, the stream continues with the next records
+        offset = len(self.records[0])
+        records = stream.feed(self.isn + 1 + offset, self.data[offset:offset + 30])
+        records += stream.feed(self.isn + 1 + offset + 30, self.data[offset + 30:])
+        self.assertEqual(self.records[1:], records)
+        self.assertEqual(offset, stream.bytes_lost)
+        self.assertLessEqual(stream.out_of_order_bytes, 40)
+
+    def test_when_stream_is_picked_up_midstream_then_it_syncs_on_next_record(self):
+        stream = tlss.TCPStream()
+        records = stream.feed(5000, self.data[3:])
+        self.assertEqual(self.records[1:], records)
+        self.assertEqual(len(self.records[0]) - 3, stream.bytes_lost)
+
+    def test_when_stream_is_picked_up_at_a_record_then_it_starts_synchronized(self):
+        client_hello = str(tls.SSLv2Record(length=0x1b) /
+                           tls.SSLv2ClientHello(cipher_suites=[0x700c0], challenge="A" * 15))
+        stream = tlss.TCPStream()
+        self.assertEqual([client_hello], stream.feed(5000, client_hello))
+        self.assertEqual(0, stream.bytes_lost)
+
+    def test_when_fin_is_seen_then_stream_is_closed(self):
+        stream = self._stream()
+        self.assertFalse(stream.closed)
+        stream.feed(self.isn + 1, "", tlss.TCPFlags.FIN | tlss.TCPFlags.ACK)
+        self.assertTrue(stream.closed)
+        self.assertTrue(stream.finished)
+
+    def test_when_fin_overtakes_data_then_stream_is_finished_once_data_is_received(self):
+        stream = self._stream()
+        stream.feed(self.isn + 1 + 30, self.data[30:])
+        self.assertEqual([], stream.feed(self.isn + 1 + len(self.data), "", tlss.TCPFlags.FIN | tlss.TCPFlags.ACK))
+        self.assertTrue(stream.closed)
+        self.assertFalse(stream.finished)
+        self.assertEqual(self.records, stream.feed(self.isn + 1, self.data[:30]))
+        self.assertTrue(stream.finished)
+
+
+class TestTCPReassembler(unittest.TestCase):
+
+    def test_when_reassembling_pcap_then_all_tls_records_are_emitted(self):
+        pkts = rdpcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap"))
+        expected = [str(record) for pkt in pkts if pkt.haslayer(tls.SSL) for record in pkt[tls.SSL].records]
+        reassembler = tlss.TCPReassembler()
+        stream_records = list(reassembler.reassemble(pkts))
+        self.assertEqual(expected, [record for _, record in stream_records])
+        self.assertEqual(("192.168.220.1", 12046, "192.168.220.131", 443), stream_records[0][0])
+        self.assertTrue(tls.SSL(stream_records[0][1]).haslayer(tls.TLSClientHello))
+        # Both directions were closed with FIN
+        self.assertEqual({}, reassembler.streams)
+
+    def test_when_fin_overtakes_data_then_stream_is_kept_until_data_is_received(self):
+        data = tls_record(data="A" * 30) + tls_record(data="B" * 30)
+
+        def segment(seq, payload="", flags="A"):
+            return IP(src="10.0.0.1", dst="10.0.0.2") / TCP(sport=40000, dport=443, seq=seq, flags=flags) / payload
+
+        reassembler = tlss.TCPReassembler()
+        pkts = [segment(99, flags="S"), segment(100 + 20, data[20:], "PA"), segment(100 + len(data), flags="FA"),
+                segment(100, data[:20], "PA")]
+        self.assertEqual([tls_record(data="A" * 30), tls_record(data="B" * 30)],
+                         [record for _, record in reassembler.reassemble(pkts)])
+        self.assertEqual({}, reassembler.streams)
+
+
+class TestFlowTable(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ("10.0.0.1", 40000)
+        self.server = ("10.0.0.2", 443)
+        self.record = tls_record(content_type=0x16, data="B" * 100)
+
+    def _open(self, table, client, server=None, timestamp=0):
+        server = server or self.server
+        table.feed(client, server, 100, "", tlss.TCPFlags.SYN, timestamp)
+        table.feed(server, client, 500, "", tlss.TCPFlags.SYN | tlss.TCPFlags.ACK, timestamp)
+
+    def test_when_both_directions_are_fed_then_they_share_one_flow(self):
+        table = tlss.FlowTable(ctx_factory=lambda flow: "ctx for %s:%d" % flow.client)
+        self._open(table, self.client)
+        flow, records = table.feed(self.client, self.server, 101, self.record, tlss.TCPFlags.ACK)
+        self.assertEqual([self.record], records)
+        server_flow, records = table.feed(self.server, self.client, 501, self.record, tlss.TCPFlags.ACK)
+        self.assertIs(flow, server_flow)
+        self.assertEqual([self.record], records)
+        self.assertEqual(1, len(table))
+        self.assertTrue(flow.is_client(self.client))
+        self.assertEqual("ctx for 10.0.0.1:40000", flow.ctx)
+
+    def test_when_picked_up_midstream_then_direction_can_be_fixed(self):
+        table = tlss.FlowTable()
+        flow, _ = table.feed(self.server, self.client, 501, self.record)
+        self.assertTrue(flow.is_client(self.server))
+        flow.set_client(self.client)
+        self.assertTrue(flow.is_client(self.client))
+        self.assertEqual(self.server, flow.server)
+
+    def test_when_flows_are_idle_then_they_are_expired(self):
+        evicted = []
+        table = tlss.FlowTable(idle_timeout=10, on_evict=lambda flow, reason: evicted.append((flow.client, reason)))
+        self._open(table, self.client, timestamp=0)
+        other_client = ("10.0.0.3", 40000)
+        self._open(table, other_client, timestamp=5)
+        self.assertEqual(0, table.expire(10))
+        self.assertEqual(1, table.expire(12))
+        self.assertEqual([(self.client, tlss.FlowTable.EVICT_IDLE)], evicted)
+        self.assertIsNotNone(table.get(tlss.flow_key(other_client[0], other_client[1], *self.server)))
+
+    def test_when_flow_limit_is_reached_then_least_recently_active_flow_is_evicted(self):
+        table = tlss.FlowTable(max_flows=2)
+        clients = [("10.0.0.%d" % i, 40000) for i in range(3)]
+        self._open(table, clients[0])
+        self._open(table, clients[1])
+        # Activity on the first flow makes the second one the least recently active
+        table.feed(clients[0], self.server, 101, self.record)
+        self._open(table, clients[2])
+        self.assertEqual(2, len(table))
+        self.assertNotIn(tlss.flow_key(clients[1][0], clients[1][1], *self.server), table)
+        self.assertEqual(1, table.evicted[tlss.FlowTable.EVICT_LRU])
+
+    def test_when_memory_limit_is_reached_then_flows_are_evicted(self):
+        table = tlss.FlowTable(max_memory=3 * tlss.TLSFlow.OVERHEAD)
+        for i in range(3):
+            self._open(table, ("10.0.0.%d" % i, 40000))
+        self.assertEqual(3, len(table))
+        # Held back out of order data counts against the memory limit
+        table.feed(("10.0.0.2", 40000), self.server, 200, self.record)
+        self.assertEqual(2, len(table))
+        self.assertLessEqual(table.memory, 3 * tlss.TLSFlow.OVERHEAD)
+
+    def test_when_session_contexts_keep_records_then_they_count_against_the_memory_limit(self):
+        for history_policy, flows in ((tlsc.TLSSessionCtx.HISTORY_ALL, 1), (tlsc.TLSSessionCtx.HISTORY_NONE, 2)):
+            max_memory = 2 * (tlss.TLSFlow.OVERHEAD + tlss.TLSFlow.CTX_OVERHEAD) + tlss.TLSFlow.RECORD_OVERHEAD
+            table = tlss.FlowTable(max_memory=max_memory,
+                                   ctx_factory=lambda flow: tlsc.TLSSessionCtx(history_policy=history_policy))
+            clients = [("10.0.0.%d" % i, 40000) for i in range(2)]
+            for client in clients:
+                self._open(table, client)
+            flow = table.get(tlss.flow_key(clients[1][0], clients[1][1], *self.server))
+            for _ in range(2):
+                flow.ctx.insert(tls.TLSRecord() / tls.TLSPlaintext(data="A" * 10))
+            # Records inserted by consumers are accounted for on the next segment of the flow
+            table.feed(clients[1], self.server, 101, tls_record())
+            self.assertEqual(flows, len(table))
+            self.assertLessEqual(table.memory, max_memory)
+            self.assertEqual(sum(len(flow) for flow in table), table.memory)
+
+    def test_when_flow_is_closed_then_it_is_dropped(self):
+        table = tlss.FlowTable()
+        self._open(table, self.client)
+        table.feed(self.client, self.server, 101, "", tlss.TCPFlags.RST)
+        self.assertEqual(0, len(table))
+        self.assertEqual(0, table.memory)
+
+    def test_when_reassembling_pcap_then_records_are_attributed_to_flow_and_source(self):
+        pkts = rdpcap(env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap"))
+        table = tlss.FlowTable()
+        records = list(table.reassemble(pkts))
+        self.assertEqual(16, len(records))
+        flow, source, record = records[0]
+        self.assertTrue(flow.is_client(source))
+        self.assertEqual(("192.168.220.131", 443), flow.server)
+        self.assertTrue(all(flow is record_flow for record_flow, _, _ in records))
+        self.assertEqual(0, len(table))
+
+
+if __name__ == "__main__":
+    unittest.main()